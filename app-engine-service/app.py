@@ -1,9 +1,44 @@
-from flask import Flask, redirect
+# Serves the counts find_stats.py publishes to Datastore
+
+# The stats are read through a backend (see stats_backend): the Datastore project, or, when STATS_SNAPSHOT names one,
+# a local SQLite snapshot written by find_stats.py.  The Datastore backend keeps one client per thread for its
+# lifetime instead of creating one per request.  The counts are looked up by key (entities are named after their
+# condition or trackable, see stats_publisher), falling back to a query for data published before keys were named.
+# Results are kept in an in-process TTL cache (STATS_CACHE_SECONDS, default 10 minutes), which is also cleared when
+# the DatasetVersion entity changes, checked at most every VERSION_CHECK_SECONDS.  /metrics reports cache hits and
+# misses and per endpoint latencies.
+
+# The normalized endpoints and /condition_stats read the ConditionStats entities find_stats.py precomputes, with each
+# condition's trackables already sorted by ratio, so top_n and min_users only pick from the front of the lists.  For
+# stats published before those entities were, /condition_counts_norm works the ratios out from the condition's counts
+# and the trackables' totals instead.
+
+# The /batch endpoints take many conditions or trackable names in one request (?condition=A&condition=B, or
+# ?name=A&name=B for counts), fetch whatever isn't cached with one multi-get, and return compact JSON with null for
+# the ones that weren't found.  They only look up named keys, a query per missing name would undo the multi-get, so
+# data published before keys were named needs publishing again first.  They, and /conditions, send a weak ETag of
+# the JSON, answer If-None-Match with 304 Not Modified, and gzip larger responses for clients that accept it, so a
+# dashboard can poll them cheaply.
+
+from flask import Flask, Response, redirect, request
 from flask.ext.restful import reqparse, abort, Api, Resource, fields,marshal_with
 from flask_restful_swagger import swagger
 import csv
+import hashlib
 import json
-from google.cloud import datastore
+import os
+import threading
+import time
+import zlib
+import stats_backend
+import stats_cache
+
+CACHE_SECONDS = int(os.environ.get('STATS_CACHE_SECONDS', 600))
+CACHE_ENTRIES = 2000
+VERSION_CHECK_SECONDS = 30
+MAX_BATCH = 1000 #names per batch request
+GZIP_BYTES = 1024 #smaller responses aren't worth compressing
+SNAPSHOT = os.environ.get('STATS_SNAPSHOT')
 
 app = Flask(__name__, static_folder='../static')
 
@@ -14,47 +49,171 @@ api = swagger.docs(Api(app), apiVersion='0.1',
                    api_spec_url='/api/spec',
                    description='Supplies summary statistics for Flaredown data')
 
+#imported here so the snapshot doesn't need the Datastore client installed
 def create_client():
+    from google.cloud import datastore
     project_id = 'flaredown-149515'
     return datastore.Client(project_id)
 
-def getCountsByCondition(client, trackable_type, condition):
-    query = client.query(kind='Condition' + trackable_type)
-    query.add_filter('condition','=',condition)
-    for result in query.fetch(limit=1):
+backend = stats_backend.SnapshotBackend(SNAPSHOT) if SNAPSHOT else stats_backend.DatastoreBackend(create_client)
+cache = stats_cache.TTLCache(CACHE_SECONDS, CACHE_ENTRIES)
+metrics = stats_cache.Metrics()
+version = {'version': None, 'checked': 0}
+version_lock = threading.Lock()
+
+#drops the cached results when a new dataset has been published since the last check
+def check_version(backend):
+    with version_lock:
+        if time.time() - version['checked'] < VERSION_CHECK_SECONDS:
+            return
+        version['checked'] = time.time()
+    current = backend.version()
+    with version_lock:
+        changed = current != version['version']
+        version['version'] = current
+    if changed:
+        cache.clear()
+
+def cached(key, load):
+    check_version(backend)
+    return cache.get(key, lambda: load(backend))
+
+#a dict of name: value for each of names, the cached ones under key + (name,) and the rest from one
+#load_many(backend, names) call
+def cached_many(key, names, load_many):
+    check_version(backend)
+    def load(keys):
+        loaded = load_many(backend, [k[-1] for k in keys])
+        return dict((key + (name,), value) for name, value in loaded.items())
+    found = cache.get_many([key + (name,) for name in names], load)
+    return dict((name, found.get(key + (name,))) for name in names)
+
+def getCountsByCondition(backend, trackable_type, condition):
+    result = backend.get('Condition' + trackable_type, condition)
+    if result is not None:
         return result
+    return backend.find('Condition' + trackable_type, 'condition', condition)
+
+def getCountsByConditions(backend, trackable_type, conditions):
+    return backend.get_many('Condition' + trackable_type, conditions)
 
-def getTotal(client, trackable_type, trackable_name):
-    query = client.query(kind=trackable_type + 'Count')
-    query.add_filter('name','=',trackable_name)
-    for result in query.fetch(limit=1):
+def getTotal(backend, trackable_type, trackable_name):
+    result = backend.get(trackable_type + 'Count', trackable_name)
+    if result is None:
+        result = backend.find(trackable_type + 'Count', 'name', trackable_name)
+    if result is not None:
         return result['count']
 
-def getAllTotals(client, trackable_type):
-    query = client.query(kind=trackable_type + 'Count')
-    totals_dict = {}
-    for result in query.fetch():
-        if result['name'] != 'condition':
-            totals_dict[result['name']] = result['count']
-    return totals_dict
+def getTotals(backend, trackable_type, trackable_names):
+    results = backend.get_many(trackable_type + 'Count', trackable_names)
+    return dict((name, result['count']) for name, result in results.items())
+
+#the counts of a condition entity, without its other properties
+def conditionCounts(condition_dict):
+    counts = dict(condition_dict or {})
+    counts.pop('condition', None)
+    counts.pop('id', None)
+    counts.pop('content_hash', None)
+    return counts
+
+#a condition's ConditionStats entity (see find_stats.py) with its stats parsed, once per cached entry
+def parseStats(entity):
+    if entity is None:
+        return None
+    stats = json.loads(entity['stats'])
+    stats['condition_users'] = entity['condition_users']
+    return stats
+
+def getConditionStats(backend, trackable_type, condition):
+    return parseStats(backend.get('ConditionStats' + trackable_type, condition))
+
+def getConditionStatsMany(backend, trackable_type, conditions):
+    entities = backend.get_many('ConditionStats' + trackable_type, conditions)
+    return dict((condition, parseStats(entity)) for condition, entity in entities.items())
+
+#the ratios of a condition's stats worked out from its counts and the totals of its trackables, highest ratio first
+#like the stats, for data published before the ConditionStats entities were
+def countStats(backend, trackable_type, condition):
+    counts = conditionCounts(getCountsByCondition(backend, trackable_type, condition))
+    if not counts:
+        return None
+    totals = getTotals(backend, trackable_type, list(counts))
+    if len(totals) < len(counts):
+        #totals published before keys were named, one query for all of them rather than one per name
+        for result in backend.all(trackable_type + 'Count'):
+            totals.setdefault(result['name'], result['count'])
+    names = sorted([name for name in counts if totals.get(name)],
+                   key=lambda name: (-float(counts[name]) / totals[name], name))
+    return {'names': names, 'users': [counts[name] for name in names],
+            'ratio': [float(counts[name]) / totals[name] for name in names]}
 
-def getConditionList(client):
-    query = client.query(kind='ConditionList')
+#top_n and min_users from the query string, no top_n is every trackable
+def statsParameters():
+    top_n = request.args.get('top_n', None, type=int)
+    min_users = request.args.get('min_users', 0, type=int)
+    if (top_n is not None and top_n < 0) or min_users < 0:
+        abort(400, message="top_n and min_users can't be negative")
+    return top_n, min_users
+
+#positions of the first top_n trackables reported by at least min_users of the condition's users, the stats are
+#already sorted highest ratio first
+def selectStats(stats, top_n, min_users):
+    selected = []
+    for i, users in enumerate(stats['users']):
+        if top_n is not None and len(selected) >= top_n:
+            break
+        if users >= min_users:
+            selected.append(i)
+    return selected
+
+def ratios(stats, top_n, min_users):
+    return dict((stats['names'][i], stats['ratio'][i]) for i in selectStats(stats, top_n, min_users))
+
+#compact JSON with a weak ETag, 304 when the client already has it, gzipped when the client accepts it
+def json_response(data):
+    body = json.dumps(data, separators=(',', ':'), sort_keys=True)
+    etag = hashlib.sha1(body).hexdigest()
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype='application/json')
+        if len(body) >= GZIP_BYTES and request.accept_encodings['gzip'] > 0:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            response.set_data(compressor.compress(body) + compressor.flush())
+            response.headers['Content-Encoding'] = 'gzip'
+    response.set_etag(etag, weak=True)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+#the distinct values of a repeated query parameter, in the order given
+def requestNames(parameter):
+    names = []
+    for name in request.args.getlist(parameter):
+        if name not in names:
+            names.append(name)
+    if not names:
+        abort(400, message="give one or more names as ?%s=...&%s=..." % (parameter, parameter))
+    if len(names) > MAX_BATCH:
+        abort(400, message="at most %d names per request" % MAX_BATCH)
+    return names
+
+def getConditionList(backend):
     conditions = []
-    for result in query.fetch():
+    for result in backend.all('ConditionList'):
         conditions.append(result['name'])
     return conditions
 
 class ConditionsList(Resource):
   @swagger.operation(
-      notes='Returns a comma seperated list of all conditions.  Rather than a list of all conditions that have ever been reported, this is a currated list where synonymous conditions have been combined.  Where the other endpoints request a condition, it should be provided in the format given here.',
+      notes='Returns a JSON list of all conditions.  Rather than a list of all conditions that have ever been reported, this is a currated list where synonymous conditions have been combined.  Where the other endpoints request a condition, it should be provided in the format given here.',
       nickname='get'
       )
+  @metrics.timed('conditions')
   def get(self):
-    client = create_client()
-    conditions = getConditionList(client)
+    conditions = cached(('conditions',), getConditionList)
 
-    return str(conditions), 200
+    return json_response(conditions)
 
 class ConditionTrackableCounts(Resource):
   @swagger.operation(
@@ -78,18 +237,18 @@ class ConditionTrackableCounts(Resource):
               "paramType": "path"
           }
       ])
+  @metrics.timed('condition_counts')
   def get(self, trackable_type, condition):
-    client = create_client()
-    condition_dict = getCountsByCondition(client, trackable_type, condition)
-    condition_dict.pop('condition', None)
-    condition_dict.pop('id', None)
+    condition_dict = cached(('condition', trackable_type, condition),
+                            lambda backend: getCountsByCondition(backend, trackable_type, condition))
+    condition_dict = conditionCounts(condition_dict)
     if len(condition_dict.values()) == 0:
         return "condition not found", 404
     return json.dumps(condition_dict), 200
 
 class ConditionTrackableCountsNormalized(Resource):
   @swagger.operation(
-      notes='Get the percent of users that report a trackable and also reported a condition.  Used to estimate if a trackable is likely caused by a condition.  For example if you request Symptom/Fibromyalgia, you will be returned a list of what percentage of people reporting each symptom also reported Fibromyalgia.',
+      notes='Get the percent of users that report a trackable and also reported a condition.  Used to estimate if a trackable is likely caused by a condition.  For example if you request Symptom/Fibromyalgia, you will be returned a list of what percentage of people reporting each symptom also reported Fibromyalgia.  Trackables none of the condition\'s users reported are left out.',
       nickname='get',
       parameters=[
           {
@@ -107,22 +266,85 @@ class ConditionTrackableCountsNormalized(Resource):
               "allowMultiple": False,
               "dataType": 'string',
               "paramType": "path"
+          },
+          {
+              "name": "top_n",
+              "description": "Only the trackables with the top_n highest percentages",
+              "required": False,
+              "allowMultiple": False,
+              "dataType": 'integer',
+              "paramType": "query"
+          },
+          {
+              "name": "min_users",
+              "description": "Only trackables reported by at least this many users with the condition",
+              "required": False,
+              "allowMultiple": False,
+              "dataType": 'integer',
+              "paramType": "query"
           }
       ])
+  @metrics.timed('condition_counts_norm')
   def get(self, trackable_type, condition):
-    client = create_client()
-    condition_dict = getCountsByCondition(client, trackable_type, condition)
-    totals_dict = getAllTotals(client,trackable_type)
-
-    condition_dict.pop('condition',None)
-    condition_dict.pop('id', None)
-
-    for key,value in condition_dict.iteritems():
-        condition_dict[key] = float(value) / float(totals_dict[key])
+    top_n, min_users = statsParameters()
+    stats = cached(('stats', trackable_type, condition),
+                   lambda backend: getConditionStats(backend, trackable_type, condition))
+    if stats is None:
+        stats = cached(('count_stats', trackable_type, condition),
+                       lambda backend: countStats(backend, trackable_type, condition))
+    if stats is None:
+        return "condition not found", 404
+    return json.dumps(ratios(stats, top_n, min_users)), 200
 
-    if len(condition_dict.values()) == 0:
+class ConditionTrackableStats(Resource):
+  @swagger.operation(
+      notes='The trackables reported by users with a condition, highest percentage first.  For each: users, the number of users with the condition that reported it; total, the number of users that reported it; ratio, users / total as in condition_counts_norm, with ci_low and ci_high its 95% Wilson score interval; and lift, how many times more common the condition is among the users that reported the trackable than among all users.',
+      nickname='get',
+      parameters=[
+          {
+            "name": "condition",
+            "description": "The name of the condition",
+            "required": True,
+            "allowMultiple": False,
+            "dataType": 'string',
+            "paramType": "path"
+          },
+          {
+              "name": "trackable_type",
+              "description": "The trackable type that the condition will be compared to (Condition, Symptom, Treatment, Tag)",
+              "required": True,
+              "allowMultiple": False,
+              "dataType": 'string',
+              "paramType": "path"
+          },
+          {
+              "name": "top_n",
+              "description": "Only the trackables with the top_n highest percentages",
+              "required": False,
+              "allowMultiple": False,
+              "dataType": 'integer',
+              "paramType": "query"
+          },
+          {
+              "name": "min_users",
+              "description": "Only trackables reported by at least this many users with the condition",
+              "required": False,
+              "allowMultiple": False,
+              "dataType": 'integer',
+              "paramType": "query"
+          }
+      ])
+  @metrics.timed('condition_stats')
+  def get(self, trackable_type, condition):
+    top_n, min_users = statsParameters()
+    stats = cached(('stats', trackable_type, condition),
+                   lambda backend: getConditionStats(backend, trackable_type, condition))
+    if stats is None:
         return "condition not found", 404
-    return json.dumps(condition_dict), 200
+    trackables = [{'name': stats['names'][i], 'users': stats['users'][i], 'total': stats['totals'][i],
+                   'ratio': stats['ratio'][i], 'ci_low': stats['ci_low'][i], 'ci_high': stats['ci_high'][i],
+                   'lift': stats['lift'][i]} for i in selectStats(stats, top_n, min_users)]
+    return json_response({'condition': condition, 'condition_users': stats['condition_users'], 'trackables': trackables})
 
 class Counts(Resource):
   @swagger.operation(
@@ -146,19 +368,138 @@ class Counts(Resource):
               "paramType": "path"
           }
       ])
+  @metrics.timed('counts')
   def get(self, trackable_type, trackable_name):
-      client = create_client()
-
-      total = getTotal(client, trackable_type, trackable_name)
+      total = cached(('total', trackable_type, trackable_name),
+                     lambda backend: getTotal(backend, trackable_type, trackable_name))
       return total, 200
 
+class BatchConditionTrackableCounts(Resource):
+  @swagger.operation(
+      notes='The condition_counts of many conditions at once, as a JSON object of condition: counts, null for conditions that were not found',
+      nickname='get',
+      parameters=[
+          {
+              "name": "trackable_type",
+              "description": "The trackable type that the conditions will be compared to (Condition, Symptom, Treatment, Tag)",
+              "required": True,
+              "allowMultiple": False,
+              "dataType": 'string',
+              "paramType": "path"
+          },
+          {
+            "name": "condition",
+            "description": "The name of a condition, repeated for each condition",
+            "required": True,
+            "allowMultiple": True,
+            "dataType": 'string',
+            "paramType": "query"
+          }
+      ])
+  @metrics.timed('batch_condition_counts')
+  def get(self, trackable_type):
+    conditions = requestNames('condition')
+    condition_dicts = cached_many(('condition', trackable_type), conditions,
+                                  lambda backend, names: getCountsByConditions(backend, trackable_type, names))
+    return json_response(dict((condition, conditionCounts(condition_dict) if condition_dict else None)
+                              for condition, condition_dict in condition_dicts.items()))
+
+class BatchConditionTrackableCountsNormalized(Resource):
+  @swagger.operation(
+      notes='The condition_counts_norm of many conditions at once, as a JSON object of condition: percentages, null for conditions that were not found.  top_n and min_users apply to each condition.',
+      nickname='get',
+      parameters=[
+          {
+              "name": "trackable_type",
+              "description": "The trackable type that the conditions will be compared to (Condition, Symptom, Treatment, Tag)",
+              "required": True,
+              "allowMultiple": False,
+              "dataType": 'string',
+              "paramType": "path"
+          },
+          {
+            "name": "condition",
+            "description": "The name of a condition, repeated for each condition",
+            "required": True,
+            "allowMultiple": True,
+            "dataType": 'string',
+            "paramType": "query"
+          },
+          {
+              "name": "top_n",
+              "description": "Only the trackables with the top_n highest percentages",
+              "required": False,
+              "allowMultiple": False,
+              "dataType": 'integer',
+              "paramType": "query"
+          },
+          {
+              "name": "min_users",
+              "description": "Only trackables reported by at least this many users with the condition",
+              "required": False,
+              "allowMultiple": False,
+              "dataType": 'integer',
+              "paramType": "query"
+          }
+      ])
+  @metrics.timed('batch_condition_counts_norm')
+  def get(self, trackable_type):
+    conditions = requestNames('condition')
+    top_n, min_users = statsParameters()
+    condition_stats = cached_many(('stats', trackable_type), conditions,
+                                  lambda backend, names: getConditionStatsMany(backend, trackable_type, names))
+    return json_response(dict((condition, ratios(stats, top_n, min_users) if stats else None)
+                              for condition, stats in condition_stats.items()))
+
+class BatchCounts(Resource):
+  @swagger.operation(
+      notes='The number of users reporting each of many trackables, as a JSON object of name: count, null for trackables that were not found',
+      nickname='get',
+      parameters=[
+          {
+              "name": "trackable_type",
+              "description": "The type of the trackables, (Symptom, Condition, Treatment, Tag)",
+              "required": True,
+              "allowMultiple": False,
+              "dataType": 'string',
+              "paramType": "path"
+          },
+          {
+              "name": "name",
+              "description": "The name of a trackable, repeated for each trackable",
+              "required": True,
+              "allowMultiple": True,
+              "dataType": 'string',
+              "paramType": "query"
+          }
+      ])
+  @metrics.timed('batch_counts')
+  def get(self, trackable_type):
+    names = requestNames('name')
+    return json_response(cached_many(('total', trackable_type), names,
+                                     lambda backend, names: getTotals(backend, trackable_type, names)))
+
+class Metrics(Resource):
+  @swagger.operation(
+      notes='Cache hits, misses and hit rate, and request counts and latency percentiles in milliseconds for each endpoint',
+      nickname='get'
+      )
+  def get(self):
+      return {'backend': backend.name, 'cache': cache.stats(), 'endpoints': metrics.stats(),
+              'dataset_version': version['version']}, 200
+
 ##
 ## Actually setup the Api resource routing here
 ##
 api.add_resource(ConditionsList,'/conditions')
 api.add_resource(ConditionTrackableCounts, '/condition_counts/<string:trackable_type>/<string:condition>')
 api.add_resource(ConditionTrackableCountsNormalized, '/condition_counts_norm/<string:trackable_type>/<string:condition>')
+api.add_resource(ConditionTrackableStats, '/condition_stats/<string:trackable_type>/<string:condition>')
 api.add_resource(Counts, '/counts/<string:trackable_type>/<string:trackable_name>')
+api.add_resource(BatchConditionTrackableCounts, '/batch/condition_counts/<string:trackable_type>')
+api.add_resource(BatchConditionTrackableCountsNormalized, '/batch/condition_counts_norm/<string:trackable_type>')
+api.add_resource(BatchCounts, '/batch/counts/<string:trackable_type>')
+api.add_resource(Metrics, '/metrics')
 
 
 @app.route('/docs')
@@ -0,0 +1,117 @@
+# An in-memory stand in for google.cloud.datastore's Client, for running the publisher and the API without a project
+# It covers the calls this service makes: keys, get/get_multi, put/put_multi, delete_multi and equality filtered queries
+# Every call that would be a round trip to Datastore is counted in round_trips, and failures can be queued with fail()
+# to exercise retries
+
+import itertools
+import threading
+
+class Key(object):
+    #Datastore keeps names as unicode, utf-8 strs are the same name
+    def __init__(self, kind, name=None):
+        self.kind = kind
+        self.name = name if not isinstance(name, (int, long)) else None
+        if isinstance(self.name, str):
+            self.name = self.name.decode('utf-8')
+        self.id = name if isinstance(name, (int, long)) else None
+
+    @property
+    def id_or_name(self):
+        return self.name if self.name is not None else self.id
+
+    def __eq__(self, other):
+        return isinstance(other, Key) and (self.kind, self.id_or_name) == (other.kind, other.id_or_name)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.kind, self.id_or_name))
+
+    def __repr__(self):
+        return "Key(%r, %r)" % (self.kind, self.id_or_name)
+
+class Entity(dict):
+    def __init__(self, key=None, exclude_from_indexes=()):
+        dict.__init__(self)
+        self.key = key
+        self.exclude_from_indexes = set(exclude_from_indexes)
+
+class Query(object):
+    def __init__(self, client, kind):
+        self.client = client
+        self.kind = kind
+        self.filters = []
+        self.keys_only_query = False
+
+    def add_filter(self, property_name, operator, value):
+        if operator != '=':
+            raise ValueError("the fake client only supports equality filters")
+        self.filters.append((property_name, value))
+
+    def keys_only(self):
+        self.keys_only_query = True
+
+    def fetch(self, limit=None):
+        self.client.call()
+        with self.client.lock:
+            entities = [entity for key, entity in sorted(self.client.entities.items(), key=lambda item: repr(item[0]))
+                        if key.kind == self.kind and all(entity.get(name) == value for name, value in self.filters)]
+        for entity in itertools.islice(entities, limit):
+            yield Entity(entity.key) if self.keys_only_query else self.client.copy(entity)
+
+class Client(object):
+    def __init__(self, project=None):
+        self.project = project
+        self.entities = {}
+        self.lock = threading.Lock()
+        self.round_trips = 0
+        self.failures = []
+        self.ids = itertools.count(1)
+
+    #the next count calls raise error
+    def fail(self, error, count=1):
+        self.failures.extend([error] * count)
+
+    def call(self):
+        with self.lock:
+            self.round_trips += 1
+            if self.failures:
+                raise self.failures.pop(0)
+
+    def copy(self, entity):
+        copied = Entity(entity.key, entity.exclude_from_indexes)
+        copied.update(entity)
+        return copied
+
+    def key(self, kind, name=None):
+        return Key(kind, name)
+
+    def query(self, kind=None):
+        return Query(self, kind)
+
+    def get(self, key):
+        entities = self.get_multi([key])
+        return entities[0] if entities else None
+
+    def get_multi(self, keys):
+        self.call()
+        with self.lock:
+            return [self.copy(self.entities[key]) for key in keys if key in self.entities]
+
+    def put(self, entity):
+        self.put_multi([entity])
+
+    def put_multi(self, entities):
+        self.call()
+        with self.lock:
+            for entity in entities:
+                if entity.key.id_or_name is None:
+                    entity.key = Key(entity.key.kind, next(self.ids))
+                self.entities[entity.key] = self.copy(entity)
+
+    def delete_multi(self, keys):
+        self.call()
+        with self.lock:
+            for key in keys:
+                self.entities.pop(key, None)
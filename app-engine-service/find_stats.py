@@ -4,99 +4,189 @@
 #need to authenticate before running by setting an environment variable to your keyfile like:
 #export GOOGLE_APPLICATION_CREDENTIALS=Flaredown-24ac7b1e7653.json
 
-#if updating, be sure to delete old records first or you will get duplicates
-
+#or write the same entities to a local snapshot the API can serve from (STATS_SNAPSHOT=stats.db python app.py):
+#python find_stats.py stats.db
+
+#entities are keyed by condition or trackable name and written through stats_publisher, so rerunning this overwrites
+#the previous counts and only sends the entities that changed.  Records written before keys were named have random ids,
+#delete those once with stats_publisher.delete_unnamed (commented out at the bottom).  Conditions whose names aren't
+#published any more, such as "Acid Reflux" now that it is counted under "Acid reflux", are deleted after publishing
+#from the condition kinds this run wrote
+
+#every count is worked out in a single pass before anything is written: the loader gives each row the code of the
+#canonical condition its name is a synonym of (condition_names.py, compiled from conditions_list.csv), which makes a
+#sparse user x condition matrix of which users have each condition, and that times a user x trackable name incidence
+#matrix gives the number of users of every condition that reported every trackable, for all four trackable types at once
+
+#writeConditionCounts also stores a ConditionStats<type> entity for each condition, so the API's normalized endpoints
+#are a read rather than dividing every count by its total on each request.  For each trackable at least one of the
+#condition's users reported, highest ratio first, it holds:
+#  users   - users with the condition that reported the trackable
+#  totals  - users that reported the trackable
+#  ratio   - users / totals, the share of the trackable's users that have the condition
+#  ci_low, ci_high - the 95% Wilson score interval of that share
+#  lift    - ratio / the share of all users that have the condition, how much more common the condition is among the
+#            trackable's users than among everybody
+#as parallel lists in one unindexed JSON string, stats
+
+import os
+import sys
 import numpy as np
 import pandas as pd
 import random
-from google.cloud import datastore
+from scipy import sparse
 import json
+import stats_backend
+import stats_publisher
+
+#trackable_loader lives in the repository root, this script runs offline and isn't part of the deployed service
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import condition_names
+import trackable_loader
+
+TRACKABLE_TYPES = ['Symptom', 'Condition', 'Treatment', 'Tag']
+#the kinds keyed by condition, <type>Count is keyed by trackable name
+CONDITION_KINDS = ['ConditionList'] + ['Condition' + trackable_type for trackable_type in TRACKABLE_TYPES] + \
+    ['ConditionStats' + trackable_type for trackable_type in TRACKABLE_TYPES]
 
+#imported here so the snapshot doesn't need the Datastore client installed
 def create_client():
+    from google.cloud import datastore
     project_id = 'flaredown-149515'
     return datastore.Client(project_id)
 
-def add_trackable(client, trackable_type, dict):
-    key = client.key('Condition'+trackable_type)
-    trackable_entity = datastore.Entity(
-        key)
-
-    trackable_entity.update(dict)
-    client.put(trackable_entity)
-    return trackable_entity.key
-
-def add_condition_list(client, conditions):
-    key = client.key('ConditionList')
-    for condition in conditions:
-        trackable_entity = datastore.Entity(
-        key)
-
-        trackable_entity.update({
-            "name": condition,
-        })
-        client.put(trackable_entity)
-    return trackable_entity.key
-
-def add_trackable_count(client, trackable_type, trackable_name, count):
-    key = client.key(trackable_type+"Count")
-    trackable_entity = datastore.Entity(
-        key)
-
-    trackable_entity.update({
+#keyed by the condition, the 'id' and 'condition' properties can be overwritten by trackables with those names
+def add_trackable(publisher, trackable_type, condition, dict):
+    return publisher.add('Condition'+trackable_type, condition, dict)
+
+def add_condition_stats(publisher, trackable_type, condition, condition_users, stats):
+    return publisher.add('ConditionStats'+trackable_type, condition, {
+        "condition": condition,
+        "condition_users": condition_users,
+        "stats": json.dumps(stats, separators=(',', ':')),
+    }, exclude_from_indexes=['stats'])
+
+def add_condition_list(publisher, conditions_index):
+    for condition in conditions_index.names:
+        key = publisher.add('ConditionList', condition, dict(conditions_index.describe(condition), name=condition))
+    return key
+
+def add_trackable_count(publisher, trackable_type, trackable_name, count):
+    return publisher.add(trackable_type+"Count", trackable_name, {
         "name" : trackable_name,
         "count" : count
     })
-    client.put(trackable_entity)
-    return trackable_entity.key
-
-df = pd.read_csv("flaredown_trackable_data_080316.csv")
-df['checkin_date'] = pd.to_datetime(df['checkin_date'])
-
-anno_df = pd.read_csv("conditions_list.csv")
-conditions_set = set(anno_df['New Name'])
-conditions_set = set(filter(lambda x: x == x, conditions_set)) #remove nan
 
-def writeConditionCounts(client, trackable_type):
+conditions_index = condition_names.ConditionIndex("conditions_list.csv")
+df = trackable_loader.load("flaredown_trackable_data_080316.csv", conditions=conditions_index)
+
+#distinct user counts of every trackable name, overall and among the users of each condition
+#returns the position of each name, the conditions x names matrix of counts and the number of users of each name
+def countUsers(df, condition_count):
+    user_index, users = pd.factorize(df['user_id'])
+    name_index, names = pd.factorize(df['trackable_name'])
+    logged = (user_index >= 0) & (name_index >= 0)
+    incidence = sparse.csr_matrix((np.ones(logged.sum()), (user_index[logged], name_index[logged])), shape=(len(users), len(names)))
+    incidence.data[:] = 1 #a user counts once however many times they logged a name
+    names = pd.Index(list(names))
+
+    #a user has a condition if they logged any of its synonyms, of any trackable type
+    codes = df['condition_code'].values
+    listed = (user_index >= 0) & (codes >= 0)
+    condition_users = sparse.csr_matrix((np.ones(listed.sum()), (user_index[listed], codes[listed])), shape=(len(users), condition_count))
+    condition_users.data[:] = 1
+    condition_counts = (condition_users.T * incidence).tocsr()
+    user_counts = np.asarray(incidence.sum(axis=0)).ravel()
+    condition_user_counts = np.asarray(condition_users.sum(axis=0)).ravel()
+    return dict((name, i) for i, name in enumerate(names)), condition_counts, user_counts, condition_user_counts, len(users)
+
+conditions = conditions_index.names
+name_positions, condition_counts, user_counts, condition_user_counts, all_users = countUsers(df, len(conditions))
+
+Z = 1.96 #95% intervals
+
+#the ConditionStats properties of one condition, from the counts of its users reporting each of names
+def conditionStats(names, counts, totals, condition_users, all_users):
+    reported = counts > 0
+    names, counts, totals = [n for n, r in zip(names, reported) if r], counts[reported], totals[reported].astype(float)
+    ratio = counts / totals
+    lift = ratio * all_users / max(condition_users, 1)
+    center = (ratio + Z ** 2 / (2 * totals)) / (1 + Z ** 2 / totals)
+    spread = Z * np.sqrt(ratio * (1 - ratio) / totals + Z ** 2 / (4 * totals ** 2)) / (1 + Z ** 2 / totals)
+    order = sorted(range(len(names)), key=lambda i: (-ratio[i], -counts[i], names[i]))
+    rounded = lambda values: [round(float(values[i]), 6) for i in order]
+    return {
+        'names': [names[i] for i in order],
+        'users': [int(counts[i]) for i in order],
+        'totals': [int(totals[i]) for i in order],
+        'ratio': rounded(ratio),
+        'ci_low': rounded(center - spread),
+        'ci_high': rounded(center + spread),
+        'lift': rounded(lift),
+    }
+
+def writeConditionCounts(publisher, trackable_type):
     trackables = set(df[df['trackable_type'] == trackable_type]['trackable_name'])
     trackables = list(set(filter(lambda x: x == x, trackables)))  # remove nan
 
-    for condition in conditions_set:
+    #names that only differ by newlines or commas clean to the same name, the stats keep the one most users reported
+    variants = {}
+    for trackable in trackables:
+        trackable_clean = ''.join(''.join(trackable.split("\n")).split(","))
+        if not trackable_clean:
+            continue
+        if trackable_clean not in variants or user_counts[name_positions[trackable]] > user_counts[variants[trackable_clean]]:
+            variants[trackable_clean] = name_positions[trackable]
+    clean_names = sorted(variants)
+    positions = np.array([variants[name] for name in clean_names], dtype=int)
+
+    for i, condition in enumerate(conditions):
         print trackable_type + ' ' + condition
         trackable_dict = {}
         trackable_dict['condition'] = condition
         trackable_dict['id'] = condition
-        names = anno_df[anno_df['New Name'] == condition]['Condition'].values
-
-        #condition_df = df[df['trackable_name'].isin(names)]
-        condition_df = df.groupby(['user_id']).filter(lambda x: len(set(x['trackable_name'].values) & set(names)) > 0)
+        condition_row = condition_counts[i].toarray().ravel()
         for trackable in trackables:
-            trackable_df = condition_df[condition_df['trackable_name'] == trackable]
             trackable_clean = ''.join(trackable.split("\n"))
             trackable_clean = ''.join(trackable_clean.split(","))
-            trackable_dict[trackable_clean] = len(trackable_df.groupby('user_id'))
-        key = add_trackable(client,trackable_type,trackable_dict)
+            if trackable_clean:
+                trackable_dict[trackable_clean] = int(condition_row[name_positions[trackable]])
+        key = add_trackable(publisher,trackable_type,condition,trackable_dict)
         print key
+        stats = conditionStats(clean_names, condition_row[positions], user_counts[positions], condition_user_counts[i], all_users)
+        add_condition_stats(publisher, trackable_type, condition, int(condition_user_counts[i]), stats)
 
 
-def writeCounts(client, trackable_type):
+def writeCounts(publisher, trackable_type):
     trackables = set(df[df['trackable_type'] == trackable_type]['trackable_name'])
     trackables = list(set(filter(lambda x: x == x, trackables)))  # remove nan
     for trackable in trackables:
         trackable_clean = ''.join(trackable.split("\n"))
         trackable_clean = ''.join(trackable_clean.split(","))
-        trackable_df = df[df['trackable_name'] == trackable].groupby('user_id')
-        num_of_users = len(trackable_df)
-        add_trackable_count(client, trackable_type, trackable_clean, num_of_users)
-
-client = create_client()
-#writeConditionCounts(client, 'Symptom')
-#writeConditionCounts(client,'Condition')
-#writeConditionCounts(client,'Treatment')
-writeConditionCounts(client,'Tag')
-
-#add_condition_list(client,conditions_set)
-
-#writeCounts(client,'Symptom')
-#writeCounts(client,'Condition')
-#writeCounts(client,'Treatment')
-#writeCounts(client,'Tag')
\ No newline at end of file
+        #names that are only newlines and commas clean to nothing, which can't be an entity's name
+        if not trackable_clean:
+            continue
+        num_of_users = int(user_counts[name_positions[trackable]])
+        add_trackable_count(publisher, trackable_type, trackable_clean, num_of_users)
+
+if len(sys.argv) > 1:
+    publisher = stats_backend.SnapshotPublisher(sys.argv[1])
+else:
+    publisher = stats_publisher.Publisher(create_client)
+#for kind in ['ConditionSymptom', 'ConditionCondition', 'ConditionTreatment', 'ConditionTag', 'ConditionList', 'SymptomCount', 'ConditionCount', 'TreatmentCount', 'TagCount']:
+#    print kind + ' ' + str(stats_publisher.delete_unnamed(create_client(), kind))
+
+#writeConditionCounts(publisher, 'Symptom')
+#writeConditionCounts(publisher,'Condition')
+#writeConditionCounts(publisher,'Treatment')
+writeConditionCounts(publisher,'Tag')
+
+#add_condition_list(publisher,conditions_index)
+
+#writeCounts(publisher,'Symptom')
+#writeCounts(publisher,'Condition')
+#writeCounts(publisher,'Treatment')
+#writeCounts(publisher,'Tag')
+
+print publisher.publish()
+print publisher.delete_stale(CONDITION_KINDS)
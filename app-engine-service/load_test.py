@@ -0,0 +1,136 @@
+# Load test for the stats API, comparing the backends it can serve from
+# Usage: python load_test.py snapshot [--backends snapshot datastore fake] [--requests 2000] [--threads 8] [--batch 20]
+#                                     [--types Tag Symptom] [--cache] [--url http://localhost:5000]
+# Example: python load_test.py stats.db --backends snapshot fake --requests 5000
+
+# Requests are a mix of every endpoint for conditions and trackables taken from the snapshot, sent from several
+# threads.  Each backend runs the same requests in process through Flask's test client, with the TTL cache off unless
+# --cache is given so the backend is what gets measured.  The backends are:
+#   snapshot  - the SQLite snapshot find_stats.py wrote
+#   datastore - the live Datastore project (needs GOOGLE_APPLICATION_CREDENTIALS)
+#   fake      - fake_datastore.Client filled from the snapshot, the Datastore code path without the network
+# With --url the requests go over HTTP to a running server instead, whatever it serves from.
+
+import argparse
+import json
+import random
+import sqlite3
+import threading
+import time
+import urllib
+import urllib2
+from multiprocessing.pool import ThreadPool
+import app
+import fake_datastore
+import stats_backend
+import stats_cache
+
+#a shuffled mix of requests, a quarter for each endpoint
+def request_mix(snapshot, types, count, batch):
+    conditions = [entity['name'] for entity in snapshot.all('ConditionList')]
+    urls = []
+    for trackable_type in types:
+        names = [entity['name'] for entity in snapshot.all(trackable_type + 'Count')]
+        found = [condition for condition in conditions if snapshot.get('Condition' + trackable_type, condition)]
+        if not found or not names:
+            continue
+        #the path endpoints can't be given a name with a slash, the batch ones can
+        path_conditions = [condition for condition in found if '/' not in condition]
+        names = [name for name in names if '/' not in name]
+        for i in range(count // len(types)):
+            condition, name = random.choice(path_conditions), random.choice(names)
+            batch_conditions = random.sample(found, min(batch, len(found)))
+            urls.append([
+                '/condition_counts/%s/%s' % (trackable_type, urllib.quote(condition.encode('utf-8'), safe='')),
+                '/condition_counts_norm/%s/%s' % (trackable_type, urllib.quote(condition.encode('utf-8'), safe='')),
+                '/counts/%s/%s' % (trackable_type, urllib.quote(name.encode('utf-8'), safe='')),
+                '/batch/condition_counts/%s?%s' % (trackable_type, urllib.urlencode(
+                    [('condition', c.encode('utf-8')) for c in batch_conditions])),
+            ][i % 4])
+    random.shuffle(urls)
+    return urls
+
+#a fake Datastore holding the snapshot's entities
+def fake_backend(snapshot_path):
+    client = fake_datastore.Client()
+    connection = sqlite3.connect(snapshot_path)
+    entities = []
+    for kind, name, properties in connection.execute("SELECT kind, name, properties FROM entities"):
+        entity = fake_datastore.Entity(client.key(kind, name))
+        entity.update(json.loads(properties))
+        entities.append(entity)
+    version = fake_datastore.Entity(client.key(stats_backend.DATASET_VERSION_KIND, stats_backend.DATASET_VERSION_NAME))
+    version['version'] = stats_backend.SnapshotBackend(snapshot_path).version()
+    client.put_multi(entities + [version])
+    return stats_backend.DatastoreBackend(lambda: client)
+
+def make_backend(name, snapshot_path):
+    if name == 'snapshot':
+        return stats_backend.SnapshotBackend(snapshot_path)
+    if name == 'datastore':
+        return stats_backend.DatastoreBackend(app.create_client)
+    return fake_backend(snapshot_path)
+
+#sends urls from threads, get(url) returns the status, returns the latency of every request and how many failed
+def run(urls, threads, get):
+    def send(url):
+        started = time.time()
+        status = get(url)
+        return time.time() - started, status
+    pool = ThreadPool(threads)
+    try:
+        results = pool.map(send, urls, chunksize=16)
+    finally:
+        pool.close()
+        pool.join()
+    return [seconds for seconds, status in results], sum(1 for seconds, status in results if status != 200)
+
+def in_process(backend, use_cache):
+    app.backend = backend
+    app.cache = stats_cache.TTLCache(app.CACHE_SECONDS if use_cache else 0, app.CACHE_ENTRIES)
+    app.version['checked'] = 0
+    local = threading.local()
+    def get(url):
+        if not hasattr(local, 'client'):
+            local.client = app.app.test_client()
+        return local.client.get(url).status_code
+    return get
+
+def over_http(base_url):
+    def get(url):
+        try:
+            return urllib2.urlopen(base_url + url).getcode()
+        except urllib2.HTTPError as error:
+            return error.code
+    return get
+
+def report(label, latencies, errors, seconds):
+    latencies = sorted(latencies)
+    percentile = lambda p: latencies[min(len(latencies) - 1, int(len(latencies) * p / 100.0))] * 1000
+    print "%-10s %8d %7d %10.0f %9.2f %9.2f %9.2f" % (label, len(latencies), errors, len(latencies) / seconds,
+                                                   percentile(50), percentile(90), percentile(99))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test the stats API against each backend')
+    parser.add_argument('snapshot', help='snapshot written by find_stats.py, the requests are made from its contents')
+    parser.add_argument('--backends', nargs='+', default=['snapshot', 'fake'], choices=['snapshot', 'datastore', 'fake'])
+    parser.add_argument('--requests', default=2000, type=int)
+    parser.add_argument('--threads', default=8, type=int)
+    parser.add_argument('--batch', default=20, type=int, help='conditions per batch request')
+    parser.add_argument('--types', nargs='+', default=['Tag'])
+    parser.add_argument('--cache', action='store_true', help='keep the TTL cache on')
+    parser.add_argument('--url', help='load test a running server instead')
+    args = parser.parse_args()
+
+    urls = request_mix(stats_backend.SnapshotBackend(args.snapshot), args.types, args.requests, args.batch)
+    print "%-10s %8s %7s %10s %9s %9s %9s" % ('backend', 'requests', 'errors', 'req/s', 'p50 ms', 'p90 ms', 'p99 ms')
+    if args.url:
+        started = time.time()
+        latencies, errors = run(urls, args.threads, over_http(args.url))
+        report('http', latencies, errors, time.time() - started)
+    else:
+        for name in args.backends:
+            get = in_process(make_backend(name, args.snapshot), args.cache)
+            started = time.time()
+            latencies, errors = run(urls, args.threads, get)
+            report(name, latencies, errors, time.time() - started)
@@ -0,0 +1,176 @@
+# Where app.py reads the stats from
+
+# DatastoreBackend reads the live Datastore project, one client per thread.  SnapshotBackend reads a single SQLite file
+# that find_stats.py writes through SnapshotPublisher instead of (or as well as) publishing to Datastore, so the API
+# can run locally, or be load tested, without a network hop per lookup.  app.py serves from the snapshot named by
+# STATS_SNAPSHOT when it is set.  sqlite3 isn't available on App Engine's python27 runtime, so the snapshot is for
+# running the service elsewhere.
+
+# Both backends return entities as plain dicts of their properties:
+#   get(kind, name)              - the entity named name, or None
+#   get_many(kind, names)        - a dict of name: entity for the names that exist, keyed by the names as they were given
+#                                  (both stores hand names back as unicode, callers may ask with utf-8 strs)
+#   find(kind, property, value)  - the first entity whose property equals value, for entities from before keys were named
+#   all(kind)                    - every entity of kind
+#   version()                    - the DatasetVersion, which changes whenever different stats are published
+
+# The snapshot is one table of (kind, name, properties as JSON, content_hash) keyed by kind and name, plus a meta
+# table holding the version.  SnapshotPublisher has the same add(), publish() and delete_stale() as
+# stats_publisher.Publisher and each updates the file in one transaction, so running find_stats.py for one trackable type at a time adds to it and readers
+# never see a half written snapshot.
+
+import json
+import threading
+from stats_publisher import DATASET_VERSION_KIND, DATASET_VERSION_NAME, GET_BATCH, batches, check_name, content_hash, \
+    text, version_string
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS entities (kind TEXT NOT NULL, name TEXT NOT NULL, properties TEXT NOT NULL, "
+    "content_hash TEXT NOT NULL, PRIMARY KEY (kind, name))",
+    "CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)",
+]
+
+class DatastoreBackend(object):
+    name = 'datastore'
+
+    def __init__(self, client_factory):
+        self.client_factory = client_factory
+        self.local = threading.local()
+
+    #this thread's client, the datastore client isn't safe to share between threads
+    def client(self):
+        if not hasattr(self.local, 'client'):
+            self.local.client = self.client_factory()
+        return self.local.client
+
+    def get(self, kind, name):
+        client = self.client()
+        return client.get(client.key(kind, name))
+
+    def get_many(self, kind, names):
+        client = self.client()
+        requested = dict((text(name), name) for name in names)
+        results = {}
+        for batch in batches([client.key(kind, name) for name in names], GET_BATCH):
+            for entity in client.get_multi(batch):
+                results[requested[text(entity.key.name)]] = entity
+        return results
+
+    def find(self, kind, property_name, value):
+        query = self.client().query(kind=kind)
+        query.add_filter(property_name, '=', value)
+        for result in query.fetch(limit=1):
+            return result
+
+    def all(self, kind):
+        return list(self.client().query(kind=kind).fetch())
+
+    def version(self):
+        entity = self.get(DATASET_VERSION_KIND, DATASET_VERSION_NAME)
+        return entity['version'] if entity is not None else None
+
+class SnapshotBackend(object):
+    name = 'snapshot'
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    #sqlite connections can't be shared between threads either
+    def connection(self):
+        if not hasattr(self.local, 'connection'):
+            import sqlite3
+            self.local.connection = sqlite3.connect(self.path)
+            self.local.connection.execute("PRAGMA query_only = 1")
+        return self.local.connection
+
+    def get(self, kind, name):
+        row = self.connection().execute("SELECT properties FROM entities WHERE kind = ? AND name = ?",
+                                        (text(kind), text(name))).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def get_many(self, kind, names):
+        requested = dict((text(name), name) for name in names)
+        results = {}
+        #sqlite allows 999 parameters a statement
+        for batch in batches(list(requested), 900):
+            rows = self.connection().execute(
+                "SELECT name, properties FROM entities WHERE kind = ? AND name IN (%s)" % ','.join('?' * len(batch)),
+                [text(kind)] + batch)
+            results.update((requested[name], json.loads(properties)) for name, properties in rows)
+        return results
+
+    #every snapshot entity is named, there are no older ones to find
+    def find(self, kind, property_name, value):
+        return None
+
+    def all(self, kind):
+        rows = self.connection().execute("SELECT properties FROM entities WHERE kind = ? ORDER BY name", (text(kind),))
+        return [json.loads(properties) for properties, in rows]
+
+    def version(self):
+        row = self.connection().execute("SELECT value FROM meta WHERE name = 'version'").fetchone()
+        return row[0] if row is not None else None
+
+class SnapshotPublisher(object):
+    def __init__(self, path):
+        self.path = path
+        self.pending = {}
+        self.added = set()
+        self.stats = {'written': 0, 'unchanged': 0, 'deleted': 0}
+
+    #queue an entity, a later add with the same kind and name replaces it, sqlite doesn't index properties
+    def add(self, kind, name, properties, exclude_from_indexes=()):
+        check_name(kind, name)
+        properties = dict(properties)
+        properties['content_hash'] = content_hash(properties)
+        self.pending[(kind, name)] = properties
+        self.added.add((kind, text(name)))
+        return kind, name
+
+    #writes everything queued that changed, returns counts of what was written and skipped
+    def publish(self):
+        import sqlite3
+        connection = sqlite3.connect(self.path)
+        try:
+            with connection:
+                for statement in SCHEMA:
+                    connection.execute(statement)
+                changed = []
+                for (kind, name), properties in sorted(self.pending.items()):
+                    row = connection.execute("SELECT content_hash FROM entities WHERE kind = ? AND name = ?",
+                                             (text(kind), text(name))).fetchone()
+                    if row is not None and row[0] == properties['content_hash']:
+                        self.stats['unchanged'] += 1
+                        continue
+                    connection.execute("INSERT OR REPLACE INTO entities VALUES (?, ?, ?, ?)",
+                                       (text(kind), text(name), json.dumps(properties), properties['content_hash']))
+                    changed.append(properties['content_hash'])
+                self.stats['written'] += len(changed)
+                if changed:
+                    connection.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (version_string(changed),))
+        finally:
+            connection.close()
+        self.pending = {}
+        return dict(self.stats)
+
+    #deletes the entities of kinds this run didn't add, in the kinds it added any to
+    def delete_stale(self, kinds):
+        import sqlite3
+        connection = sqlite3.connect(self.path)
+        try:
+            with connection:
+                stale = []
+                for kind in sorted(set(kind for kind, name in self.added if kind in kinds)):
+                    rows = connection.execute("SELECT name, content_hash FROM entities WHERE kind = ?", (text(kind),))
+                    stale.extend((kind, name, stored) for name, stored in rows.fetchall()
+                                 if (kind, name) not in self.added)
+                for kind, name, stored in stale:
+                    connection.execute("DELETE FROM entities WHERE kind = ? AND name = ?", (text(kind), name))
+                self.stats['deleted'] += len(stale)
+                if stale:
+                    connection.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)",
+                                       (version_string([stored for kind, name, stored in stale]),))
+        finally:
+            connection.close()
+        return dict(self.stats)
@@ -0,0 +1,121 @@
+# In-process caching and request metrics for app.py
+
+# TTLCache holds results read from Datastore for a fixed number of seconds, up to max_entries of them, dropping the
+# least recently used first.  app.py also clears it whenever the DatasetVersion entity that stats_publisher writes
+# changes, so a new upload is served as soon as the version is next checked.
+
+# Metrics counts cache hits and misses and keeps the recent latencies of each endpoint for /metrics.
+
+import collections
+import threading
+import time
+
+class TTLCache(object):
+    def __init__(self, seconds, max_entries):
+        self.seconds = seconds
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.clears = 0
+
+    #the cached value for key, or what load() returns (cached unless it is None)
+    def get(self, key, load):
+        now = time.time()
+        with self.lock:
+            if key in self.entries:
+                value, expires = self.entries.pop(key)
+                if expires > now:
+                    self.entries[key] = (value, expires)
+                    self.hits += 1
+                    return value
+            self.misses += 1
+        value = load()
+        if value is not None:
+            with self.lock:
+                self.entries[key] = (value, now + self.seconds)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        return value
+
+    #the cached values of keys, loading every one that isn't cached with a single load_many(missing keys) call,
+    #which returns a dict of the keys it found
+    def get_many(self, keys, load_many):
+        now = time.time()
+        found = {}
+        with self.lock:
+            for key in keys:
+                if key in self.entries:
+                    value, expires = self.entries.pop(key)
+                    if expires > now:
+                        self.entries[key] = (value, expires)
+                        found[key] = value
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        missing = [key for key in keys if key not in found]
+        if missing:
+            loaded = load_many(missing)
+            with self.lock:
+                for key, value in loaded.items():
+                    if value is not None:
+                        self.entries[key] = (value, now + self.seconds)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+            found.update(loaded)
+        return found
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.clears += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else None,
+                'entries': len(self.entries),
+                'clears': self.clears,
+            }
+
+class Metrics(object):
+    def __init__(self, samples=1000):
+        self.lock = threading.Lock()
+        self.samples = samples
+        self.latencies = collections.defaultdict(lambda: collections.deque(maxlen=self.samples))
+        self.requests = collections.Counter()
+
+    def record(self, endpoint, seconds):
+        with self.lock:
+            self.latencies[endpoint].append(seconds)
+            self.requests[endpoint] += 1
+
+    #decorates a Resource method so each call's latency is recorded under endpoint
+    def timed(self, endpoint):
+        def decorator(function):
+            def timed_function(*args, **kwargs):
+                started = time.time()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.record(endpoint, time.time() - started)
+            timed_function.__name__ = function.__name__
+            timed_function.__doc__ = function.__doc__
+            return timed_function
+        return decorator
+
+    #request counts and latency percentiles in milliseconds over the recent samples of each endpoint
+    def stats(self):
+        with self.lock:
+            latencies = dict((endpoint, sorted(values)) for endpoint, values in self.latencies.items())
+            requests = dict(self.requests)
+        stats = {}
+        for endpoint, values in latencies.items():
+            stats[endpoint] = {'requests': requests[endpoint]}
+            for percentile in [50, 90, 99]:
+                index = min(len(values) - 1, int(len(values) * percentile / 100.0))
+                stats[endpoint]['p%d_ms' % percentile] = values[index] * 1000 if values else None
+        return stats
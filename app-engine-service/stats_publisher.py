@@ -0,0 +1,195 @@
+# Writes the precomputed stats to Datastore in bulk, used by find_stats.py
+
+# Entities are collected with add() and written by publish() in put_multi batches of up to 500 entities (Datastore's
+# limit for one commit), several batches at a time, each retried with backoff when a call fails.  Keys are named after
+# what the entity describes (the condition, or the cleaned trackable name) instead of being random ids, so running
+# find_stats.py again overwrites the previous entities rather than adding duplicates.  add() refuses an empty name,
+# which Datastore would turn into a new random id on every run.
+
+# Every entity carries a content_hash property, a hash of its other properties.  Before writing, publish() reads the
+# hashes already stored under the same keys and skips entities whose content hasn't changed, so rerunning on the same
+# export only costs the reads.
+
+# When anything was written, publish() finishes by updating a single DatasetVersion entity (named 'current') with a
+# new version string.  The API reads it to know when to drop its cached results.
+
+# delete_stale(kinds) then deletes the named entities of those kinds that this run didn't add, so a name that isn't
+# published any more (a condition merged into another's canonical name) isn't still served with its old counts.  Only
+# the kinds the run added anything to are touched, a run that only writes the Tag counts leaves the Symptom ones alone.
+# Entities with random ids are left to delete_unnamed.
+
+# The client is anything with the google.cloud.datastore Client calls used here, such as fake_datastore.Client for
+# tests.  datastore.Client talks to a local emulator when DATASTORE_EMULATOR_HOST is set (gcloud beta emulators
+# datastore start, then $(gcloud beta emulators datastore env-init)).
+
+import hashlib
+import json
+import random
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+PUT_BATCH = 500 #entities per put_multi, Datastore's limit
+GET_BATCH = 1000 #keys per get_multi, Datastore's limit
+BATCH_BYTES = 8 * 1024 * 1024 #stay under the 10MB request limit, the condition entities can be large
+WORKERS = 4
+RETRIES = 5
+BACKOFF_SECONDS = 0.5
+DATASET_VERSION_KIND = 'DatasetVersion'
+DATASET_VERSION_NAME = 'current'
+
+def content_hash(properties):
+    content = dict((name, value) for name, value in properties.items() if name != 'content_hash')
+    return hashlib.sha1(json.dumps(content, sort_keys=True)).hexdigest()
+
+#Datastore and sqlite hand names back as unicode, find_stats.py's names are utf-8 strs
+def text(value):
+    return value.decode('utf-8') if isinstance(value, str) else value
+
+#entities are found again by their name, an empty one can't be
+def check_name(kind, name):
+    if not name:
+        raise ValueError("a %s entity needs a name" % kind)
+
+#the time of publishing plus a hash of the content hashes that changed, the API only compares versions for equality
+def version_string(hashes):
+    return '%d-%s' % (time.time(), hashlib.sha1(''.join(hashes)).hexdigest()[:12])
+
+#consecutive runs of items, each at most count long and, by the estimate of size, at most max_bytes
+def batches(items, count, max_bytes=None, size=None):
+    batch = []
+    batch_bytes = 0
+    for item in items:
+        item_bytes = size(item) if size else 0
+        if batch and (len(batch) >= count or (max_bytes and batch_bytes + item_bytes > max_bytes)):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(item)
+        batch_bytes += item_bytes
+    if batch:
+        yield batch
+
+class Publisher(object):
+    #client_factory returns a client, each worker thread makes its own since the datastore client isn't thread safe
+    #entity_class is the Entity to create, google.cloud.datastore.Entity unless the client brings its own
+    def __init__(self, client_factory, workers=WORKERS, retries=RETRIES, entity_class=None):
+        self.client_factory = client_factory
+        self.workers = workers
+        self.retries = retries
+        self.entity_class = entity_class
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.unindexed = {}
+        self.added = set()
+        self.stats = {'written': 0, 'unchanged': 0, 'deleted': 0, 'batches': 0, 'retries': 0}
+
+    def client(self):
+        if not hasattr(self.local, 'client'):
+            self.local.client = self.client_factory()
+        return self.local.client
+
+    def new_entity(self, key, exclude_from_indexes=()):
+        if self.entity_class is None:
+            from google.cloud import datastore
+            self.entity_class = datastore.Entity
+        return self.entity_class(key, exclude_from_indexes=exclude_from_indexes)
+
+    #queue an entity, a later add with the same kind and name replaces it
+    #properties in exclude_from_indexes aren't indexed, indexed strings can't be longer than 1500 bytes
+    def add(self, kind, name, properties, exclude_from_indexes=()):
+        check_name(kind, name)
+        properties = dict(properties)
+        properties['content_hash'] = content_hash(properties)
+        self.pending[(kind, name)] = properties
+        self.unindexed[(kind, name)] = tuple(exclude_from_indexes)
+        self.added.add((kind, text(name)))
+        return kind, name
+
+    #calls function, retrying with exponential backoff and jitter until it works or the retries run out
+    def call(self, function, *args):
+        for attempt in range(self.retries + 1):
+            try:
+                return function(*args)
+            except Exception:
+                if attempt == self.retries:
+                    raise
+                with self.lock:
+                    self.stats['retries'] += 1
+                time.sleep(BACKOFF_SECONDS * (2 ** attempt) * (0.5 + random.random()))
+
+    def stored_hashes(self, names):
+        client = self.client()
+        keys = [client.key(kind, name) for kind, name in names]
+        #keyed by the names as they were added, which may be strs where the stored names are unicode
+        requested = dict(((kind, text(name)), (kind, name)) for kind, name in names)
+        return dict((requested[(entity.key.kind, text(entity.key.name))], entity.get('content_hash'))
+                    for entity in self.call(client.get_multi, keys))
+
+    def put_batch(self, names):
+        client = self.client()
+        entities = []
+        for kind, name in names:
+            entity = self.new_entity(client.key(kind, name), self.unindexed[(kind, name)])
+            entity.update(self.pending[(kind, name)])
+            entities.append(entity)
+        self.call(client.put_multi, entities)
+        with self.lock:
+            self.stats['batches'] += 1
+            self.stats['written'] += len(entities)
+
+    #writes everything queued that changed, returns counts of what was written, skipped, and retried
+    def publish(self):
+        names = sorted(self.pending)
+        pool = ThreadPool(self.workers)
+        try:
+            stored = {}
+            for hashes in pool.imap_unordered(self.stored_hashes, list(batches(names, GET_BATCH))):
+                stored.update(hashes)
+            changed = [name for name in names if stored.get(name) != self.pending[name]['content_hash']]
+            self.stats['unchanged'] += len(names) - len(changed)
+
+            def size(name):
+                return len(json.dumps(self.pending[name]))
+            for _ in pool.imap_unordered(self.put_batch, list(batches(changed, PUT_BATCH, BATCH_BYTES, size))):
+                pass
+        finally:
+            pool.close()
+            pool.join()
+        if changed:
+            self.write_version([self.pending[name]['content_hash'] for name in changed])
+        self.pending = {}
+        self.unindexed = {}
+        return dict(self.stats)
+
+    #deletes the named entities of kinds this run didn't add, in the kinds it added any to
+    def delete_stale(self, kinds):
+        client = self.client()
+        stale = []
+        for kind in sorted(set(kind for kind, name in self.added if kind in kinds)):
+            query = client.query(kind=kind)
+            query.keys_only()
+            stale.extend(entity.key for entity in self.call(lambda: list(query.fetch()))
+                         if entity.key.name is not None and (kind, text(entity.key.name)) not in self.added)
+        for batch in batches(stale, PUT_BATCH):
+            self.call(client.delete_multi, batch)
+        self.stats['deleted'] += len(stale)
+        if stale:
+            self.write_version([content_hash({'deleted': [key.kind, key.name]}) for key in stale])
+        return dict(self.stats)
+
+    def write_version(self, hashes):
+        client = self.client()
+        entity = self.new_entity(client.key(DATASET_VERSION_KIND, DATASET_VERSION_NAME))
+        entity.update({'version': version_string(hashes), 'entities': len(hashes)})
+        self.call(client.put_multi, [entity])
+
+#removes the entities of kind that have a random id rather than a name, left over from before keys were named
+def delete_unnamed(client, kind):
+    query = client.query(kind=kind)
+    query.keys_only()
+    keys = [entity.key for entity in query.fetch() if entity.key.name is None]
+    for batch in batches(keys, PUT_BATCH):
+        client.delete_multi(batch)
+    return len(keys)
@@ -0,0 +1,174 @@
+### Usage: python benchmark.py [--rows 10000 100000 1000000] [--steps generate effectiveness train predict batch find_stats]
+###                            [--workdir benchmark_data] [--output benchmark.json] [--baseline previous.json]
+###                            [--tolerance 1.25] [--seed 0]
+### Example: python benchmark.py --rows 100000 1000000 --output after.json --baseline before.json
+
+### Times the pipeline on synthetic_data.py exports of each size given, so changes can be measured without the real
+### export.  Every step runs in its own process, and its wall time, peak RSS (the process's ru_maxrss from wait4) and
+### rows per second are written to --output as JSON along with the commit they were measured at.  The steps are:
+###   generate      - synthetic_data.py writing the export and an effectiveness file for the same users
+###   effectiveness - treatment_effectiveness.py --output, scoring the export
+###   train         - recommender_train.py --format binary on the synthetic effectiveness file
+###   predict       - recommender_predict.py for the user with the most effectiveness rows
+###   batch         - recommender_batch.py scoring every user of the effectiveness file
+###   find_stats    - app-engine-service/find_stats.py aggregating the export into a SQLite snapshot
+### train, predict and batch read the generated effectiveness file rather than the effectiveness step's, so each step
+### can be run on its own once the data is there.  Each size's data and step logs are kept in workdir/<rows>/, and
+### leaving generate out of --steps reuses them.
+
+### --baseline compares with an earlier --output: each step that is more than --tolerance times slower, or uses more
+### than --tolerance times the memory, is printed as a regression and the exit status is 1.
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+SERVICE = os.path.join(ROOT, 'app-engine-service')
+STEPS = ['generate', 'effectiveness', 'train', 'predict', 'batch', 'find_stats']
+#the names find_stats.py reads from its working directory
+EXPORT = 'flaredown_trackable_data_080316.csv'
+CONDITIONS_LIST = 'conditions_list.csv'
+EFFECTIVENESS = 'synthetic_effectiveness.csv'
+TEST_USER = 'test_user.csv'
+METRIC = 'cosine'
+
+def count_rows(path):
+    with open(path) as infile:
+        return max(sum(1 for _ in infile) - 1, 0)
+
+#the effectiveness rows of the user with the most, for recommender_predict.py
+def write_test_user(datadir):
+    user_ids = pd.read_csv(os.path.join(datadir, EFFECTIVENESS), usecols=['user_id'])['user_id']
+    user_id = user_ids.value_counts().index[0]
+    rows = [chunk[chunk['user_id'] == user_id]
+            for chunk in pd.read_csv(os.path.join(datadir, EFFECTIVENESS), chunksize=500000)]
+    pd.concat(rows).to_csv(os.path.join(datadir, TEST_USER), index=False)
+
+#(command, working directory, rows processed) of each step
+def step_command(step, datadir, rows, seed):
+    python = sys.executable
+    if step == 'generate':
+        return ([python, os.path.join(ROOT, 'synthetic_data.py'), EXPORT, '--rows', str(rows), '--seed', str(seed),
+                 '--effectiveness', EFFECTIVENESS, '--conditions-list', os.path.join(SERVICE, CONDITIONS_LIST)],
+                datadir, lambda: count_rows(os.path.join(datadir, EXPORT)))
+    if step == 'effectiveness':
+        return ([python, os.path.join(ROOT, 'treatment_effectiveness.py'), EXPORT, '--output', 'effectiveness.csv'],
+                datadir, lambda: count_rows(os.path.join(datadir, EXPORT)))
+    if step == 'train':
+        return ([python, os.path.join(ROOT, 'recommender_train.py'), EFFECTIVENESS, 'models', METRIC, '--format', 'binary'],
+                datadir, lambda: count_rows(os.path.join(datadir, EFFECTIVENESS)))
+    if step == 'predict':
+        return ([python, os.path.join(ROOT, 'recommender_predict.py'), TEST_USER, 'models', METRIC],
+                datadir, lambda: count_rows(os.path.join(datadir, TEST_USER)))
+    if step == 'batch':
+        return ([python, os.path.join(ROOT, 'recommender_batch.py'), EFFECTIVENESS, 'models', 'recommendations.csv',
+                 METRIC], datadir, lambda: count_rows(os.path.join(datadir, EFFECTIVENESS)))
+    if step == 'find_stats':
+        return ([python, os.path.join(SERVICE, 'find_stats.py'), 'stats.db'],
+                datadir, lambda: count_rows(os.path.join(datadir, EXPORT)))
+
+#runs command and waits for it with wait4, which gives the child's own peak RSS, unlike getrusage(RUSAGE_CHILDREN)
+#which is the largest of every child so far
+def measure(command, cwd, log):
+    with open(log, 'w') as logfile:
+        started = time.time()
+        process = subprocess.Popen(command, cwd=cwd, stdout=logfile, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(process.pid, 0)
+        seconds = time.time() - started
+    returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    #ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak_mb = usage.ru_maxrss / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0)
+    return returncode, seconds, peak_mb
+
+def last_lines(path, count=5):
+    with open(path) as infile:
+        return ''.join(infile.readlines()[-count:]).strip()
+
+def run(sizes, steps, workdir, seed):
+    results = []
+    for size in sizes:
+        datadir = os.path.join(workdir, str(size))
+        if not os.path.exists(os.path.join(datadir, 'models')):
+            os.makedirs(os.path.join(datadir, 'models'))
+        if 'find_stats' in steps:
+            shutil.copy(os.path.join(SERVICE, CONDITIONS_LIST), datadir)
+        for step in steps:
+            if step != 'generate' and not os.path.exists(os.path.join(datadir, EXPORT)):
+                print "no data in %s, run the generate step first" % datadir
+                break
+            if step == 'predict':
+                write_test_user(datadir)
+            command, cwd, rows = step_command(step, datadir, size, seed)
+            log = os.path.join(datadir, step + '.log')
+            returncode, seconds, peak_mb = measure(command, cwd, log)
+            result = {'size': size, 'step': step, 'returncode': returncode, 'seconds': round(seconds, 3),
+                      'peak_rss_mb': round(peak_mb, 1)}
+            if returncode == 0:
+                result['rows'] = rows()
+                result['rows_per_second'] = round(result['rows'] / max(seconds, 1e-9), 1)
+                print "%-9d %-13s %10d rows %9.2fs %9.1f MB %12.0f rows/s" % (
+                    size, step, result['rows'], seconds, peak_mb, result['rows_per_second'])
+            else:
+                result['error'] = last_lines(log)
+                print "%-9d %-13s failed (%d), see %s" % (size, step, returncode, log)
+            results.append(result)
+    return results
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+#the steps of results that are more than tolerance times slower or bigger than in the baseline
+def regressions(results, baseline, tolerance):
+    before = dict(((result['size'], result['step']), result) for result in baseline['results']
+                  if result['returncode'] == 0)
+    found = []
+    for result in results:
+        previous = before.get((result['size'], result['step']))
+        if previous is None or result['returncode'] != 0:
+            continue
+        for measure_name in ['seconds', 'peak_rss_mb']:
+            ratio = result[measure_name] / max(previous[measure_name], 1e-9)
+            print "%-9d %-13s %-12s %10.2f -> %10.2f  %5.2fx" % (result['size'], result['step'], measure_name,
+                                                                previous[measure_name], result[measure_name], ratio)
+            if ratio > tolerance:
+                found.append((result['size'], result['step'], measure_name, ratio))
+    return found
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline on synthetic data')
+    parser.add_argument('--rows', nargs='+', type=int, default=[10000, 100000, 1000000], help='export sizes to run')
+    parser.add_argument('--steps', nargs='+', default=STEPS, choices=STEPS)
+    parser.add_argument('--workdir', default='benchmark_data', help='where the data and step logs are kept')
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--baseline', help='an earlier --output to compare with')
+    parser.add_argument('--tolerance', default=1.25, type=float, help='slowdown or growth counted as a regression')
+    parser.add_argument('--seed', default=0, type=int)
+    args = parser.parse_args()
+
+    steps = [step for step in STEPS if step in args.steps]
+    started = datetime.datetime.utcnow()
+    results = run(args.rows, steps, os.path.abspath(args.workdir), args.seed)
+    with open(args.output, 'w') as outfile:
+        json.dump({'started': started.isoformat() + 'Z', 'commit': git_commit(), 'python': platform.python_version(),
+                   'platform': platform.platform(), 'seed': args.seed, 'results': results},
+                  outfile, indent=1, sort_keys=True)
+    print "wrote %s" % args.output
+
+    if args.baseline:
+        with open(args.baseline) as infile:
+            found = regressions(results, json.load(infile), args.tolerance)
+        for size, step, measure_name, ratio in found:
+            print "regression: %s at %d rows, %s %.2fx" % (step, size, measure_name, ratio)
+        if found:
+            sys.exit(1)
@@ -0,0 +1,295 @@
+### Usage: python cluster_patients.py datafile outdir [--k 6 12 24 30 36 42 48 96 120 150] [--no-refine] [--components 50]
+###                                    [--min-users 50] [--sample 2000] [--processes N] [--seed 0]
+###                                    [--conditions-list conditions_list.csv]
+### Example: python cluster_patients.py effectiveness_083016.csv clusters --processes 8
+
+### Clusters the users of every condition by the effectiveness they reported, the experiment of clustering.ipynb run
+### for all conditions at once.  The notebook filled a dense user x treatment pivot of Depression with zeros, fitted
+### KMeans for each k and scored it with an O(n^2) silhouette, serially and by hand.  Here each condition's pivot stays
+### sparse (user_recommender.condition_ratings, the mean effectiveness per user and treatment, untried treatments are
+### zero) and is reduced once to --components dimensions with a truncated SVD.  Every k of the sweep is then fitted
+### with mini-batch k-means and scored with the silhouette of a --sample of the users, and the (condition, k) fits run
+### in a process pool that inherits the reduced conditions, each task only sends a condition name and k.
+### Conditions with fewer than --min-users users aren't clustered, and when none are left nothing is written.  Unless
+### --no-refine is given, a second sweep tries the k between the best k and its neighbours in --k, like the notebook's
+### second look at 114 to 130.
+
+### The best k of each condition is kept in outdir/clusters.model (model_store.py's container): every user's cluster,
+### the centroids and the SVD projection that puts a new user in the same space.  outdir/clusters.json has the
+### silhouette of every k tried.  user_recommender.py predict --clusters uses the file to look for similar users only
+### in the NEAREST clusters to the user, see ConditionClusters.nearest.
+
+### Condition names are replaced by their canonical names from --conditions-list (see condition_names.py) as the data
+### is read, so the clusters are kept under the names user_recommender.py's index uses, and the list is kept in
+### outdir with them.
+
+import argparse
+import json
+import os
+import time
+from multiprocessing import Pool
+import numpy as np
+import pandas as pd
+from scipy.sparse.linalg import svds
+import condition_names
+import model_store
+import recommender_engine
+import user_recommender
+
+SWEEP = [6, 12, 24, 30, 36, 42, 48, 96, 120, 150]
+COMPONENTS = 50
+MIN_USERS = 50
+SAMPLE = 2000
+BATCH_SIZE = 1024
+BATCHES = 100
+NEAREST = 2 #clusters ConditionClusters.nearest returns by default
+MODEL = 'clusters.model'
+SCORES = 'clusters.json'
+
+#coordinates of each row in the first components singular directions, and the projection that gives them
+def truncated_svd(ratings, components):
+    components = min(components, min(ratings.shape) - 1)
+    if components < 1:
+        return ratings.toarray(), np.eye(ratings.shape[1])
+    _, singular_values, projection = svds(ratings.astype(float), k=components)
+    order = np.argsort(-singular_values)
+    projection = projection[order]
+    return ratings.dot(projection.T), projection
+
+#squared euclidean distance of every point to every center
+def squared_distances(points, centers):
+    distances = (points * points).sum(axis=1)[:, None] - 2 * points.dot(centers.T) + (centers * centers).sum(axis=1)
+    return np.maximum(distances, 0)
+
+#k-means++ seeding
+def initial_centers(points, k, rng):
+    centers = [points[rng.randint(len(points))]]
+    closest = squared_distances(points, np.array(centers)).ravel()
+    for _ in range(1, k):
+        total = closest.sum()
+        chosen = rng.choice(len(points), p=closest / total) if total > 0 else rng.randint(len(points))
+        centers.append(points[chosen])
+        closest = np.minimum(closest, squared_distances(points, points[chosen][None, :]).ravel())
+    return np.array(centers)
+
+#the cluster of every point and its squared distance to the center, a chunk at a time
+def assign(points, centers, chunksize=65536):
+    labels = np.empty(len(points), dtype=np.int32)
+    distances = np.empty(len(points))
+    for start in range(0, len(points), chunksize):
+        chunk = squared_distances(points[start:start + chunksize], centers)
+        labels[start:start + chunksize] = chunk.argmin(axis=1)
+        distances[start:start + chunksize] = chunk[np.arange(len(chunk)), labels[start:start + chunksize]]
+    return labels, distances
+
+#mini-batch k-means (Sculley 2010): each batch moves its points' centers towards them by 1 / how many points each
+#center has taken so far.  Returns the centers, each point's cluster and the inertia
+def mini_batch_kmeans(points, k, rng, batch_size=BATCH_SIZE, batches=BATCHES):
+    seeding = points[rng.choice(len(points), min(len(points), max(3 * k, batch_size)), replace=False)]
+    centers = initial_centers(seeding, k, rng)
+    counts = np.zeros(k)
+    for _ in range(batches):
+        batch = points[rng.randint(0, len(points), min(batch_size, len(points)))]
+        labels, _ = assign(batch, centers)
+        taken = np.bincount(labels, minlength=k)
+        members = np.zeros((len(batch), k))
+        members[np.arange(len(batch)), labels] = 1
+        sums = members.T.dot(batch)
+        moved = taken > 0
+        counts[moved] += taken[moved]
+        #the per point updates of a batch, in closed form: center += (sum - taken * center) / counts
+        centers[moved] += (sums[moved] - taken[moved, None] * centers[moved]) / counts[moved, None]
+    labels, distances = assign(points, centers)
+    return centers, labels, distances.sum()
+
+#the mean silhouette of a sample of the points, sklearn's definition (0 for points alone in their cluster)
+def sampled_silhouette(points, labels, sample, rng):
+    if len(points) > sample:
+        chosen = rng.choice(len(points), sample, replace=False)
+        points, labels = points[chosen], labels[chosen]
+    clusters, labels = np.unique(labels, return_inverse=True)
+    if len(clusters) < 2:
+        return np.nan
+    distances = np.sqrt(squared_distances(points, points))
+    members = np.zeros((len(points), len(clusters)))
+    members[np.arange(len(points)), labels] = 1
+    sizes = members.sum(axis=0)
+    totals = distances.dot(members)
+    own = sizes[labels] - 1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        a = totals[np.arange(len(points)), labels] / own
+        others = totals / sizes
+    others[np.arange(len(points)), labels] = np.inf
+    b = others.min(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = np.where(own > 0, (b - a) / np.maximum(a, b), 0.0)
+    return float(np.nan_to_num(scores).mean())
+
+#the k between the best and its neighbours in the sweep, as the notebook's second sweep did
+def refined(sweep, best, steps=8):
+    sweep = sorted(sweep)
+    i = sweep.index(best)
+    low = sweep[i - 1] if i > 0 else best
+    high = sweep[i + 1] if i + 1 < len(sweep) else best
+    step = max(1, (high - low) // (2 * steps))
+    return sorted(set(range(low + step, high, step)) - set(sweep))
+
+#the reduced conditions the sweep workers inherit, filled in before the sweep pool is started
+reduced = {}
+
+def reduce_condition(job):
+    condition, rows, components = job
+    users, treatments, ratings = user_recommender.condition_ratings(rows)
+    coordinates, projection = truncated_svd(ratings, components)
+    return condition, users, treatments, coordinates, projection
+
+def fit(job):
+    condition, k, sample, seed = job
+    users, treatments, coordinates, projection = reduced[condition]
+    started = time.time()
+    rng = np.random.RandomState(seed)
+    centers, labels, inertia = mini_batch_kmeans(coordinates, k, rng)
+    score = sampled_silhouette(coordinates, labels, sample, rng)
+    return condition, k, score, inertia, centers, labels, time.time() - started
+
+def sweep(jobs, processes):
+    pool = Pool(processes)
+    try:
+        for result in pool.imap_unordered(fit, jobs):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+def cluster(df, outdir, ks=SWEEP, refine=True, components=COMPONENTS, min_users=MIN_USERS, sample=SAMPLE,
+            processes=None, seed=0):
+    started = time.time()
+    df = df[pd.notnull(df['effectiveness'])]
+    means = df.groupby(['condition', 'user_id', 'treatment'])['effectiveness'].mean().reset_index()
+    condition_users = means.groupby('condition')['user_id'].nunique()
+    conditions = sorted(condition_users[condition_users >= min_users].index,
+                        key=lambda condition: -condition_users[condition])
+    indices = means.groupby('condition').indices
+    jobs = [(condition, means.take(indices[condition]), components) for condition in conditions]
+    pool = Pool(processes)
+    try:
+        for condition, users, treatments, coordinates, projection in pool.imap_unordered(reduce_condition, jobs):
+            reduced[condition] = (users, treatments, coordinates, projection)
+    finally:
+        pool.close()
+        pool.join()
+    print "reduced %d conditions in %.1fs" % (len(reduced), time.time() - started)
+
+    #the sweep only tries k the condition has enough users for
+    def sweep_jobs(condition_ks):
+        return [(condition, k, sample, seed) for condition in conditions for k in condition_ks.get(condition, [])
+                if k < condition_users[condition]]
+
+    scores = dict((condition, {}) for condition in conditions)
+    best = {}
+    passes = [dict((condition, ks) for condition in conditions)]
+    while passes:
+        condition_ks = passes.pop()
+        for condition, k, score, inertia, centers, labels, seconds in sweep(sweep_jobs(condition_ks), processes):
+            scores[condition][k] = {'silhouette': score, 'inertia': inertia, 'seconds': round(seconds, 3)}
+            if condition not in best or (score > best[condition][1] or np.isnan(best[condition][1])):
+                best[condition] = (k, score, centers, labels)
+        if refine:
+            refine = False
+            passes.append(dict((condition, refined(ks, best[condition][0]) if best[condition][0] in ks else [])
+                               for condition in best))
+    print "swept %d conditions in %.1fs" % (len(best), time.time() - started)
+    if not best:
+        print "no condition with at least %d users could be clustered, nothing written" % min_users
+        return best, scores
+
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    write_clusters(os.path.join(outdir, MODEL), [(condition,) + reduced[condition] + best[condition][2:] + (best[condition][0],)
+                                                 for condition in sorted(best)])
+    with open(os.path.join(outdir, SCORES), 'w') as outfile:
+        json.dump(dict((condition, {
+            'users': int(condition_users[condition]),
+            'best_k': best[condition][0],
+            'silhouette': dict((str(k), result['silhouette']) for k, result in sorted(scores[condition].items())),
+            'inertia': dict((str(k), result['inertia']) for k, result in sorted(scores[condition].items())),
+        }) for condition in best), outfile, indent=1, sort_keys=True)
+    return best, scores
+
+#conditions is a list of (condition, users, treatments, coordinates, projection, centers, labels, k)
+def write_clusters(path, conditions):
+    arrays = model_store.condition_arrays([recommender_engine.model_name(condition[0]) for condition in conditions],
+                                          [condition[2] for condition in conditions])
+    arrays['user_offsets'] = np.concatenate([[0], np.cumsum([len(condition[1]) for condition in conditions])])
+    arrays['user_ids'] = np.concatenate([condition[1] for condition in conditions]).astype(np.int64)
+    arrays['labels'] = np.concatenate([condition[6] for condition in conditions]).astype(np.int32)
+    arrays['center_offsets'] = np.concatenate([[0], np.cumsum([condition[7] for condition in conditions])])
+    arrays['components'] = np.array([len(condition[4]) for condition in conditions], dtype=np.int32)
+    #centers are padded to the widest condition's components, projections are flattened
+    width = max(arrays['components'])
+    arrays['centers'] = np.concatenate([np.pad(condition[5], ((0, 0), (0, width - condition[5].shape[1])), 'constant')
+                                        for condition in conditions]).astype(np.float32)
+    arrays['projection_offsets'] = np.concatenate([[0], np.cumsum([condition[4].size for condition in conditions])])
+    arrays['projections'] = np.concatenate([condition[4].ravel() for condition in conditions]).astype(np.float32)
+    model_store.write_arrays(path, {'kind': 'clusters'}, arrays)
+
+class Clusters(model_store.ModelStore):
+    def __init__(self, path):
+        header, self.arrays = model_store.read_arrays(path)
+        self.path = path
+        self.header = header
+        self.treatment_names = model_store.unpack_names(self.arrays['treatment_names_blob'],
+                                                        self.arrays['treatment_names_offsets'])
+        self.condition_index = dict((name, i) for i, name in enumerate(
+            model_store.unpack_names(self.arrays['condition_names_blob'], self.arrays['condition_names_offsets'])))
+        self.models = {}
+
+    def condition_model(self, i):
+        return ConditionClusters(self, i)
+
+class ConditionClusters(object):
+    def __init__(self, clusters, i):
+        arrays = clusters.arrays
+        self.treatments, _ = clusters.condition_treatments(i)
+        self.treatment_index = dict((treatment, t) for t, treatment in enumerate(self.treatments))
+        start, end = arrays['user_offsets'][i], arrays['user_offsets'][i + 1]
+        self.user_ids = arrays['user_ids'][start:end]
+        self.labels = arrays['labels'][start:end]
+        components = arrays['components'][i]
+        start, end = arrays['center_offsets'][i], arrays['center_offsets'][i + 1]
+        self.centers = arrays['centers'][start:end, :components]
+        start, end = arrays['projection_offsets'][i], arrays['projection_offsets'][i + 1]
+        self.projection = arrays['projections'][start:end].reshape(components, len(self.treatments))
+
+    #the count clusters closest to a user with these treatment: effectiveness scores, closest first
+    def nearest(self, scores, count=NEAREST):
+        vector = np.zeros(len(self.treatments))
+        for treatment, score in scores.items():
+            if treatment in self.treatment_index:
+                vector[self.treatment_index[treatment]] = score
+        distances = squared_distances(self.projection.dot(vector)[None, :], self.centers).ravel()
+        return np.argsort(distances, kind='mergesort')[:count]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cluster the users of every condition by the effectiveness they reported')
+    parser.add_argument('datafile')
+    parser.add_argument('outdir')
+    parser.add_argument('--k', nargs='+', type=int, default=SWEEP, help='numbers of clusters to try')
+    parser.add_argument('--no-refine', action='store_true', help='don\'t sweep again around the best k')
+    parser.add_argument('--components', default=COMPONENTS, type=int, help='dimensions of the truncated SVD')
+    parser.add_argument('--min-users', default=MIN_USERS, type=int, help='conditions with fewer users are left out')
+    parser.add_argument('--sample', default=SAMPLE, type=int, help='users the silhouette is computed over')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes, one per cpu by default')
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--conditions-list', default=condition_names.CONDITIONS_LIST,
+                        help='conditions list to canonicalize condition names with')
+    args = parser.parse_args()
+
+    df = condition_names.canonicalized(pd.read_csv(args.datafile), condition_names.index(args.conditions_list))
+    best, scores = cluster(df, args.outdir, sorted(args.k), not args.no_refine, args.components,
+                           args.min_users, args.sample, args.processes, args.seed)
+    if best:
+        condition_names.record_list(args.outdir, args.conditions_list)
+    for condition in sorted(best):
+        k, score = best[condition][:2]
+        print "%s: %d clusters, silhouette %.3f (%d k tried)" % (condition, k, score, len(scores[condition]))
@@ -0,0 +1,238 @@
+### Usage: python condition_names.py lookup name [name ...] [--conditions-list conditions_list.csv]
+###        python condition_names.py compare datafile [--conditions-list conditions_list.csv]
+### Example: python condition_names.py lookup GERD "adult  adhd" Fibromyalgia
+### Example: python condition_names.py compare flaredown_trackable_data_080316.csv
+
+### The canonical conditions of app-engine-service/conditions_list.csv, compiled once into a dict so a name is matched
+### with a single lookup instead of filtering the list.  The list gives each raw name users logged (Condition) the
+### canonical name it is counted under (New Name), with its Family and Group.  Names are matched on a normalized key:
+### lower case, with runs of whitespace and newlines collapsed to one space and the ends stripped, so "GERD",
+### "gerd " and "Gerd\n" are the same condition.  The New Names are matched the same way, the list has "Acid reflux"
+### and "Acid Reflux", "Fibromyalgia" and "Fibromyalgia ", so those are one condition too, named by the spelling with
+### the most logged rows (Count) with its spacing tidied.  Where two rows of the list give the same key different
+### canonical names, the one logged most wins.  Rows without a New Name aren't canonicalized.
+
+### A few canonical names are also listed as synonyms of another condition: GERD is the New Name of Barrett's
+### esophagus but is itself a synonym of Acid reflux, and Spasms (Muscle spasms) is a synonym of Spasm.  Those are
+### followed to the condition they end up at, so Barrett's esophagus is Acid reflux too, and every canonical name
+### matches itself.  canonical_name is then idempotent, canonicalizing a column twice (as recommender_train.py --delta
+### --write-merged and a later full run do) gives the same names as doing it once.
+
+### Each canonical condition has a position, 0 to len(index) - 1 in order of its id, which is what the compact integer
+### codes are, and an id that stays the same when the list is edited: the smallest trackable_id of its synonyms.
+
+### codes() and canonical() map a whole column at once: the distinct values (a categorical's categories) are looked up
+### once each and the result is taken by the column's codes.  trackable_loader.py adds the codes of every row's
+### trackable_name as condition_code when it loads the export, and find_stats.py counts the users of each condition
+### from them.  recommender_train.py, recommender_predict.py, recommender_batch.py and recommender_service.py replace
+### condition names by their canonical names as they read them, so synonyms share one model, found by model_name.
+### They group their rows by condition with rows(), on the codes canonical() already has.  The models themselves are
+### files and entries named by condition, so they are still looked up by name.
+
+### user_recommender.py, cluster_patients.py and diagnosis.py canonicalize the conditions they group users and labels
+### by the same way, so the user index, the clusters and the diagnosis model use the names the item models do.
+
+### recommender_train.py --conditions-list copies the list it canonicalized with into the model directory as
+### conditions_list.csv (record_list), and so do user_recommender.py build, cluster_patients.py and diagnosis.py
+### train.  models_index() is what the readers canonicalize with, so a model trained with another list is found
+### under the names it was trained with.  A model directory without the copy was trained on the names
+### as they were logged (the repository's models/ is), so its readers get an index without any conditions, which
+### keeps every name as it is.
+
+### compare times canonicalizing the export's names with the list filtered per condition, as find_stats.py used to,
+### against codes().
+
+import argparse
+import os
+import re
+import shutil
+import time
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_categorical_dtype
+
+CONDITIONS_LIST = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app-engine-service', 'conditions_list.csv')
+MODELS_LIST = 'conditions_list.csv'
+LIST_COLUMNS = ['trackable_id', 'Count', 'Condition', 'New Name', 'Family', 'Group']
+
+#condition names are used as file names, so strip anything that can't be in one
+def model_name(condition):
+    return condition.replace('/', '').replace("\n","").replace("\r","")
+
+def tidy(name):
+    return re.sub(r'\s+', ' ', name).strip()
+
+def normalize(name):
+    return tidy(name).lower()
+
+def optional(value):
+    return value if value == value else None
+
+#path None gives an index without any conditions
+class ConditionIndex(object):
+    def __init__(self, path=CONDITIONS_LIST):
+        self.path = path
+        annotated = pd.read_csv(path) if path is not None else pd.DataFrame(columns=LIST_COLUMNS)
+        annotated = annotated[pd.notnull(annotated['New Name'])].copy()
+        annotated['key'] = annotated['New Name'].map(normalize)
+        #a list without any New Names gives an index without any conditions, where no name is listed
+        annotated['canonical'] = annotated['key']
+        if len(annotated) > 0:
+            spellings = annotated.groupby(['key', 'New Name'])['Count'].sum().reset_index().sort_values(
+                'Count', ascending=False, kind='mergesort').drop_duplicates('key')
+            annotated['canonical'] = annotated['key'].map(spellings.set_index('key')['New Name'].map(tidy))
+            annotated['canonical'] = annotated['canonical'].map(resolved(annotated))
+        ids = annotated.groupby('canonical')['trackable_id'].min().sort_values(kind='mergesort')
+        self.names = list(ids.index)
+        self.ids = ids.values.astype(np.int64)
+        self.positions = dict((name, i) for i, name in enumerate(self.names))
+        #the first family and group any of a condition's rows gives
+        first = annotated.groupby('canonical')[['Family', 'Group']].first()
+        self.families = [optional(first.loc[name, 'Family']) for name in self.names]
+        self.groups = [optional(first.loc[name, 'Group']) for name in self.names]
+
+        #a canonical name matches itself before anything else, so canonicalizing a canonical name keeps it
+        self.keys = dict((normalize(name), i) for name, i in self.positions.items())
+        for condition, canonical in by_count(annotated)[['Condition', 'canonical']].values:
+            self.keys.setdefault(normalize(condition), self.positions[canonical])
+        assert all(self.position(name) == i for i, name in enumerate(self.names))
+
+    def __len__(self):
+        return len(self.names)
+
+    #position of a name's canonical condition, -1 if it isn't one
+    def position(self, name):
+        if not isinstance(name, basestring):
+            return -1
+        return self.keys.get(normalize(name), -1)
+
+    #the canonical name of a name, or the name itself if it isn't a listed condition
+    def canonical_name(self, name):
+        i = self.position(name)
+        return self.names[i] if i >= 0 else name
+
+    #id, family and group of a canonical condition
+    def describe(self, name):
+        i = self.positions[name]
+        return {'id': int(self.ids[i]), 'family': self.families[i], 'group': self.groups[i]}
+
+    #positions of every value of a column, -1 where it isn't a listed condition
+    def codes(self, values):
+        codes, uniques = factorized(values)
+        positions = np.array([self.position(name) for name in uniques] + [-1], dtype=np.int32)
+        return positions[codes]
+
+    #a column with each listed condition replaced by its canonical name, as a categorical
+    def canonical(self, values):
+        codes, uniques = factorized(values)
+        names, inverse = np.unique(np.array([self.canonical_name(name) for name in uniques], dtype=object),
+                                   return_inverse=True)
+        return pd.Categorical.from_codes(np.append(inverse, -1)[codes], list(names))
+
+    #row positions of each canonical name of a column, grouped on the integer codes of canonical() so the names are
+    #only hashed once, by the factorizing.  Missing values aren't in any group, like a groupby
+    def rows(self, values):
+        conditions = self.canonical(values)
+        groups = pd.Series(np.arange(len(conditions))).groupby(conditions.codes).indices
+        return dict((conditions.categories[code], positions) for code, positions in groups.items() if code >= 0)
+
+#df with the names in column replaced by their canonical names, as plain strings
+def canonicalized(df, conditions, column='condition'):
+    df[column] = np.asarray(conditions.canonical(df[column]), dtype=object)
+    return df
+
+def by_count(annotated):
+    return annotated.sort_values('Count', ascending=False, kind='mergesort')
+
+#each canonical name followed through the rows that list it as a synonym of another condition, to the name it ends up
+#at; names in a cycle all end up at the alphabetically first of the cycle
+def resolved(annotated):
+    targets = {}
+    for condition, canonical in by_count(annotated)[['Condition', 'canonical']].values:
+        targets.setdefault(normalize(condition), canonical)
+    names = {}
+    for name in set(annotated['canonical']):
+        followed = [name]
+        while targets.get(normalize(followed[-1]), followed[-1]) not in followed:
+            followed.append(targets[normalize(followed[-1])])
+        following = targets.get(normalize(followed[-1]), followed[-1])
+        names[name] = min(followed[followed.index(following):])
+    return names
+
+#codes of a column and its distinct values, -1 for missing values so they index the end of a lookup
+def factorized(values):
+    if is_categorical_dtype(values):
+        values = pd.Categorical(values)
+        return values.codes, list(values.categories)
+    codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+    return codes, list(uniques)
+
+indexes = {}
+
+#the index of a conditions list, compiled the first time it is asked for
+def index(path=CONDITIONS_LIST):
+    if path not in indexes:
+        indexes[path] = ConditionIndex(path)
+    return indexes[path]
+
+#where recommender_train.py keeps a copy of the conditions list a model directory was trained with
+def models_list(modeldir):
+    return os.path.join(modeldir, MODELS_LIST)
+
+def same_list(path, other):
+    if not os.path.exists(path):
+        return False
+    with open(path, 'rb') as first, open(other, 'rb') as second:
+        return first.read() == second.read()
+
+#keeps a copy of the conditions list at path in modeldir, only rewriting it when it differs so the directory's
+#readers don't see a change that isn't one
+def record_list(modeldir, path):
+    if not same_list(models_list(modeldir), path):
+        shutil.copyfile(path, models_list(modeldir))
+
+#the index of the conditions list a model directory was trained with, one without any conditions for models trained
+#on the names as they were logged, before the list was kept with them
+def models_index(modeldir):
+    path = models_list(modeldir)
+    return ConditionIndex(path if os.path.exists(path) else None)
+
+#the users of each canonical condition found by filtering the list per condition, the way find_stats.py did
+def filtered_conditions(names, annotated):
+    found = {}
+    for condition in set(annotated['New Name'].dropna()):
+        synonyms = set(annotated[annotated['New Name'] == condition]['Condition'])
+        found[condition] = np.nonzero(names.isin(synonyms).values)[0]
+    return found
+
+def compare(datafile, path):
+    import trackable_loader
+    names = trackable_loader.load(datafile, columns=['trackable_name'])['trackable_name']
+    started = time.time()
+    found = filtered_conditions(names, pd.read_csv(path))
+    print "filtering the list per condition: %.3fs, %d rows matched" % (
+        time.time() - started, sum(len(rows) for rows in found.values()))
+    started = time.time()
+    codes = ConditionIndex(path).codes(names)
+    print "compiled index: %.3fs, %d rows matched (more where only case or spacing differs)" % (
+        time.time() - started, (codes >= 0).sum())
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Canonical condition names of the conditions list')
+    parser.add_argument('command', choices=['lookup', 'compare'])
+    parser.add_argument('names', nargs='+', help='condition names for lookup, the export for compare')
+    parser.add_argument('--conditions-list', default=CONDITIONS_LIST)
+    args = parser.parse_args()
+
+    if args.command == 'lookup':
+        conditions = index(args.conditions_list)
+        for name in args.names:
+            canonical = conditions.canonical_name(name)
+            if conditions.position(name) < 0:
+                print "%s: not a listed condition" % name
+            else:
+                details = conditions.describe(canonical)
+                print "%s: %s (id %d, family %s, group %s)" % (name, canonical, details['id'], details['family'],
+                                                               details['group'])
+    else:
+        compare(args.names[0], args.conditions_list)
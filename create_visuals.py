@@ -6,13 +6,12 @@ import matplotlib.pyplot as plt
 from datetime import datetime
 from matplotlib.patches import Rectangle
 import matplotlib.patches as mpatches
+import trackable_loader
 
-orig_df = pd.read_csv("flaredown_trackable_data_083016.csv")
-orig_df = orig_df[orig_df['user_id'] == 52]
-orig_df['checkin_date'] = pd.to_datetime(orig_df['checkin_date'])
-#orig_df['trackable_value'] = pd.to_numeric(orig_df['trackable_value'])
+orig_df = trackable_loader.select("flaredown_trackable_data_083016.csv", lambda chunk: chunk['user_id'] == 52)
+#orig_df['trackable_value'] = orig_df['value']
 
-test_df = pd.read_csv("effectiveness_test.csv")
+test_df = trackable_loader.load_effectiveness("effectiveness_test.csv")
 
 treatments = orig_df[orig_df['trackable_type'] == "Treatment"]
 
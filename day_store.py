@@ -0,0 +1,244 @@
+### Usage: python day_store.py build datafile storefile
+###        python day_store.py benchmark datafile [storefile] [--combinations N]
+### Example: python day_store.py build flaredown_trackable_data_083016.csv trackables.days
+### Example: python day_store.py benchmark flaredown_trackable_data_083016.csv trackables.days --combinations 500
+
+### The trackable export laid out as one dense array per user, indexed by day, so the treatment_effectiveness
+### functions can slice a user's days instead of filtering their rows on every call.  A user's days run from their
+### first check-in to their last, one column per calendar day, and every trackable they logged is a row:
+###   counts  - how many numeric values of the trackable were logged that day
+###   sums    - float32 sum of those values, and squares the sum of their squares
+###   present - whether the trackable was logged that day at all (treatments are usually logged without a value)
+### A check-in day is any day with a trackable present.  Lagged windows (a treatment's days shifted by a timeframe) and
+### in-window/out-of-window means are then array slices.  A trackable logged more than once on a day counts every value,
+### the same as the rows of the export do in treatment_effectiveness.py's bulk mode, so the means and t-tests are
+### worked out from the counts and sums rather than from a single value per day.
+
+### The store is a single file in the same container as model_store.py, memory mapped, with every user's arrays
+### concatenated:
+###   user_names_*        - user ids, as strings
+###   first_day           - int32 day number (days since 1970-01-01) of each user's first check-in
+###   day_offsets         - user i has day_offsets[i + 1] - day_offsets[i] days
+###   trackable_offsets   - user i's rows are trackables[trackable_offsets[i]:trackable_offsets[i + 1]]
+###   trackables          - ids into the trackable_names_* vocabulary
+###   cell_offsets        - user i's matrices are counts[cell_offsets[i]:cell_offsets[i + 1]] and so on
+###   counts, sums,       - flattened rows x days matrices
+###   squares, present
+
+### benchmark times getEffectiveness from the store against filtering the user's DataFrame on every call, the way the
+### functions worked before the store, over a sample of (user, treatment, symptom) combinations.
+
+import argparse
+import datetime
+import math
+import os
+import sys
+import time
+import warnings
+import numpy as np
+import pandas as pd
+from scipy.stats import ttest_ind
+import model_store
+import trackable_loader
+
+TREATMENT_TYPES = ['Treatment', 'Tag']
+SYMPTOM_TYPES = ['Condition', 'Symptom']
+
+#the store's arrays for an export already read into df (checkin_date parsed)
+def build_arrays(df):
+    users, user_index = np.unique(df['user_id'].astype(str).values, return_inverse=True)
+    names, name_index = np.unique(df['trackable_name'].astype(str).values, return_inverse=True)
+    day = df['checkin_date'].values.astype('datetime64[D]').astype(np.int64)
+    first_day = np.full(len(users), np.iinfo(np.int64).max)
+    last_day = np.full(len(users), np.iinfo(np.int64).min)
+    np.minimum.at(first_day, user_index, day)
+    np.maximum.at(last_day, user_index, day)
+    days = last_day - first_day + 1
+
+    #each user's rows are the trackables they logged, in vocabulary order
+    pairs, pair_index = np.unique(user_index * len(names) + name_index, return_inverse=True)
+    pair_users = pairs // len(names)
+    trackable_offsets = np.searchsorted(pair_users, np.arange(len(users) + 1))
+    rows = np.bincount(pair_users, minlength=len(users))
+    cell_offsets = np.concatenate([[0], np.cumsum(rows * days)])
+
+    #the cell of every row of the export, and the count, sum and sum of squares of the numeric values logged in it
+    pair_row = np.arange(len(pairs)) - trackable_offsets[pair_users]
+    cells = cell_offsets[user_index] + pair_row[pair_index] * days[user_index] + (day - first_day[user_index])
+    values = trackable_loader.numeric_values(df).astype(float)
+    logged = ~np.isnan(values)
+    counts = np.bincount(cells[logged], minlength=cell_offsets[-1])
+    sums = np.bincount(cells[logged], weights=values[logged], minlength=cell_offsets[-1])
+    squares = np.bincount(cells[logged], weights=values[logged] ** 2, minlength=cell_offsets[-1])
+    count_dtype = np.uint16 if counts.max() <= np.iinfo(np.uint16).max else np.int32
+    present = np.zeros(cell_offsets[-1], dtype=bool)
+    present[cells] = True
+
+    arrays = {}
+    arrays['user_names_blob'], arrays['user_names_offsets'] = model_store.pack_names(list(users))
+    arrays['trackable_names_blob'], arrays['trackable_names_offsets'] = model_store.pack_names(list(names))
+    arrays['first_day'] = first_day.astype(np.int32)
+    arrays['day_offsets'] = np.concatenate([[0], np.cumsum(days)]).astype(np.int64)
+    arrays['trackable_offsets'] = trackable_offsets.astype(np.int64)
+    arrays['trackables'] = (pairs % len(names)).astype(np.int32)
+    arrays['cell_offsets'] = cell_offsets.astype(np.int64)
+    arrays['counts'] = counts.astype(count_dtype)
+    arrays['sums'] = sums.astype(np.float32)
+    arrays['squares'] = squares.astype(np.float32)
+    arrays['present'] = present
+    return arrays
+
+def write_store(path, df):
+    model_store.write_arrays(path, {'kind': 'days'}, build_arrays(df))
+
+def open_store(path):
+    arrays = model_store.read_arrays(path)[1]
+    if 'counts' not in arrays:
+        raise ValueError(path + " holds one value per day, build it again")
+    return DayStore(arrays)
+
+def from_frame(df):
+    return DayStore(build_arrays(df))
+
+class DayStore(object):
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self.trackable_names = model_store.unpack_names(arrays['trackable_names_blob'], arrays['trackable_names_offsets'])
+        self.user_index = dict((name, i) for i, name in enumerate(
+            model_store.unpack_names(arrays['user_names_blob'], arrays['user_names_offsets'])))
+
+    def users(self):
+        return sorted(self.user_index, key=self.user_index.get)
+
+    #the days of a single user, or None if they aren't in the store
+    def user(self, user_id):
+        i = self.user_index.get(str(user_id))
+        if i is None:
+            return None
+        arrays = self.arrays
+        days = arrays['day_offsets'][i + 1] - arrays['day_offsets'][i]
+        start, end = arrays['trackable_offsets'][i], arrays['trackable_offsets'][i + 1]
+        trackables = [self.trackable_names[t] for t in arrays['trackables'][start:end]]
+        cells = slice(arrays['cell_offsets'][i], arrays['cell_offsets'][i + 1])
+        matrices = [arrays[name][cells].reshape(len(trackables), days) for name in ['counts', 'sums', 'squares']]
+        return UserDays(int(arrays['first_day'][i]), trackables, matrices,
+                        arrays['present'][cells].reshape(len(trackables), days))
+
+class UserDays(object):
+    #sums is the counts, sums and squares matrices
+    def __init__(self, first_day, trackables, sums, present):
+        self.first_day = first_day
+        self.trackables = trackables
+        self.trackable_index = dict((name, t) for t, name in enumerate(trackables))
+        self.sums = sums
+        self.present = present
+        self.checked_in = present.any(axis=0)
+
+    def days(self):
+        return self.present.shape[1]
+
+    def date(self, day):
+        return datetime.date(1970, 1, 1) + datetime.timedelta(days=self.first_day + int(day))
+
+    #which days a trackable was logged on, all False for one the user never logged
+    def logged(self, name):
+        t = self.trackable_index.get(name)
+        if t is None:
+            return np.zeros(self.days(), dtype=bool)
+        return self.present[t]
+
+    #the count, sum and sum of squares of the trackable's values on every day, zeros for one the user never logged
+    def trackable_sums(self, name):
+        t = self.trackable_index.get(name)
+        if t is None:
+            return [np.zeros(self.days()) for matrix in self.sums]
+        return [matrix[t].astype(float) for matrix in self.sums]
+
+#getEffectiveness as it was before the store, filtering the user's rows on every call
+def frame_effectiveness(user_df, treatment_name, symptom_name, periodicity_threshold, timeframe):
+    def numbers(rows):
+        values = trackable_loader.numeric(rows['trackable_value']).astype(float)
+        return [x for x in values if (math.isnan(x) == False)]
+    treatment_df = user_df[(user_df['trackable_name'] == treatment_name)]
+    start, end = treatment_df['checkin_date'].min(), treatment_df['checkin_date'].max()
+    symptom_df = user_df[user_df['trackable_name'] == symptom_name]
+    population_values = numbers(symptom_df)
+
+    treatment_range = user_df[(user_df['checkin_date'] > start) & (user_df['checkin_date'] < end)]
+    if float(len(set(treatment_range['checkin_date']))) / float(len(set(user_df['checkin_date']))) > periodicity_threshold:
+        treatment_values = numbers(symptom_df[(symptom_df['checkin_date'] >= start) & (symptom_df['checkin_date'] <= end)])
+        no_treatment_values = numbers(symptom_df[(symptom_df['checkin_date'] < start) | (symptom_df['checkin_date'] > end)])
+        return np.mean(no_treatment_values) - np.mean(treatment_values), ttest_ind(treatment_values, population_values)[1]
+
+    treatment_dates = treatment_df['checkin_date'].apply(lambda x: x + datetime.timedelta(days=timeframe))
+    treatment_range = symptom_df[symptom_df['checkin_date'].isin(treatment_dates)]
+    if len(treatment_range) == 0:
+        return 0, 0
+    treatment_values = numbers(treatment_range)
+    return np.mean(population_values) - np.mean(treatment_values), ttest_ind(treatment_values, population_values)[1]
+
+#up to count (user_id, treatment, symptom) combinations, sampled evenly from every user's treatments and symptoms
+def sample_combinations(df, count):
+    treatments = df[df['trackable_type'].isin(TREATMENT_TYPES)][['user_id', 'trackable_name']].drop_duplicates()
+    symptoms = df[df['trackable_type'].isin(SYMPTOM_TYPES)][['user_id', 'trackable_name']].drop_duplicates()
+    combinations = treatments.merge(symptoms, on='user_id', suffixes=('_treatment', '_symptom'))
+    combinations = combinations[combinations['trackable_name_treatment'] != combinations['trackable_name_symptom']]
+    step = max(len(combinations) // count, 1)
+    return list(combinations.iloc[::step][:count].itertuples(index=False))
+
+def benchmark(datafile, storefile, count):
+    import treatment_effectiveness
+    df = trackable_loader.load(datafile)
+
+    started = time.time()
+    if storefile:
+        write_store(storefile, df)
+        store = open_store(storefile)
+        print "built %s (%.1f MB) in %.2fs" % (storefile, os.path.getsize(storefile) / 1e6, time.time() - started)
+    else:
+        store = from_frame(df)
+        print "built the store in memory in %.2fs" % (time.time() - started)
+
+    combinations = sample_combinations(df, count)
+    threshold, timeframe = treatment_effectiveness.PERIODICITY_THRESHOLD, treatment_effectiveness.TIMEFRAMES[-1]
+    user_frames = dict((user_id, user_df) for user_id, user_df in df.groupby('user_id'))
+    #getEffectiveness prints as it goes, keep that out of both timings
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        warnings.simplefilter('ignore', RuntimeWarning)
+        started = time.time()
+        expected = [frame_effectiveness(user_frames[user_id], treatment, symptom, threshold, timeframe)
+                    for user_id, treatment, symptom in combinations]
+        frame_seconds = time.time() - started
+
+        started = time.time()
+        results = [treatment_effectiveness.getEffectiveness(store.user(user_id), treatment, symptom)
+                   for user_id, treatment, symptom in combinations]
+        store_seconds = time.time() - started
+    finally:
+        sys.stdout = stdout
+
+    expected, results = np.array(expected, dtype=float).reshape(-1, 2), np.array(results, dtype=float).reshape(-1, 2)
+    different = ~np.isclose(expected, results, rtol=1e-6, atol=1e-9, equal_nan=True)
+    print "%d combinations: per-call filtering %.2fs (%.2f ms each), day store %.2fs (%.2f ms each), %.0fx faster" % (
+        len(combinations), frame_seconds, frame_seconds / max(len(combinations), 1) * 1000,
+        store_seconds, store_seconds / max(len(combinations), 1) * 1000, frame_seconds / max(store_seconds, 1e-9))
+    print "%d combinations with a different effectiveness or p value" % different.any(axis=1).sum()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build or benchmark the per-user day store of a trackable export')
+    parser.add_argument('command', choices=['build', 'benchmark'])
+    parser.add_argument('datafile')
+    parser.add_argument('storefile', nargs='?')
+    parser.add_argument('--combinations', default=200, type=int, help='how many combinations benchmark scores')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        if not args.storefile:
+            parser.error('build needs a storefile')
+        df = trackable_loader.load(args.datafile)
+        started = time.time()
+        write_store(args.storefile, df)
+        print "wrote %s (%.1f MB) in %.2fs" % (args.storefile, os.path.getsize(args.storefile) / 1e6, time.time() - started)
+    else:
+        benchmark(args.datafile, args.storefile, args.combinations)
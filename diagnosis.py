@@ -0,0 +1,430 @@
+### Usage: python diagnosis.py train datafile [modeldir] [--components 625] [--threshold1 0.5] [--threshold2 0.01]
+###                                              [--alpha 1] [--test-size 0.2] [--min-count 2]
+###                                              [--conditions-list conditions_list.csv]
+###        python diagnosis.py search datafile [--components 100 200 400 625] [--threshold1 0.3 0.5 0.7]
+###                                            [--threshold2 0.001 0.01 0.05] [--alpha 1]
+###                                            [--conditions-list conditions_list.csv]
+###        python diagnosis.py predict testfile [modeldir] [--k 10]
+###        python diagnosis.py batch datafile [modeldir] [outfile] [--k 5]
+###        python diagnosis.py benchmark datafile [modeldir] [--notebook-rows 20000] [--queries 1000]
+### Example: python diagnosis.py train flaredown_trackable_data_080316.csv models
+### Example: python diagnosis.py predict test_user_1.csv models
+
+### The condition diagnosis of diagnosis.ipynb as a model that is trained once and then served: the symptoms a user
+### reported at a check-in are the features and the conditions they reported the labels.  The notebook's best model
+### is kept: the labels are reduced by PCA, a ridge regression predicts the reduced labels from the symptoms, and its
+### output, mapped back to every condition, is the decision of each condition.  A condition is predicted when its
+### decision is over threshold1 or within threshold2 of the check-in's best one.
+
+### Features are built in one pass over the export instead of get_dummies: every check-in (user and date) with at
+### least one symptom and one condition is a row, and the symptoms (logged with a value other than 0) and conditions
+### are columns of two binary CSR matrices.  Users reporting a condition that fewer than --min-count rows of the
+### export report are left out, all of their check-ins, as the notebook meant to.  The rows are split into training
+### and test sets the way the notebook's train_test_split(test_size=0.2, random_state=42) does.
+
+### The fit needs no sklearn.  PCA and ridge are both linear, so the model saved is a single symptoms x conditions
+### matrix, ridge weights times the kept components, and a bias per condition: a check-in's decisions are the bias
+### plus the rows of its symptoms.  train writes it to modeldir/diagnosis.model (model_store.py's memory mapped
+### container) with the thresholds and the mean F1 on the test rows, so predicting for a set of symptoms touches a few
+### rows of the file and takes well under a millisecond.  The ridge system is solved over the symptoms, or over the
+### check-ins when there are fewer of those, the same choice sklearn's Ridge makes.
+
+### search is the notebook's grid search, sped up: the ridge solution for every component count comes from one solve
+### per alpha, and every pair of thresholds is scored on the same decisions, with the vectorized F1 and decision rule.
+### predict ranks the conditions for the symptoms in a single user's rows, leaving out the ones they already report.
+### batch writes the --k best candidates of every check-in with symptoms in an export.  recommender_service.py serves
+### the model at /diagnose.
+
+### benchmark times the notebook's get_dummies features, row by row F1 and per row thresholding against the ones here
+### on the first --notebook-rows rows of the export, the notebook's way doesn't get far past that, then the one pass
+### features on the whole export and the latency of --queries predictions for random check-ins' symptoms.
+
+### The conditions users report are replaced by their canonical names from --conditions-list (see condition_names.py)
+### as the export is read, so "GERD" and "Acid reflux" are one label, named as the recommender models name it.
+### Symptoms are kept as they were logged.  train keeps the list in modeldir, and predict and batch canonicalize with
+### the list the model was trained with.
+
+import argparse
+import time
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_categorical_dtype
+from scipy import linalg
+from scipy import sparse
+import condition_names
+import model_store
+import trackable_loader
+
+COLUMNS = ['user_id', 'checkin_date', 'trackable_type', 'trackable_name', 'value']
+#the notebook's best parameters
+COMPONENTS = 625
+THRESHOLD1 = 0.5
+THRESHOLD2 = 0.01
+ALPHA = 1.0
+TEST_SIZE = 0.2
+SEED = 42
+MIN_COUNT = 2
+K = 10
+CHUNK = 10000 #rows scored at a time, so the dense decisions stay small
+
+def model_path(modeldir):
+    return modeldir + '/diagnosis.model'
+
+def load(datafile, conditions=None):
+    df = trackable_loader.select(datafile, lambda chunk: chunk['trackable_type'].isin(['Condition', 'Symptom']),
+                                 COLUMNS)
+    return canonical_conditions(df, conditions or condition_names.index())
+
+#the export with the names of its condition rows replaced by their canonical names, symptom rows keep theirs
+def canonical_conditions(df, conditions):
+    names = pd.Categorical(df['trackable_name'])
+    logged = list(names.categories)
+    canonical = [conditions.canonical_name(name) for name in logged]
+    merged = sorted(set(logged) | set(canonical))
+    positions = dict((name, i) for i, name in enumerate(merged))
+    own = np.array([positions[name] for name in logged] + [-1])
+    renamed = np.array([positions[name] for name in canonical] + [-1])
+    codes = np.where((df['trackable_type'] == 'Condition').values, renamed[names.codes], own[names.codes])
+    df['trackable_name'] = pd.Categorical.from_codes(codes, merged)
+    return df
+
+#codes and names of a column's values, the loader reads them as categoricals already
+def categories(values):
+    if not is_categorical_dtype(values):
+        values = values.astype('category')
+    return values.cat.codes.values, list(values.cat.categories.astype(str))
+
+#every row's check-in, numbered in user then date order, and the user_id and date of each check-in
+def checkins(df):
+    days = df['checkin_date'].values.astype('datetime64[D]').astype(np.int64)
+    first, span = days.min(), days.max() - days.min() + 1
+    checkin, keys = pd.factorize(df['user_id'].values.astype(np.int64) * span + (days - first), sort=True)
+    return checkin, keys // span, (keys % span + first).astype('datetime64[D]')
+
+#check-ins x names, 1 where the check-in has a row of the name, and the names of the columns in order
+def binary_matrix(checkin, codes, names, rows, count):
+    used, columns = np.unique(codes[rows], return_inverse=True)
+    matrix = sparse.csr_matrix((np.ones(len(columns)), (checkin[rows], columns)), shape=(count, len(used)))
+    matrix.data[:] = 1.0
+    return matrix, [names[code] for code in used]
+
+#the symptoms x and conditions y of every check-in that has both, with names and the user_id and date of each row
+def features(df, min_count=MIN_COUNT):
+    codes, names = categories(df['trackable_name'])
+    known = codes >= 0
+    symptom_rows = known & (df['trackable_type'] == 'Symptom').values & (trackable_loader.numeric_values(df) != 0)
+    condition_rows = known & (df['trackable_type'] == 'Condition').values
+    checkin, user_ids, dates = checkins(df)
+    x, symptoms = binary_matrix(checkin, codes, names, symptom_rows, len(user_ids))
+    y, conditions = binary_matrix(checkin, codes, names, condition_rows, len(user_ids))
+
+    #the users of the conditions too rare to be in both the training and test rows
+    condition_counts = np.asarray(y.sum(axis=0)).ravel()
+    rare_users = np.unique(user_ids[y[:, condition_counts < min_count].nonzero()[0]])
+    keep = (np.diff(x.indptr) > 0) & (np.diff(y.indptr) > 0) & ~np.in1d(user_ids, rare_users)
+    x, y = x[keep], y[keep]
+    symptom_kept = np.asarray(x.sum(axis=0)).ravel() > 0
+    condition_kept = np.asarray(y.sum(axis=0)).ravel() > 0
+    return (x[:, symptom_kept].tocsr(), y[:, condition_kept].tocsr(),
+            [name for name, kept in zip(symptoms, symptom_kept) if kept],
+            [name for name, kept in zip(conditions, condition_kept) if kept], user_ids[keep], dates[keep])
+
+#training and test rows as sklearn's train_test_split shuffles them
+def split(count, test_size=TEST_SIZE, seed=SEED):
+    order = np.random.RandomState(seed).permutation(count)
+    tests = int(np.ceil(test_size * count))
+    return order[tests:], order[:tests]
+
+#each row's F1 of predicted against reported conditions, both boolean rows x conditions
+def row_f1(y, predicted):
+    tp = (predicted & y).sum(axis=1)
+    fp = (predicted & ~y).sum(axis=1)
+    fn = (~predicted & y).sum(axis=1)
+    precision = tp / (tp + fp + 1e-9)
+    recall = tp / (tp + fn + 1e-9)
+    return 2 * precision * recall / (precision + recall + 1e-9)
+
+def mean_f1(y, predicted):
+    return np.mean(row_f1(y, predicted))
+
+#the notebook's two threshold rule: over threshold1, or within threshold2 of the row's best decision
+def decide(decisions, threshold1=THRESHOLD1, threshold2=THRESHOLD2):
+    decisions = np.atleast_2d(decisions)
+    return (decisions > threshold1) | (decisions >= decisions.max(axis=1)[:, None] - threshold2)
+
+#ridge weights from the symptoms to every centered condition column, the means of both, and the principal directions
+#of the conditions, most variance first
+def fit(x, y, alpha=ALPHA):
+    count = x.shape[0]
+    x_mean = np.asarray(x.mean(axis=0)).ravel()
+    y_mean = np.asarray(y.mean(axis=0)).ravel()
+    covariance = y.T.dot(y).toarray() - count * np.outer(y_mean, y_mean)
+    _, directions = linalg.eigh(covariance)
+    directions = directions[:, ::-1]
+
+    if x.shape[1] <= count:
+        gram = x.T.dot(x).toarray() - count * np.outer(x_mean, x_mean)
+        gram[np.diag_indices_from(gram)] += alpha
+        targets = x.T.dot(y).toarray() - count * np.outer(x_mean, y_mean)
+        weights = linalg.solve(gram, targets, assume_a='pos', overwrite_a=True, overwrite_b=True)
+    else:
+        #fewer check-ins than symptoms, solve over the check-ins instead
+        projected = x.dot(x_mean)
+        kernel = (x.dot(x.T).toarray() - projected[:, None] - projected[None, :] + x_mean.dot(x_mean))
+        kernel[np.diag_indices_from(kernel)] += alpha
+        dual = linalg.solve(kernel, y.toarray() - y_mean, assume_a='pos', overwrite_a=True)
+        weights = x.T.dot(dual) - np.outer(x_mean, dual.sum(axis=0))
+    return weights, x_mean, y_mean, directions
+
+#the symptoms x conditions matrix and condition bias of ridge over the first components principal directions
+def combine(weights, x_mean, y_mean, directions, components=COMPONENTS):
+    kept = directions[:, :min(components, directions.shape[1])]
+    matrix = weights.dot(kept).dot(kept.T)
+    return matrix, y_mean - x_mean.dot(matrix)
+
+def decisions(x, matrix, bias):
+    return np.asarray(x.dot(matrix)) + bias
+
+#mean F1 of the rows of x and y, scored CHUNK rows at a time
+def evaluate(x, y, matrix, bias, threshold1=THRESHOLD1, threshold2=THRESHOLD2):
+    scores = [row_f1(y[start:start + CHUNK].toarray() > 0,
+                     decide(decisions(x[start:start + CHUNK], matrix, bias), threshold1, threshold2))
+              for start in range(0, x.shape[0], CHUNK)]
+    return np.mean(np.concatenate(scores)) if scores else np.nan
+
+def write_model(path, symptoms, conditions, matrix, bias, header):
+    arrays = {}
+    arrays['symptom_names_blob'], arrays['symptom_names_offsets'] = model_store.pack_names(symptoms)
+    arrays['condition_names_blob'], arrays['condition_names_offsets'] = model_store.pack_names(conditions)
+    arrays['weights'] = matrix.astype(np.float32)
+    arrays['bias'] = bias.astype(np.float32)
+    model_store.write_arrays(path, dict(header, kind='diagnosis'), arrays)
+
+def train(df, path, components=COMPONENTS, threshold1=THRESHOLD1, threshold2=THRESHOLD2, alpha=ALPHA,
+          test_size=TEST_SIZE, min_count=MIN_COUNT, seed=SEED):
+    x, y, symptoms, conditions, _, _ = features(df, min_count)
+    training, tests = split(x.shape[0], test_size, seed)
+    matrix, bias = combine(*fit(x[training], y[training], alpha), components=components)
+    f1 = evaluate(x[tests], y[tests], matrix, bias, threshold1, threshold2) if len(tests) else None
+    write_model(path, symptoms, conditions, matrix, bias,
+                {'components': min(components, len(conditions)), 'threshold1': threshold1,
+                 'threshold2': threshold2, 'alpha': alpha, 'training_rows': len(training), 'test_rows': len(tests),
+                 'mean_f1': f1})
+    return x.shape[0], len(symptoms), len(conditions), f1
+
+#the notebook's findMaxScore, printing each parameter set that beats the best so far
+def search(df, components, thresholds1, thresholds2, alphas, test_size=TEST_SIZE, min_count=MIN_COUNT, seed=SEED):
+    x, y, symptoms, conditions, _, _ = features(df, min_count)
+    training, tests = split(x.shape[0], test_size, seed)
+    y_test = y[tests].toarray() > 0
+    best = (0, None)
+    for alpha in alphas:
+        fitted = fit(x[training], y[training], alpha)
+        for component_count in components:
+            matrix, bias = combine(*fitted, components=component_count)
+            test_decisions = decisions(x[tests], matrix, bias)
+            for threshold1 in thresholds1:
+                for threshold2 in thresholds2:
+                    score = mean_f1(y_test, decide(test_decisions, threshold1, threshold2))
+                    if score > best[0]:
+                        best = (score, (component_count, threshold1, threshold2, alpha))
+                        print "PCA Comps %d thresh1 %g thresh2 %g ridge_alpha %g score %.6f" % (
+                            component_count, threshold1, threshold2, alpha, score)
+    return best
+
+class Diagnosis(object):
+    def __init__(self, path):
+        self.path = path
+        self.header, self.arrays = model_store.read_arrays(path)
+        self.symptoms = model_store.unpack_names(self.arrays['symptom_names_blob'], self.arrays['symptom_names_offsets'])
+        self.conditions = model_store.unpack_names(self.arrays['condition_names_blob'],
+                                                   self.arrays['condition_names_offsets'])
+        self.symptom_index = dict((name, i) for i, name in enumerate(self.symptoms))
+        self.weights = self.arrays['weights']
+        self.bias = self.arrays['bias'].astype(np.float64)
+
+    #the decision of every condition for a set of symptom names, and the names the model doesn't know
+    def decisions(self, symptoms):
+        positions = sorted(set(self.symptom_index[name] for name in symptoms if name in self.symptom_index))
+        unknown = [name for name in symptoms if name not in self.symptom_index]
+        return self.bias + self.weights[positions].sum(axis=0), unknown
+
+    #up to k (condition, decision, predicted) of the best candidates, best first, leaving out the conditions in exclude
+    def rank(self, symptoms, k=K, exclude=()):
+        scores, unknown = self.decisions(symptoms)
+        predicted = decide(scores, self.header['threshold1'], self.header['threshold2'])[0]
+        exclude = set(exclude)
+        excluded = [i for i, name in enumerate(self.conditions) if name in exclude]
+        scores[excluded] = -np.inf
+        count = min(k, len(scores) - len(excluded))
+        if count <= 0:
+            return [], unknown
+        best = np.argpartition(-scores, count - 1)[:count]
+        best = best[np.argsort(-scores[best], kind='mergesort')]
+        return [(self.conditions[i], float(scores[i]), bool(predicted[i])) for i in best], unknown
+
+#the k best candidates of every check-in of an export that has a symptom the model knows
+def batch(df, diagnosis, k=5):
+    codes, names = categories(df['trackable_name'])
+    positions = np.array([diagnosis.symptom_index.get(name, -1) for name in names] + [-1])
+    columns = positions[codes]
+    rows = (columns >= 0) & (df['trackable_type'] == 'Symptom').values & (trackable_loader.numeric_values(df) != 0)
+    checkin, user_ids, dates = checkins(df)
+    x = sparse.csr_matrix((np.ones(rows.sum()), (checkin[rows], columns[rows])),
+                          shape=(len(user_ids), len(diagnosis.symptoms)))
+    x.data[:] = 1.0
+    present = np.nonzero(np.diff(x.indptr) > 0)[0]
+    count = min(k, len(diagnosis.conditions))
+    results = []
+    for start in range(0, len(present), CHUNK):
+        chunk = present[start:start + CHUNK]
+        scores = np.asarray(x[chunk].dot(diagnosis.weights)) + diagnosis.bias
+        predicted = decide(scores, diagnosis.header['threshold1'], diagnosis.header['threshold2'])
+        best = np.argpartition(-scores, count - 1, axis=1)[:, :count]
+        order = np.argsort(-scores[np.arange(len(chunk))[:, None], best], axis=1, kind='mergesort')
+        best = best[np.arange(len(chunk))[:, None], order]
+        rows_of = np.repeat(np.arange(len(chunk)), count)
+        results.append(pd.DataFrame({
+            'user_id': user_ids[chunk][rows_of],
+            'checkin_date': dates[chunk][rows_of],
+            'rank': np.tile(np.arange(1, count + 1), len(chunk)),
+            'condition': np.asarray(diagnosis.conditions, dtype=object)[best.ravel()],
+            'decision': scores[rows_of, best.ravel()],
+            'predicted': predicted[rows_of, best.ravel()]}))
+    columns = ['user_id', 'checkin_date', 'rank', 'condition', 'decision', 'predicted']
+    return pd.concat(results, ignore_index=True)[columns] if results else pd.DataFrame(columns=columns)
+
+#the notebook's reshapeSymptoms and createXY, without the split, for benchmark
+def notebook_features(df):
+    def numericOr(x):
+        if 1 in x.values:
+            return 1
+        else:
+            return 0
+    df = df.copy()
+    df['trackable_name'] = df['trackable_name'].astype(str)
+    df['trackable_type'] = df['trackable_type'].astype(str)
+    symptoms = pd.get_dummies(df[(df['trackable_type'] == "Symptom") & (df['value'] != 0)], columns=['trackable_name'])
+    symptoms = symptoms.drop(['trackable_type', 'value'], axis=1)
+    symptoms = symptoms.groupby(['user_id', 'checkin_date']).agg(numericOr).reset_index()
+    newdf = df[df['trackable_type'] == 'Condition'].groupby(['user_id', 'checkin_date'])['trackable_name'].agg(
+        lambda x: set(x)).reset_index()
+    return newdf.merge(symptoms, on=['user_id', 'checkin_date'])
+
+def notebook_f1(y, pred):
+    row_f1 = np.zeros((y.shape[0]))
+    for k in range(y.shape[0]):
+        tp = (pred[k] * y[k]).sum()
+        fp = (pred[k] > y[k]).sum()
+        fn = (pred[k] < y[k]).sum()
+        precision = tp / (tp + fp + 1e-9)
+        recall = tp / (tp + fn + 1e-9)
+        row_f1[k] = 2 * precision * recall / (precision + recall + 1e-9)
+    return np.mean(row_f1)
+
+def notebook_predict(decision, threshold1, threshold2):
+    pred = ((decision - threshold1) > 0).astype(float)
+    max_decision = decision.max(1)
+    for k in range(pred.shape[0]):
+        cut = max_decision[k] - threshold2
+        idx = (decision[k, :] >= cut)
+        pred[k, idx] = 1
+    return pred
+
+def timed(function, *args):
+    started = time.time()
+    result = function(*args)
+    return result, time.time() - started
+
+def benchmark(datafile, path, notebook_rows, queries, conditions=None):
+    df, seconds = timed(load, datafile, conditions)
+    print "loaded %d condition and symptom rows in %.2fs" % (len(df), seconds)
+
+    head = df.iloc[:notebook_rows]
+    merged, old_seconds = timed(notebook_features, head)
+    (x, y, _, _, _, _), new_seconds = timed(features, head, 1)
+    print "features of the first %d rows: get_dummies %.2fs (%d check-ins), one pass %.3fs (%d check-ins)" % (
+        len(head), old_seconds, len(merged), new_seconds, x.shape[0])
+
+    (x, y, symptoms, conditions, _, _), seconds = timed(features, df)
+    print "features of every row: %.2fs, %d check-ins, %d symptoms, %d conditions" % (
+        seconds, x.shape[0], len(symptoms), len(conditions))
+    rng = np.random.RandomState(0)
+    sample = rng.choice(x.shape[0], min(x.shape[0], 5000), replace=False)
+    y_sample = y[sample].toarray() > 0
+    scores = y_sample + rng.normal(0, 0.5, y_sample.shape)
+    (old_f1, old_seconds), (new_f1, new_seconds) = [timed(f1, y_sample, decided) for f1, decided in
+                                                     [(notebook_f1, notebook_predict(scores, THRESHOLD1, THRESHOLD2)),
+                                                      (mean_f1, decide(scores, THRESHOLD1, THRESHOLD2))]]
+    print "F1 of %d rows: row by row %.3fs, vectorized %.4fs (%.6f and %.6f)" % (
+        len(sample), old_seconds, new_seconds, old_f1, new_f1)
+    _, old_seconds = timed(notebook_predict, scores, THRESHOLD1, THRESHOLD2)
+    _, new_seconds = timed(decide, scores, THRESHOLD1, THRESHOLD2)
+    print "thresholds of %d rows: per row %.3fs, vectorized %.4fs" % (len(sample), old_seconds, new_seconds)
+
+    (rows, _, _, f1), seconds = timed(train, df, path)
+    print "trained on %d check-ins in %.2fs, mean F1 %s" % (rows, seconds, f1)
+    diagnosis, seconds = timed(Diagnosis, path)
+    print "opened the model in %.4fs" % seconds
+    latencies = []
+    for row in rng.choice(x.shape[0], min(queries, x.shape[0]), replace=False):
+        reported = [symptoms[i] for i in x.indices[x.indptr[row]:x.indptr[row + 1]]]
+        _, seconds = timed(diagnosis.rank, reported)
+        latencies.append(seconds * 1000)
+    print "predictions: p50 %.3fms p90 %.3fms p99 %.3fms" % (
+        np.percentile(latencies, 50), np.percentile(latencies, 90), np.percentile(latencies, 99))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Train and serve a condition diagnosis model from reported symptoms')
+    parser.add_argument('command', choices=['train', 'search', 'predict', 'batch', 'benchmark'])
+    parser.add_argument('datafile', help='trackable export, or a single user\'s rows for predict')
+    parser.add_argument('modeldir', nargs='?', default='models')
+    parser.add_argument('outfile', nargs='?', default='diagnoses.csv', help='where batch writes its candidates')
+    parser.add_argument('--components', nargs='+', default=None, type=int, help='principal components of the conditions kept')
+    parser.add_argument('--threshold1', nargs='+', default=None, type=float, help='decisions over this are predicted')
+    parser.add_argument('--threshold2', nargs='+', default=None, type=float,
+                        help='decisions this close to a check-in\'s best are predicted')
+    parser.add_argument('--alpha', nargs='+', default=None, type=float, help='ridge regularization')
+    parser.add_argument('--test-size', default=TEST_SIZE, type=float, help='share of check-ins held out to score')
+    parser.add_argument('--min-count', default=MIN_COUNT, type=int,
+                        help='users reporting a condition with fewer rows are left out')
+    parser.add_argument('--k', default=None, type=int, help='candidates per user or check-in')
+    parser.add_argument('--notebook-rows', default=20000, type=int, help='rows benchmark runs the notebook\'s way on')
+    parser.add_argument('--queries', default=1000, type=int)
+    parser.add_argument('--conditions-list', default=condition_names.CONDITIONS_LIST,
+                        help='conditions list to canonicalize the reported conditions with')
+    args = parser.parse_args()
+    conditions = condition_names.index(args.conditions_list)
+
+    if args.command == 'train':
+        started = time.time()
+        rows, symptom_count, condition_count, f1 = train(
+            load(args.datafile, conditions), model_path(args.modeldir), (args.components or [COMPONENTS])[0],
+            (args.threshold1 or [THRESHOLD1])[0], (args.threshold2 or [THRESHOLD2])[0], (args.alpha or [ALPHA])[0],
+            args.test_size, args.min_count)
+        condition_names.record_list(args.modeldir, args.conditions_list)
+        print "trained on %d check-ins (%d symptoms, %d conditions) in %.2fs, mean F1 on the test rows %s" % (
+            rows, symptom_count, condition_count, time.time() - started, f1)
+    elif args.command == 'search':
+        score, best = search(load(args.datafile, conditions), args.components or [100, 200, 400, COMPONENTS],
+                             args.threshold1 or [0.3, THRESHOLD1, 0.7], args.threshold2 or [0.001, THRESHOLD2, 0.05],
+                             args.alpha or [ALPHA], args.test_size, args.min_count)
+        print "best: components %d, threshold1 %g, threshold2 %g, alpha %g, mean F1 %.6f" % (best + (score,))
+    elif args.command == 'predict':
+        rows = load(args.datafile, condition_names.models_index(args.modeldir))
+        reported = rows[(rows['trackable_type'] == 'Symptom').values & (rows['value'].values != 0)]
+        existing = rows[(rows['trackable_type'] == 'Condition').values]['trackable_name'].astype(str).unique()
+        candidates, unknown = Diagnosis(model_path(args.modeldir)).rank(
+            reported['trackable_name'].astype(str).unique(), args.k or K, exclude=existing)
+        if unknown:
+            print "symptoms the model doesn't know: %s" % ', '.join(unknown)
+        for condition, decision, predicted in candidates:
+            print "%-40s %8.4f%s" % (condition, decision, ' predicted' if predicted else '')
+    elif args.command == 'batch':
+        started = time.time()
+        candidates = batch(load(args.datafile, condition_names.models_index(args.modeldir)),
+                           Diagnosis(model_path(args.modeldir)), args.k or 5)
+        candidates.to_csv(args.outfile, index=False)
+        print "wrote %d candidates to %s in %.2fs" % (len(candidates), args.outfile, time.time() - started)
+    else:
+        benchmark(args.datafile, model_path(args.modeldir), args.notebook_rows, args.queries, conditions)
@@ -0,0 +1,220 @@
+### Usage: python instrumentation.py summarize tracefile [tracefile ...]
+### Example: python recommender_train.py effectiveness_083016.csv models --trace train.jsonl --profile profiles
+###          python instrumentation.py summarize train.jsonl
+
+### Timing spans and counters for the pipelines, written as JSON lines so runs can be compared and added up.
+### Nothing is recorded until configure() is called, the scripts call it for --trace; until then span() hands back one
+### shared object whose enter and exit do nothing and count() returns straight away, so the calls can stay in the hot
+### paths.
+
+###   with instrumentation.span('pairs', condition=condition):   - times the block, one line when it ends
+###       instrumentation.count('pairs evaluated', n)            - adds n to a counter of the innermost open span
+###   with instrumentation.profile('condition', condition):      - cProfile and memory capture of the block, if asked for
+###   instrumentation.record('train_cosine', seconds)            - a span timed elsewhere, like pipeline.py's stages
+
+### Each span's line holds its name, the names of the spans it's inside (path), its seconds, its fields, the counters
+### added while it was the innermost open span and the run, pid and time it ended.  configure() also writes a 'run'
+### line with the command line, and close() (registered with atexit) an 'end' line with the counters added outside any
+### span, so a run's totals are the sum of both.  Forked workers (recommender_train.py --workers) inherit the
+### configuration and append their own lines to the same file, each line in a single write; they exit without running
+### atexit, which is why the counters are kept on the spans.
+
+### profile() keeps a cProfile .prof file per block in the profile directory, for pstats or snakeviz, and with memory
+### capture on adds the block's peak traced allocation (tracemalloc, python 3) or, where tracemalloc isn't available,
+### how much the process's peak RSS grew while it ran.
+
+### summarize adds up trace files: for each span name, how many there were and their total, mean, 95th percentile and
+### longest seconds, then every counter summed over the spans and end lines.
+
+import atexit
+import cProfile
+import json
+import os
+import re
+import resource
+import sys
+import time
+import uuid
+from contextlib import contextmanager
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+class NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_SPAN = NullSpan()
+
+class Span(object):
+    def __init__(self, recorder, name, fields):
+        self.recorder = recorder
+        self.name = name
+        self.fields = fields
+        self.counters = {}
+
+    def __enter__(self):
+        self.path = [span.name for span in self.recorder.stack]
+        self.recorder.stack.append(self)
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.time() - self.started
+        self.recorder.stack.pop()
+        record = {'event': 'span', 'name': self.name, 'path': self.path, 'seconds': round(seconds, 6)}
+        if self.fields:
+            record['fields'] = self.fields
+        if self.counters:
+            record['counters'] = self.counters
+        if exc_info[0] is not None:
+            record['error'] = exc_info[0].__name__
+        self.recorder.write(record)
+        return False
+
+class Recorder(object):
+    def __init__(self, path, profile_dir=None, memory=False):
+        self.path = path
+        self.profile_dir = profile_dir
+        self.memory = memory
+        self.run = uuid.uuid4().hex[:12]
+        self.stack = []
+        self.outside = {}
+        self.pid = None
+        self.outfile = None
+        if profile_dir and not os.path.isdir(profile_dir):
+            os.makedirs(profile_dir)
+        if memory and tracemalloc is not None:
+            tracemalloc.start()
+
+    #each process appends through its own descriptor, a forked worker mustn't share its parent's
+    def write(self, record):
+        if self.path is None:
+            return
+        if self.pid != os.getpid():
+            self.outfile = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            self.pid = os.getpid()
+        record['run'] = self.run
+        record['pid'] = self.pid
+        record['time'] = round(time.time(), 3)
+        os.write(self.outfile, json.dumps(record, sort_keys=True, default=str) + '\n')
+
+    #adds to the innermost open span, or the run's own counters outside them
+    def count(self, name, n):
+        counters = self.stack[-1].counters if self.stack else self.outside
+        counters[name] = counters.get(name, 0) + n
+
+    def close(self):
+        if self.pid == os.getpid() or self.pid is None:
+            self.write({'event': 'end', 'counters': self.outside})
+            if self.outfile is not None:
+                os.close(self.outfile)
+                self.outfile = None
+
+recorder = None
+
+#turns recording on, spans and counters go to path as JSON lines, profile() writes to profile_dir
+def configure(path=None, profile_dir=None, memory=False):
+    global recorder
+    if recorder is not None:
+        recorder.close()
+    recorder = Recorder(path, profile_dir, memory)
+    recorder.write({'event': 'run', 'argv': sys.argv})
+    atexit.register(recorder.close)
+    return recorder
+
+def enabled():
+    return recorder is not None
+
+def span(name, **fields):
+    if recorder is None:
+        return NULL_SPAN
+    return Span(recorder, name, fields)
+
+#a span that was timed somewhere else, inside the spans open now
+def record(name, seconds, **fields):
+    if recorder is not None:
+        line = {'event': 'span', 'name': name, 'path': [span.name for span in recorder.stack], 'seconds': round(seconds, 6)}
+        if fields:
+            line['fields'] = fields
+        recorder.write(line)
+
+def count(name, n=1):
+    if recorder is not None:
+        recorder.count(name, n)
+
+#slashes and spaces would make odd file names
+def profile_file(name, label):
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', name + ('_' + str(label) if label is not None else '')) + '.prof'
+
+def peak_rss_mb():
+    #ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0)
+
+@contextmanager
+def profile(name, label=None):
+    if recorder is None or not (recorder.profile_dir or recorder.memory):
+        yield
+        return
+    profiler = None
+    if recorder.profile_dir:
+        profiler = cProfile.Profile()
+    if recorder.memory:
+        if tracemalloc is not None and hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        rss_before = peak_rss_mb()
+    try:
+        if profiler is not None:
+            profiler.enable()
+        yield
+    finally:
+        record = {'event': 'profile', 'name': name, 'label': label}
+        if profiler is not None:
+            profiler.disable()
+            record['file'] = os.path.join(recorder.profile_dir, profile_file(name, label))
+            profiler.dump_stats(record['file'])
+        if recorder.memory:
+            if tracemalloc is not None:
+                record['peak_traced_mb'] = round(tracemalloc.get_traced_memory()[1] / (1024.0 * 1024.0), 3)
+            record['peak_rss_growth_mb'] = round(peak_rss_mb() - rss_before, 3)
+        recorder.write(record)
+
+def read_records(paths):
+    for path in paths:
+        with open(path) as infile:
+            for line in infile:
+                if line.strip():
+                    yield json.loads(line)
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def summarize(paths):
+    seconds = {}
+    counters = {}
+    runs = set()
+    for record in read_records(paths):
+        runs.add(record.get('run'))
+        if record['event'] == 'span':
+            seconds.setdefault(record['name'], []).append(record['seconds'])
+        for name, n in record.get('counters', {}).items():
+            counters[name] = counters.get(name, 0) + n
+    print "%d runs" % len(runs)
+    print "%-30s %8s %12s %10s %10s %10s" % ('span', 'count', 'total s', 'mean s', 'p95 s', 'max s')
+    for name, values in sorted(seconds.items(), key=lambda item: -sum(item[1])):
+        print "%-30s %8d %12.3f %10.4f %10.4f %10.4f" % (name, len(values), sum(values), sum(values) / len(values),
+                                                        percentile(values, 95), max(values))
+    for name, n in sorted(counters.items()):
+        print "%-30s %12d" % (name, n)
+    return seconds, counters
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 3 and sys.argv[1] == 'summarize':
+        summarize(sys.argv[2:])
+    else:
+        print "Usage: python instrumentation.py summarize tracefile [tracefile ...]"
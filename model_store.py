@@ -0,0 +1,409 @@
+### Usage: python model_store.py convert modeldir <pearson|cosine>
+###        python model_store.py compare modeldir <pearson|cosine>
+### Example: python model_store.py convert models cosine
+
+### A single file holding every condition's distance table for one distance metric, as an alternative to the
+### <condition>_<metric>.csv files.  The CSVs are mostly NaN and have to be parsed in full for every lookup, this file
+### only stores the values that exist and is memory mapped, so opening it costs almost nothing and a lookup only
+### touches the bytes of the row that is asked for.
+
+### Layout: an 8 byte magic string, the length of a JSON header, the header itself, and then the raw arrays it
+### describes, each aligned to 64 bytes.  Each condition's table is kept in CSR form:
+###   treatment_names_*       - the vocabulary of every treatment name in the file
+###   condition_names_*       - condition names, in the same form as the CSV file names (see recommender_engine)
+###   treatment_offsets       - condition i's treatments are treatments[treatment_offsets[i]:treatment_offsets[i + 1]]
+###   treatments              - vocabulary ids, in the row/column order of the original table
+###   indptr                  - condition i's CSR row pointers start at indptr[treatment_offsets[i] + i]
+###   indices, values         - column (position in the condition's treatments) and value of each non-NaN cell
+
+### Values are stored as float32, seven significant digits is far more than the effectiveness ratings behind them
+### carry, and columns as uint16 unless some condition has more treatments than that can count.  That keeps each
+### stored cell at 6 bytes, against the 4 or more characters per cell (NaN or not) of the CSVs.
+
+### Next to it recommender_train.py also writes <metric>.neighbours, a nearest neighbour index in the same container:
+### for every treatment of every condition the positions and values of its k closest treatments, best first (lowest
+### cosine distance or highest pearson correlation), so finding the closest treatments is an O(k) read.
+
+### convert builds both files from an existing directory of CSV models, and compare prints the size and load time of
+### the formats.  recommender_train.py writes the model directly with --format binary and the index with --top-k.
+### open_models picks the fastest of the three that is present in a model directory.
+
+import json
+import os
+import sys
+import glob
+import time
+import numpy as np
+import pandas as pd
+
+MAGIC = 'FDMODEL1'
+ALIGNMENT = 64
+
+def store_path(modeldir, distance_metric):
+    return modeldir + '/' + distance_metric + '.model'
+
+def neighbours_path(modeldir, distance_metric):
+    return modeldir + '/' + distance_metric + '.neighbours'
+
+#order of a row's values from closest to furthest, ties keep their column order
+def rank(values, distance_metric):
+    return np.argsort(values if distance_metric == 'cosine' else -values, kind='mergesort')
+
+#turn a square distance table into the CSR pieces of a single condition
+#columns are kept in table order so ties resolve the same way idxmin/idxmax do on the CSV
+def table_rows(distances):
+    present = ~np.isnan(distances)
+    indptr = np.concatenate([[0], np.cumsum(present.sum(axis=1))])
+    rows, columns = np.nonzero(present)
+    return indptr, columns.astype(np.int32), distances[rows, columns]
+
+#positions and values of each row's k closest treatments, best first, padded with -1 and nan
+def top_neighbours(distances, distance_metric, k):
+    ranking = np.where(np.isnan(distances), np.inf, distances if distance_metric == 'cosine' else -distances)
+    order = np.argsort(ranking, axis=1, kind='mergesort')[:, :k]
+    values = distances[np.arange(len(distances))[:, None], order]
+    order[np.isnan(values)] = -1
+    padding = k - order.shape[1]
+    order = np.pad(order, ((0, 0), (0, padding)), 'constant', constant_values=-1)
+    values = np.pad(values, ((0, 0), (0, padding)), 'constant', constant_values=np.nan)
+    return order.astype(np.int32), values
+
+def pack_names(names):
+    encoded = [name.encode('utf-8') if isinstance(name, unicode) else name for name in names]
+    offsets = np.concatenate([[0], np.cumsum([len(name) for name in encoded])]).astype(np.int64)
+    return np.frombuffer(''.join(encoded), dtype=np.uint8), offsets
+
+def unpack_names(blob, offsets):
+    data = blob.tostring()
+    return [data[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+
+#the vocabulary and per condition treatment lists shared by both file types
+def condition_arrays(condition_names, condition_treatments):
+    vocabulary = {}
+    treatments = []
+    treatment_offsets = [0]
+    for names in condition_treatments:
+        treatments.extend(vocabulary.setdefault(treatment, len(vocabulary)) for treatment in names)
+        treatment_offsets.append(len(treatments))
+
+    arrays = {}
+    arrays['treatment_names_blob'], arrays['treatment_names_offsets'] = pack_names(sorted(vocabulary, key=vocabulary.get))
+    arrays['condition_names_blob'], arrays['condition_names_offsets'] = pack_names(condition_names)
+    arrays['treatment_offsets'] = np.asarray(treatment_offsets, dtype=np.int64)
+    arrays['treatments'] = np.asarray(treatments, dtype=np.int32)
+    return arrays
+
+#conditions is an iterable of (condition name, treatments, (indptr, indices, values)) as returned by table_rows
+def write_store(path, distance_metric, conditions):
+    condition_names = []
+    condition_treatments = []
+    treatment_offsets = [0]
+    indptr = []
+    indices = []
+    values = []
+    entries = 0
+    for condition, treatments, (condition_indptr, condition_indices, condition_values) in conditions:
+        condition_names.append(condition)
+        condition_treatments.append(treatments)
+        treatment_offsets.append(treatment_offsets[-1] + len(treatments))
+        indptr.append(np.asarray(condition_indptr, dtype=np.int64) + entries)
+        indices.append(condition_indices)
+        values.append(condition_values)
+        entries += len(condition_values)
+
+    arrays = condition_arrays(condition_names, condition_treatments)
+    arrays['indptr'] = np.concatenate(indptr) if indptr else np.zeros(0, dtype=np.int64)
+    widest = max(np.diff(treatment_offsets)) if len(treatment_offsets) > 1 else 0
+    index_dtype = np.uint16 if widest <= np.iinfo(np.uint16).max else np.int32
+    arrays['indices'] = np.concatenate(indices).astype(index_dtype) if indices else np.zeros(0, dtype=index_dtype)
+    arrays['values'] = np.concatenate(values).astype(np.float32) if values else np.zeros(0, dtype=np.float32)
+    write_arrays(path, {'distance_metric': distance_metric}, arrays)
+
+#conditions is an iterable of (condition name, treatments, (neighbours, values)) as returned by top_neighbours
+def write_neighbours(path, distance_metric, k, conditions):
+    conditions = list(conditions)
+    arrays = condition_arrays([condition[0] for condition in conditions], [condition[1] for condition in conditions])
+    neighbours = [condition[2][0] for condition in conditions]
+    values = [condition[2][1] for condition in conditions]
+    arrays['neighbours'] = np.concatenate(neighbours) if neighbours else np.zeros((0, k), dtype=np.int32)
+    arrays['neighbour_values'] = np.concatenate(values) if values else np.zeros((0, k))
+    write_arrays(path, {'distance_metric': distance_metric, 'k': k}, arrays)
+
+#the entries of every condition in an open file, in the form write_store/write_neighbours take
+#recommender_train.py --delta uses these to rewrite a file with only some of its conditions replaced
+def store_conditions(store):
+    for condition in store.conditions():
+        model = store.condition(condition)
+        start, end = model.indptr[0], model.indptr[-1]
+        yield condition, model.treatments, (model.indptr - start, model.indices[start:end], model.values[start:end])
+
+def neighbour_conditions(index):
+    for condition in index.conditions():
+        model = index.condition(condition)
+        yield condition, model.treatments, (model.neighbour_rows, model.value_rows)
+
+#existing entries with the ones named in replacements swapped out, plus any new ones, sorted by condition
+def replace_conditions(existing, replacements):
+    entries = dict((entry[0], entry) for entry in existing)
+    entries.update((entry[0], entry) for entry in replacements)
+    return [entries[condition] for condition in sorted(entries)]
+
+def write_arrays(path, header, arrays):
+    layout = {}
+    offset = 0
+    for name in sorted(arrays):
+        array = np.ascontiguousarray(arrays[name])
+        arrays[name] = array
+        layout[name] = {'dtype': array.dtype.str, 'shape': array.shape, 'offset': offset}
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+    header = dict(header, arrays=layout)
+    encoded = json.dumps(header)
+    data_start = -(-(len(MAGIC) + 8 + len(encoded)) // ALIGNMENT) * ALIGNMENT
+
+    #write to a temporary file first so readers never see a half written model
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as outfile:
+        outfile.write(MAGIC)
+        outfile.write(np.array([len(encoded)], dtype='<u8').tostring())
+        outfile.write(encoded)
+        for name in sorted(arrays):
+            outfile.seek(data_start + layout[name]['offset'])
+            outfile.write(arrays[name].tostring())
+        outfile.truncate(data_start + offset)
+    os.rename(temporary, path)
+
+#returns the header and a dict of read only arrays backed by the memory mapped file
+def read_arrays(path):
+    with open(path, 'rb') as infile:
+        if infile.read(len(MAGIC)) != MAGIC:
+            raise ValueError(path + " is not a model file")
+        header_length = int(np.frombuffer(infile.read(8), dtype='<u8')[0])
+        header = json.loads(infile.read(header_length))
+    data_start = -(-(len(MAGIC) + 8 + header_length) // ALIGNMENT) * ALIGNMENT
+    buffer = np.memmap(path, dtype=np.uint8, mode='r')
+    arrays = {}
+    for name, spec in header['arrays'].items():
+        dtype = np.dtype(str(spec['dtype']))
+        count = int(np.prod(spec['shape']))
+        start = data_start + spec['offset']
+        arrays[str(name)] = buffer[start:start + count * dtype.itemsize].view(dtype).reshape(spec['shape'])
+    return header, arrays
+
+class ModelStore(object):
+    def __init__(self, path):
+        self.path = path
+        header, self.arrays = read_arrays(path)
+        self.header = header
+        self.distance_metric = header['distance_metric']
+        self.treatment_names = unpack_names(self.arrays['treatment_names_blob'], self.arrays['treatment_names_offsets'])
+        self.condition_index = dict((name, i) for i, name in enumerate(
+            unpack_names(self.arrays['condition_names_blob'], self.arrays['condition_names_offsets'])))
+        self.models = {}
+
+    def conditions(self):
+        return sorted(self.condition_index, key=self.condition_index.get)
+
+    #condition is the file name form of the condition, recommender_engine.model_name(condition)
+    def condition(self, condition):
+        if condition not in self.models:
+            model = self.load(condition)
+            if model is None:
+                return None
+            self.models[condition] = model
+        return self.models[condition]
+
+    #a new model of the condition that isn't kept, for callers that cache models themselves
+    def load(self, condition):
+        if condition not in self.condition_index:
+            return None
+        return self.condition_model(self.condition_index[condition])
+
+    def condition_model(self, i):
+        return ConditionModel(self, i)
+
+    #the names of condition i's treatments and where its rows start
+    def condition_treatments(self, i):
+        start, end = self.arrays['treatment_offsets'][i], self.arrays['treatment_offsets'][i + 1]
+        return [self.treatment_names[t] for t in self.arrays['treatments'][start:end]], start
+
+class NeighbourIndex(ModelStore):
+    def condition_model(self, i):
+        return ConditionNeighbours(self, i)
+
+#shared by the models that can return every value in a treatment's row
+class RowModel(object):
+    #the closest other treatment and its value, or (nan, nan) if there is none
+    #lowest value for cosine, highest for pearson; ties go to the first column like idxmin/idxmax
+    def closest(self, treatment, distance_metric):
+        indices, values = self.row(treatment)
+        if len(values) == 0:
+            return np.nan, np.nan
+        best = np.argmin(values) if distance_metric == 'cosine' else np.argmax(values)
+        return self.treatments[indices[best]], float(values[best])
+
+    #up to k (name, value) pairs of the closest treatments, best first
+    def neighbours(self, treatment, distance_metric, k):
+        indices, values = self.row(treatment)
+        return [(self.treatments[indices[i]], float(values[i])) for i in rank(values, distance_metric)[:k]]
+
+class ConditionModel(RowModel):
+    def __init__(self, store, i):
+        self.treatments, start = store.condition_treatments(i)
+        self.treatment_index = dict((name, t) for t, name in enumerate(self.treatments))
+        self.indptr = store.arrays['indptr'][start + i:start + i + len(self.treatments) + 1]
+        self.indices = store.arrays['indices']
+        self.values = store.arrays['values']
+
+    #positions and values of the treatments that have a distance to this one, views into the mapped file
+    def row(self, treatment):
+        t = self.treatment_index.get(treatment)
+        if t is None:
+            return self.indices[:0], self.values[:0]
+        start, end = self.indptr[t], self.indptr[t + 1]
+        return self.indices[start:end], self.values[start:end]
+
+    #the same DataFrame the CSV model would load as
+    def to_table(self):
+        distances = np.full((len(self.treatments), len(self.treatments)), np.nan)
+        for t in range(len(self.treatments)):
+            indices, values = self.row(self.treatments[t])
+            distances[t, indices] = values
+        table = pd.DataFrame(distances, columns=self.treatments)
+        table['row'] = self.treatments
+        return table
+
+#a condition's model as read from its CSV
+class TableModel(RowModel):
+    def __init__(self, table):
+        #a few early models were written without the 'row' column, their rows are in column order too
+        self.treatments = [column for column in table.columns if column != 'row']
+        rows = list(table['row']) if 'row' in table.columns else self.treatments
+        self.treatment_index = dict((name, t) for t, name in enumerate(rows))
+        self.distances = table[self.treatments].values.astype(float)
+
+    def row(self, treatment):
+        t = self.treatment_index.get(treatment)
+        if t is None:
+            return np.zeros(0, dtype=int), np.zeros(0)
+        indices = np.flatnonzero(~np.isnan(self.distances[t]))
+        return indices, self.distances[t, indices]
+
+class ConditionNeighbours(object):
+    def __init__(self, index, i):
+        self.treatments, start = index.condition_treatments(i)
+        self.treatment_index = dict((name, t) for t, name in enumerate(self.treatments))
+        self.neighbour_rows = index.arrays['neighbours'][start:start + len(self.treatments)]
+        self.value_rows = index.arrays['neighbour_values'][start:start + len(self.treatments)]
+
+    #the index is already sorted best first for its metric, so this only reads the first k entries
+    def neighbours(self, treatment, distance_metric, k):
+        t = self.treatment_index.get(treatment)
+        if t is None:
+            return []
+        neighbours = []
+        for neighbour, value in zip(self.neighbour_rows[t, :k].tolist(), self.value_rows[t, :k].tolist()):
+            if neighbour < 0:
+                break
+            neighbours.append((self.treatments[neighbour], value))
+        return neighbours
+
+    def closest(self, treatment, distance_metric):
+        t = self.treatment_index.get(treatment)
+        if t is None or self.neighbour_rows[t, 0] < 0:
+            return np.nan, np.nan
+        return self.treatments[self.neighbour_rows[t, 0]], float(self.value_rows[t, 0])
+
+class CsvModels(object):
+    def __init__(self, modeldir, distance_metric):
+        self.modeldir = modeldir
+        self.distance_metric = distance_metric
+
+    def condition(self, condition):
+        path = self.modeldir + '/' + condition + "_" + self.distance_metric + ".csv"
+        if not os.path.exists(path):
+            return None
+        return TableModel(pd.read_csv(path))
+
+    #the CSVs are read on every call already
+    load = condition
+
+def open_store(path):
+    return ModelStore(path)
+
+def open_neighbours(path):
+    return NeighbourIndex(path)
+
+#the fastest model source in modeldir: the neighbour index, then the binary model, then the CSVs
+#all three hand out per condition models with closest() and neighbours(), condition() keeps the models it returns and
+#load() doesn't
+def open_models(modeldir, distance_metric):
+    if os.path.exists(neighbours_path(modeldir, distance_metric)):
+        return open_neighbours(neighbours_path(modeldir, distance_metric))
+    if os.path.exists(store_path(modeldir, distance_metric)):
+        return open_store(store_path(modeldir, distance_metric))
+    return CsvModels(modeldir, distance_metric)
+
+def csv_models(modeldir, distance_metric):
+    suffix = "_" + distance_metric + ".csv"
+    return sorted(glob.glob(modeldir + '/*' + suffix))
+
+def condition_from_csv(path, distance_metric):
+    return os.path.basename(path)[:-len("_" + distance_metric + ".csv")]
+
+def convert(modeldir, distance_metric, k=10):
+    models = []
+    neighbours = []
+    for path in csv_models(modeldir, distance_metric):
+        model = TableModel(pd.read_csv(path))
+        condition = condition_from_csv(path, distance_metric)
+        models.append((condition, model.treatments, table_rows(model.distances)))
+        neighbours.append((condition, model.treatments, top_neighbours(model.distances, distance_metric, k)))
+    write_store(store_path(modeldir, distance_metric), distance_metric, models)
+    write_neighbours(neighbours_path(modeldir, distance_metric), distance_metric, k, neighbours)
+
+def directory_size(paths):
+    return sum(os.path.getsize(path) for path in paths)
+
+def compare(modeldir, distance_metric):
+    paths = csv_models(modeldir, distance_metric)
+    path = store_path(modeldir, distance_metric)
+    print "csv:    %d files, %.1f MB" % (len(paths), directory_size(paths) / 1e6)
+    print "binary: 1 file, %.1f MB" % (os.path.getsize(path) / 1e6)
+
+    started = time.time()
+    for csv_path in paths:
+        pd.read_csv(csv_path)
+    csv_seconds = time.time() - started
+
+    started = time.time()
+    store = open_store(path)
+    open_seconds = time.time() - started
+    for condition in store.conditions():
+        store.condition(condition)
+    binary_seconds = time.time() - started
+    print "loading every condition: csv %.2fs, binary %.3fs (%.3fs to open the file)" % (csv_seconds, binary_seconds, open_seconds)
+
+    #a lookup of the closest treatment to every treatment, the work recommender_predict.py does per user
+    time_lookups('binary', store, distance_metric)
+    if os.path.exists(neighbours_path(modeldir, distance_metric)):
+        time_lookups('neighbours', open_neighbours(neighbours_path(modeldir, distance_metric)), distance_metric)
+
+def time_lookups(name, store, distance_metric):
+    started = time.time()
+    lookups = 0
+    for condition in store.conditions():
+        model = store.condition(condition)
+        for treatment in model.treatments:
+            model.closest(treatment, distance_metric)
+            lookups += 1
+    seconds = time.time() - started
+    print "%s: %d closest treatment lookups in %.2fs (%.1f us each)" % (name, lookups, seconds, seconds / max(lookups, 1) * 1e6)
+
+if __name__ == '__main__':
+    if len(sys.argv) != 4 or sys.argv[1] not in ('convert', 'compare'):
+        print "Usage: python model_store.py <convert|compare> modeldir <pearson|cosine>"
+        quit()
+    if sys.argv[1] == 'convert':
+        convert(sys.argv[2], sys.argv[3])
+    else:
+        compare(sys.argv[2], sys.argv[3])
@@ -0,0 +1,412 @@
+### Usage: python pipeline.py datafile [--workdir pipeline] [--stages effectiveness train find_stats word_clouds]
+###                                    [--distance-metrics cosine pearson] [--threshold 0.05] [--format binary]
+###                                    [--top-k 10] [--welch] [--actionable-tags [tag_relevance.csv]] [--publish]
+###                                    [--conditions-list conditions_list.csv] [--jobs 2] [--force stage ...]
+###                                    [--dry-run] [--trace tracefile] [--trace-stages]
+### Example: python pipeline.py flaredown_trackable_data_080316.csv
+### Example: python pipeline.py flaredown_trackable_data_080316.csv --stages train --distance-metrics pearson --dry-run
+### Example: python pipeline.py flaredown_trackable_data_080316.csv --stages effectiveness train diagnosis users clusters
+
+### Runs the scripts that take the raw export to the published outputs, one stage per script, skipping every stage
+### whose inputs, code and parameters haven't changed since it last ran:
+###   effectiveness  - treatment_effectiveness.py --output, the export scored into effectiveness.csv
+###   train_<metric> - recommender_train.py on effectiveness.csv, one stage per --distance-metrics into models/, with
+###                    condition names canonicalized by --conditions-list
+###   find_stats     - app-engine-service/find_stats.py, the condition and trackable counts as a stats.db snapshot, or
+###                    with --publish sent to Datastore
+###   word_clouds    - word_clouds.py, the word cloud images and text files
+###   diagnosis      - diagnosis.py train, the diagnosis model, into models/
+###   users          - user_recommender.py build, the user based recommender's index, into models/
+###   clusters       - cluster_patients.py on effectiveness.csv, into clusters/
+### diagnosis, users and clusters canonicalize condition names by --conditions-list too.
+### Asking for a stage runs the stages it reads from too.
+
+### Each stage's outputs are kept in workdir/store/<stage>/<key>/, where the key is a sha1 of the stage's parameters
+### (the distance metric, threshold, treatment_effectiveness.py's PERIODICITY_THRESHOLD and TIMEFRAMES...), the source
+### of its script and of the repository modules the script imports, and the hashes of its inputs: the contents of the
+### export and the other input files, and the outputs of the stages it reads from.  A stage whose key already has a
+### directory is skipped.  Since a stage's key depends on what its upstream stages wrote rather than on their keys, a
+### change that reruns effectiveness but doesn't change effectiveness.csv still leaves train skipped.  The export's
+### hash is kept in workdir/hashes.json with its size and mtime, so it is only read again when it changes.
+
+### A stage runs in its own process in a temporary directory that is renamed into place when it succeeds, so a failed
+### or interrupted stage leaves nothing that looks finished, and the stages after it are skipped.  Stages that don't
+### depend on each other run at the same time, up to --jobs at once.  workdir/current/<stage> links to the latest
+### outputs of each stage, which are what gets published; older keys stay in the store, so going back to earlier
+### parameters is free, until they are deleted by hand.  word_clouds starts from a copy of its current outputs so
+### word_clouds.py can skip the images whose words haven't changed.
+
+### Every stage's outcome (ran, cached, failed or skipped), its wall time and peak RSS are appended to --trace
+### (default workdir/timings.jsonl) as instrumentation.py spans, add them up with python instrumentation.py summarize.
+### --trace-stages also passes the file to the stages that take --trace, for their own spans.  Each stage's
+### directory keeps its output as stage.log and what it was run from as stage.json.
+
+import argparse
+import ast
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import time
+import instrumentation
+import trackable_loader
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+SERVICE = os.path.join(ROOT, 'app-engine-service')
+DEFAULT_STAGES = ['effectiveness', 'train', 'find_stats', 'word_clouds']
+OPTIONAL_STAGES = ['diagnosis', 'users', 'clusters']
+DISTANCE_METRICS = ['cosine', 'pearson']
+#find_stats.py reads these names from its working directory
+EXPORT = 'flaredown_trackable_data_080316.csv'
+CONDITIONS_LIST = 'conditions_list.csv'
+LOG = 'stage.log'
+MANIFEST = 'stage.json'
+
+class Stage(object):
+    def __init__(self, name, script, inputs, params, command, links=None, directories=(), seeded=False):
+        self.name = name
+        self.script = script
+        self.inputs = inputs #input files and stages the stage reads
+        self.params = params
+        self.command = command #the command line, given the paths of the inputs
+        self.links = links or {} #names the script expects in its working directory, and the input each is
+        self.directories = directories #output directories the script expects to exist
+        self.seeded = seeded #starts from a copy of its current outputs
+
+#module level constants of a script, read from its source so that scripts which do their work on import can be hashed
+def constants(path, names):
+    with open(path) as infile:
+        tree = ast.parse(infile.read(), path)
+    found = {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign):
+            for target in node.targets:
+                if isinstance(target, ast.Name) and target.id in names:
+                    found[target.id] = ast.literal_eval(node.value)
+    return found
+
+#the repository modules a script imports, and the ones they import, as paths
+def local_modules(path, found=None):
+    found = set([path]) if found is None else found
+    with open(path) as infile:
+        source = infile.read()
+    for module in re.findall(r'^\s*(?:import|from)\s+([A-Za-z_][A-Za-z0-9_]*)', source, re.MULTILINE):
+        for directory in [os.path.dirname(path), ROOT]:
+            candidate = os.path.join(directory, module + '.py')
+            if os.path.exists(candidate) and candidate not in found:
+                found.add(candidate)
+                local_modules(candidate, found)
+                break
+    return found
+
+def code_hash(script):
+    digest = hashlib.sha1()
+    for path in sorted(local_modules(script)):
+        digest.update(os.path.relpath(path, ROOT) + '\0' + trackable_loader.file_hash(path) + '\0')
+    return digest.hexdigest()
+
+#sha1 of an input file, kept in hashes with its size and mtime so an unchanged file isn't read again
+def source_hash(path, hashes):
+    stat = os.stat(path)
+    known = hashes.get(os.path.abspath(path))
+    if known and known['size'] == stat.st_size and known['mtime'] == stat.st_mtime:
+        return known['sha1']
+    sha1 = trackable_loader.file_hash(path)
+    hashes[os.path.abspath(path)] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha1': sha1}
+    return sha1
+
+#sha1 of every file a stage wrote, by relative path, leaving out its own log and manifest
+def output_hash(directory):
+    digest = hashlib.sha1()
+    for parent, directories, files in os.walk(directory):
+        directories.sort()
+        for name in sorted(files):
+            path = os.path.join(parent, name)
+            relative = os.path.relpath(path, directory)
+            if relative in [LOG, MANIFEST]:
+                continue
+            digest.update(relative + '\0' + trackable_loader.file_hash(path) + '\0')
+    return digest.hexdigest()
+
+def stage_key(stage, code, input_hashes):
+    description = {'stage': stage.name, 'code': code, 'params': stage.params,
+                   'inputs': dict((name, input_hashes[name]) for name in stage.inputs)}
+    return hashlib.sha1(json.dumps(description, sort_keys=True)).hexdigest()
+
+def python_script(*path):
+    return [sys.executable, os.path.join(*path)]
+
+def effectiveness_file(inputs):
+    return os.path.join(inputs['effectiveness'], 'effectiveness.csv')
+
+#every stage there is, in an order that runs each after its inputs, for the options given
+def define_stages(args):
+    stages = []
+    script = os.path.join(ROOT, 'treatment_effectiveness.py')
+    params = constants(script, ['PERIODICITY_THRESHOLD', 'TIMEFRAMES', 'TREATMENT_TYPES', 'SYMPTOM_TYPES'])
+    params.update(welch=args.welch, actionable_tags=bool(args.actionable_tags))
+    trace = ['--trace', os.path.abspath(args.trace)] if args.trace_stages else []
+    stages.append(Stage('effectiveness', script, ['export'] + (['relevance'] if args.actionable_tags else []), params,
+                        lambda inputs: python_script(ROOT, 'treatment_effectiveness.py') + [
+                            inputs['export'], '--output', 'effectiveness.csv'] + (['--welch'] if args.welch else []) +
+                        (['--actionable-tags', inputs['relevance']] if args.actionable_tags else []) + trace))
+    for distance_metric in args.distance_metrics:
+        stages.append(Stage('train_' + distance_metric, os.path.join(ROOT, 'recommender_train.py'),
+                            ['effectiveness', 'conditions_list'],
+                            {'distance_metric': distance_metric, 'threshold': args.threshold, 'format': args.format,
+                             'top_k': args.top_k},
+                            lambda inputs, distance_metric=distance_metric: python_script(ROOT, 'recommender_train.py') + [
+                                effectiveness_file(inputs), 'models', distance_metric, str(args.threshold),
+                                '--format', args.format, '--top-k', str(args.top_k),
+                                '--conditions-list', inputs['conditions_list']] + trace,
+                            directories=['models']))
+    script = os.path.join(SERVICE, 'find_stats.py')
+    stages.append(Stage('find_stats', script, ['export', 'conditions_list'],
+                        dict(constants(script, ['Z']), publish=args.publish),
+                        lambda inputs: python_script(SERVICE, 'find_stats.py') + ([] if args.publish else ['stats.db']),
+                        links={EXPORT: 'export', CONDITIONS_LIST: 'conditions_list'}))
+    script = os.path.join(ROOT, 'word_clouds.py')
+    stages.append(Stage('word_clouds', script, ['export'],
+                        constants(script, ['CLOUD_EXCLUDED', 'TEXT_SAMPLED', 'SYMPTOM_CONDITIONS', 'TAG_CONDITIONS',
+                                           'SYMPTOM_WORDS', 'TAG_WORDS']),
+                        lambda inputs: python_script(ROOT, 'word_clouds.py') + [
+                            inputs['export'], '--output', 'word_cloud_images'],
+                        seeded=True))
+    script = os.path.join(ROOT, 'diagnosis.py')
+    stages.append(Stage('diagnosis', script, ['export', 'conditions_list'],
+                        constants(script, ['COMPONENTS', 'THRESHOLD1', 'THRESHOLD2', 'ALPHA', 'TEST_SIZE', 'MIN_COUNT']),
+                        lambda inputs: python_script(ROOT, 'diagnosis.py') + [
+                            'train', inputs['export'], 'models', '--conditions-list', inputs['conditions_list']],
+                        directories=['models']))
+    script = os.path.join(ROOT, 'user_recommender.py')
+    stages.append(Stage('users', script, ['effectiveness', 'conditions_list'],
+                        constants(script, ['COMPONENTS', 'EXACT_LIMIT']),
+                        lambda inputs: python_script(ROOT, 'user_recommender.py') + [
+                            'build', effectiveness_file(inputs), 'models', '--conditions-list', inputs['conditions_list']],
+                        directories=['models']))
+    script = os.path.join(ROOT, 'cluster_patients.py')
+    stages.append(Stage('clusters', script, ['effectiveness', 'conditions_list'],
+                        constants(script, ['SWEEP', 'COMPONENTS', 'MIN_USERS', 'SAMPLE', 'NEAREST']),
+                        lambda inputs: python_script(ROOT, 'cluster_patients.py') + [
+                            effectiveness_file(inputs), 'clusters', '--conditions-list', inputs['conditions_list']]))
+    return stages
+
+#the name a stage is asked for by, train for every train_<metric>
+def group(stage):
+    return 'train' if stage.name.startswith('train_') else stage.name
+
+#the stages asked for and every stage they read from, in run order
+def selected(stages, names):
+    by_name = dict((stage.name, stage) for stage in stages)
+    wanted = set(stage.name for stage in stages if group(stage) in names or stage.name in names)
+    for stage in reversed(stages):
+        if stage.name in wanted:
+            wanted.update(name for name in stage.inputs if name in by_name)
+    return [stage for stage in stages if stage.name in wanted]
+
+def stage_dir(workdir, stage, key):
+    return os.path.join(workdir, 'store', stage.name, key)
+
+def current_link(workdir, stage):
+    return os.path.join(workdir, 'current', stage.name)
+
+#points workdir/current/<stage> at an output directory, replacing the link in one rename
+def publish(workdir, stage, directory):
+    link = current_link(workdir, stage)
+    if not os.path.exists(os.path.dirname(link)):
+        os.makedirs(os.path.dirname(link))
+    temporary = link + '.tmp'
+    if os.path.lexists(temporary):
+        os.remove(temporary)
+    os.symlink(os.path.relpath(directory, os.path.dirname(link)), temporary)
+    os.rename(temporary, link)
+
+def read_manifest(directory):
+    path = os.path.join(directory, MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path) as infile:
+        return json.load(infile)
+
+class Runner(object):
+    def __init__(self, stages, sources, workdir, jobs=2, force=(), dry_run=False):
+        self.stages = stages
+        self.sources = sources
+        self.workdir = workdir
+        self.jobs = max(jobs, 1)
+        self.force = set(force)
+        self.dry_run = dry_run
+        self.hashes_path = os.path.join(workdir, 'hashes.json')
+        self.status = {}
+        self.output_hashes = {}
+        self.running = {}
+
+    def load_hashes(self):
+        if not os.path.exists(self.hashes_path):
+            return {}
+        with open(self.hashes_path) as infile:
+            return json.load(infile)
+
+    def save_hashes(self, hashes):
+        with open(self.hashes_path + '.tmp', 'w') as outfile:
+            json.dump(hashes, outfile, indent=1, sort_keys=True)
+        os.rename(self.hashes_path + '.tmp', self.hashes_path)
+
+    def forced(self, stage):
+        return stage.name in self.force or group(stage) in self.force
+
+    def input_paths(self, stage):
+        return dict((name, self.sources[name] if name in self.sources else
+                     os.path.realpath(current_link(self.workdir, self.by_name[name]))) for name in stage.inputs)
+
+    def finish(self, stage, status, seconds=0.0, **fields):
+        self.status[stage.name] = status
+        instrumentation.record(stage.name, seconds, status=status, **fields)
+        print "%-16s %-9s %9.2fs%s" % (stage.name, status, seconds,
+                                       ''.join(' %s %s' % (name, value) for name, value in sorted(fields.items())))
+
+    #starts a stage in a temporary directory next to where its outputs will be kept
+    def launch(self, stage, key):
+        final = stage_dir(self.workdir, stage, key)
+        temporary = final + '.tmp'
+        if os.path.exists(temporary):
+            shutil.rmtree(temporary)
+        current = current_link(self.workdir, stage)
+        if stage.seeded and os.path.exists(current):
+            shutil.copytree(os.path.realpath(current), temporary, symlinks=True)
+            for name in [LOG, MANIFEST]:
+                if os.path.exists(os.path.join(temporary, name)):
+                    os.remove(os.path.join(temporary, name))
+        else:
+            os.makedirs(temporary)
+        for directory in stage.directories:
+            if not os.path.exists(os.path.join(temporary, directory)):
+                os.makedirs(os.path.join(temporary, directory))
+        inputs = self.input_paths(stage)
+        for name, source in stage.links.items():
+            os.symlink(inputs[source], os.path.join(temporary, name))
+        command = stage.command(inputs)
+        with open(os.path.join(temporary, LOG), 'w') as logfile:
+            process = subprocess.Popen(command, cwd=temporary, stdout=logfile, stderr=subprocess.STDOUT)
+        self.running[process.pid] = (stage, key, command, temporary, time.time())
+
+    #waits for any running stage, and moves its outputs into place if it succeeded
+    def reap(self):
+        pid, status, usage = os.wait4(-1, 0)
+        if pid not in self.running:
+            return
+        stage, key, command, temporary, started = self.running.pop(pid)
+        seconds = time.time() - started
+        returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+        #ru_maxrss is in kilobytes on Linux and bytes on macOS
+        peak_mb = round(usage.ru_maxrss / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0), 1)
+        if returncode != 0:
+            self.finish(stage, 'failed', seconds, returncode=returncode, peak_rss_mb=peak_mb,
+                        log=os.path.join(temporary, LOG))
+            return
+        for name in stage.links:
+            os.remove(os.path.join(temporary, name))
+        self.output_hashes[stage.name] = output_hash(temporary)
+        with open(os.path.join(temporary, MANIFEST), 'w') as outfile:
+            json.dump({'stage': stage.name, 'key': key, 'params': stage.params, 'command': command,
+                       'inputs': dict((name, self.output_hashes[name]) for name in stage.inputs),
+                       'output_hash': self.output_hashes[stage.name], 'seconds': round(seconds, 3),
+                       'peak_rss_mb': peak_mb, 'finished': time.time()}, outfile, indent=1, sort_keys=True)
+        final = stage_dir(self.workdir, stage, key)
+        if os.path.exists(final):
+            shutil.rmtree(final)
+        os.rename(temporary, final)
+        publish(self.workdir, stage, final)
+        self.finish(stage, 'ran', seconds, peak_rss_mb=peak_mb)
+
+    #decides what to do with a stage whose inputs are all there, True if it was dealt with
+    def start(self, stage, codes):
+        if any(self.output_hashes.get(name) is None for name in stage.inputs):
+            #an input that would be rebuilt in a dry run
+            self.finish(stage, 'would run')
+            return True
+        key = stage_key(stage, codes[stage.name], self.output_hashes)
+        manifest = read_manifest(stage_dir(self.workdir, stage, key))
+        if manifest is not None and not self.forced(stage):
+            self.output_hashes[stage.name] = manifest['output_hash']
+            if not self.dry_run:
+                publish(self.workdir, stage, stage_dir(self.workdir, stage, key))
+            self.finish(stage, 'cached', key=key[:12])
+            return True
+        if self.dry_run:
+            self.output_hashes[stage.name] = None
+            self.finish(stage, 'would run', key=key[:12])
+            return True
+        if len(self.running) >= self.jobs:
+            return False
+        self.launch(stage, key)
+        return True
+
+    def run(self):
+        self.by_name = dict((stage.name, stage) for stage in self.stages)
+        hashes = self.load_hashes()
+        for name, path in sorted(self.sources.items()):
+            self.output_hashes[name] = source_hash(path, hashes)
+        self.save_hashes(hashes)
+        codes = dict((stage.name, code_hash(stage.script)) for stage in self.stages)
+        pending = list(self.stages)
+        done = ['ran', 'cached', 'would run']
+        while pending or self.running:
+            progressed = True
+            while progressed:
+                progressed = False
+                for stage in list(pending):
+                    inputs = [self.status.get(name, 'ran' if name in self.sources else None) for name in stage.inputs]
+                    if any(status in ['failed', 'skipped'] for status in inputs):
+                        pending.remove(stage)
+                        self.finish(stage, 'skipped')
+                        progressed = True
+                    elif all(status in done for status in inputs) and self.start(stage, codes):
+                        pending.remove(stage)
+                        progressed = True
+            if not self.running:
+                break
+            self.reap()
+        return self.status
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the pipeline from the raw export, skipping unchanged stages')
+    parser.add_argument('datafile', help='the raw trackable export')
+    parser.add_argument('--workdir', default='pipeline', help='where stage outputs and hashes are kept')
+    parser.add_argument('--stages', nargs='+', default=DEFAULT_STAGES, choices=DEFAULT_STAGES + OPTIONAL_STAGES,
+                        help='stages to run, with the stages they read from')
+    parser.add_argument('--distance-metrics', nargs='+', default=DISTANCE_METRICS, choices=DISTANCE_METRICS)
+    parser.add_argument('--threshold', default=0.05, type=float, help='recommender_train.py\'s threshold')
+    parser.add_argument('--format', default='binary', choices=['csv', 'binary', 'both'], help='model format to train')
+    parser.add_argument('--top-k', default=10, type=int, help='closest treatments kept in the neighbour index')
+    parser.add_argument('--welch', action='store_true', help='score effectiveness with Welch\'s t-test')
+    parser.add_argument('--actionable-tags', nargs='?', const='tag_relevance.csv', metavar='RELEVANCEFILE',
+                        help='only score the tags labelled actionable in this file as treatments')
+    parser.add_argument('--publish', action='store_true', help='send find_stats to Datastore rather than a snapshot')
+    parser.add_argument('--conditions-list', default=os.path.join(SERVICE, CONDITIONS_LIST))
+    parser.add_argument('--jobs', default=2, type=int, help='stages to run at the same time')
+    parser.add_argument('--force', nargs='+', default=[], metavar='STAGE', help='run these stages even if unchanged')
+    parser.add_argument('--dry-run', action='store_true', help='print what would run without running it')
+    parser.add_argument('--trace', help='where stage timings are appended, workdir/timings.jsonl by default')
+    parser.add_argument('--trace-stages', action='store_true', help='pass --trace to the stages that take it')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.workdir):
+        os.makedirs(args.workdir)
+    args.trace = args.trace or os.path.join(args.workdir, 'timings.jsonl')
+    sources = {'export': os.path.abspath(args.datafile), 'conditions_list': os.path.abspath(args.conditions_list)}
+    if args.actionable_tags:
+        sources['relevance'] = os.path.abspath(args.actionable_tags)
+    stages = selected(define_stages(args), args.stages)
+    sources = dict((name, path) for name, path in sources.items() if any(name in stage.inputs for stage in stages))
+    if not args.dry_run:
+        instrumentation.configure(args.trace)
+    started = time.time()
+    with instrumentation.span('pipeline', stages=[stage.name for stage in stages]):
+        status = Runner(stages, sources, os.path.abspath(args.workdir), args.jobs, args.force, args.dry_run).run()
+    print "done in %.2fs" % (time.time() - started)
+    if any(value in ['failed', 'skipped'] for value in status.values()):
+        sys.exit(1)
@@ -0,0 +1,128 @@
+### Usage: python recommender_batch.py datafile modeldir outfile <pearson|cosine> [--chunksize N]
+### Example: python recommender_batch.py effectiveness_083016.csv models recommendations.csv
+### Example: python recommender_batch.py effectiveness_083016.csv models recommendations.parquet pearson --chunksize 500000
+
+### Scores every user in an effectiveness file in one pass, where recommender_predict.py handles a single user per run.
+### Each condition's model is loaded once, and all users of a condition are scored together: the closest treatment is
+### looked up once per distinct treatment and joined back onto the users' rows, then each user's best fit is picked with
+### a sort.  The picking follows recommender_predict.py: the closest correlation wins, ties go to the largest
+### effectiveness, and nothing is recommended if the best fit is a treatment the user already uses.
+
+### The output has a row per user and condition with a recommendation: user_id, condition, recommended (a treatment
+### predicted to help), avoid (a treatment predicted to make things worse) and score (the predicted effectiveness).
+### It is written as Parquet if outfile ends in .parquet (needs pyarrow or fastparquet), otherwise as CSV.
+
+### With --chunksize the datafile is streamed in chunks of that many rows instead of being read whole.  This expects
+### the rows of each user to be together, as treatment_effectiveness writes them.
+
+### Condition names are replaced by their canonical names before scoring, with the conditions list the models were
+### trained with (see condition_names.py), and the output uses the canonical names.
+
+import argparse
+import time
+import numpy as np
+import pandas as pd
+import model_store
+import condition_names
+import recommender_engine
+
+OUTPUT_COLUMNS = ['user_id', 'condition', 'recommended', 'avoid', 'score']
+
+#the best fit recommendation for every user of a single condition
+def score_condition(condition, condition_rows, condition_model, distance_metric, user_treatments):
+    treatments = condition_rows['treatment'].unique()
+    closest = [condition_model.closest(treatment, distance_metric) for treatment in treatments]
+    closest = pd.DataFrame({'treatment': treatments,
+                            'closest_correlation_name': [name for name, value in closest],
+                            'closest_correlation_value': [value for name, value in closest]})
+    rows = condition_rows[['user_id', 'treatment', 'effectiveness']].reset_index(drop=True)
+    rows['order'] = np.arange(len(rows))
+    rows = rows.merge(closest, on='treatment')
+    rows = rows[pd.notnull(rows['closest_correlation_value'])]
+
+    #closest first, in the case of a tie the most relevant predicted effectiveness, then the first row like idxmax
+    rows['relevance'] = rows['effectiveness'].abs()
+    rows = rows.sort_values(['user_id', 'closest_correlation_value', 'relevance', 'order'],
+                            ascending=[True, distance_metric == 'cosine', False, True])
+    best = rows.drop_duplicates('user_id')
+
+    #a check to make sure we don't recommend a treatment they already use
+    already_used = best[['user_id', 'closest_correlation_name']].merge(
+        user_treatments, left_on=['user_id', 'closest_correlation_name'], right_on=['user_id', 'treatment'], how='left')
+    best = best[pd.isnull(already_used['treatment'].values)]
+
+    return pd.DataFrame({
+        'user_id': best['user_id'].values,
+        'condition': condition,
+        'recommended': np.where(best['effectiveness'] > 0, best['closest_correlation_name'], None),
+        'avoid': np.where(best['effectiveness'] < 0, best['closest_correlation_name'], None),
+        'score': best['effectiveness'].values,
+    }, columns=OUTPUT_COLUMNS)
+
+#load_model returns the model of a condition from its file name form, or None if there isn't one
+#conditions is the index the models were trained with, the repository's conditions list by default
+def score_users(df, load_model, distance_metric, conditions=None):
+    condition_rows = (conditions or condition_names.index()).rows(df['condition'])
+    user_treatments = df[['user_id', 'treatment']].drop_duplicates()
+    results = []
+    for condition in sorted(condition_rows):
+        condition_model = load_model(recommender_engine.model_name(condition))
+        if condition_model is None:
+            continue
+        scored = score_condition(condition, df.take(condition_rows[condition]), condition_model, distance_metric,
+                                 user_treatments)
+        results.append(scored[scored['score'] != 0])
+    if not results:
+        return pd.DataFrame(columns=OUTPUT_COLUMNS)
+    return pd.concat(results, ignore_index=True)
+
+#chunks of the datafile that never split a user's rows between two chunks
+def user_chunks(file, chunksize):
+    if not chunksize:
+        yield pd.read_csv(file)
+        return
+    carried = None
+    for chunk in pd.read_csv(file, chunksize=chunksize):
+        if carried is not None:
+            chunk = pd.concat([carried, chunk], ignore_index=True)
+        last_user = chunk['user_id'].iloc[-1]
+        carried = chunk[chunk['user_id'] == last_user]
+        chunk = chunk[chunk['user_id'] != last_user]
+        if len(chunk) > 0:
+            yield chunk
+    if carried is not None and len(carried) > 0:
+        yield carried
+
+def write_results(results, outfile):
+    if outfile.endswith('.parquet'):
+        results.to_parquet(outfile, index=False)
+    else:
+        results.to_csv(outfile, index=False)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Recommend treatments for every user in an effectiveness file')
+    parser.add_argument('datafile')
+    parser.add_argument('modeldir')
+    parser.add_argument('outfile')
+    parser.add_argument('distance_metric', nargs='?', default='cosine', choices=['cosine', 'pearson'])
+    parser.add_argument('--chunksize', default=0, type=int, help='stream the datafile in chunks of this many rows')
+    args = parser.parse_args()
+
+    started = time.time()
+    models = model_store.open_models(args.modeldir, args.distance_metric)
+    conditions = condition_names.models_index(args.modeldir)
+    condition_models = {}
+    def load_model(name):
+        if name not in condition_models:
+            condition_models[name] = models.condition(name)
+        return condition_models[name]
+    results = []
+    users = 0
+    for chunk in user_chunks(args.datafile, args.chunksize):
+        users += chunk['user_id'].nunique()
+        results.append(score_users(chunk, load_model, args.distance_metric, conditions))
+    results = pd.concat(results, ignore_index=True) if results else pd.DataFrame(columns=OUTPUT_COLUMNS)
+    write_results(results, args.outfile)
+
+    seconds = time.time() - started
+    print "scored %d users (%d recommendations) in %.2fs, %.0f users/second" % (users, len(results), seconds, users / max(seconds, 1e-9))
@@ -0,0 +1,163 @@
+### Vectorized pairwise distance engine used by recommender_train.py
+
+### Each condition is pivoted once into a sparse user x treatment matrix.  Every statistic that cosine distance and
+### pearson correlation need (co-rated user counts, sums, sums of squares and dot products over the users that rated
+### both treatments) is then a single sparse matrix product, so a whole condition costs a handful of products instead
+### of one DataFrame filter per treatment pair.
+
+### The statistics are sums over users, so they can also be kept between runs (save_statistics) and updated for a few
+### changed users by taking those users' old contribution out and adding their new one (update_statistics), which is
+### how recommender_train.py --delta retrains without rescanning a whole condition.
+
+### Values are paired by user_id.  The old per-pair filtering paired them by row order, which gives the same answer
+### as long as the effectiveness file is grouped by user, as the treatment_effectiveness notebook writes it.
+
+import numpy as np
+import pandas as pd
+from scipy import sparse, special
+#condition names are used as file names, condition_names.py keeps the one way they're made
+from condition_names import model_name
+
+STATISTICS = ['n', 'nan', 'sx', 'sxx', 'sxy']
+
+def model_path(modeldir, condition, distance_metric):
+    return modeldir + '/' + model_name(condition) + "_" + distance_metric + ".csv"
+
+#the treatments in the order the model table lists them (rows and columns)
+def condition_treatments(condition_rows):
+    return list(set(condition_rows['treatment']))
+
+#pivot the rows of a single condition into sparse user x treatment matrices
+#returns the matrices of effectiveness values (nan as 0), of which cells were rated, and of which ratings were nan
+def condition_matrices(condition_rows, treatments):
+    condition_rows = condition_rows.drop_duplicates(['user_id', 'treatment'])
+    users, user_index = np.unique(condition_rows['user_id'].values, return_inverse=True)
+    treatment_index = pd.Index(treatments).get_indexer(condition_rows['treatment'])
+    values = condition_rows['effectiveness'].values.astype(float)
+    is_nan = np.isnan(values)
+
+    shape = (len(users), len(treatments))
+    def build(data):
+        return sparse.csr_matrix((data, (user_index, treatment_index)), shape=shape)
+    return build(np.where(is_nan, 0.0, values)), build(np.ones(len(values))), build(is_nan.astype(float))
+
+#sufficient statistics for every pair of treatments, each a dense treatments x treatments array
+#for a pair (i, j) everything is summed over the users that rated both i and j:
+#  n   - number of co-rated users
+#  nan - number of co-rated users where either value is nan
+#  sx  - sum of treatment i's values (treatment j's sum is sx.T)
+#  sxx - sum of squares of treatment i's values (treatment j's is sxx.T)
+#  sxy - dot product of the two value vectors
+def pair_statistics(values, rated, missing):
+    def product(a, b):
+        return np.asarray((a.T * b).todense())
+    nan_counts = product(missing, rated)
+    return {
+        'n': product(rated, rated),
+        'nan': nan_counts + nan_counts.T,
+        'sx': product(values, rated),
+        'sxx': product(values.multiply(values), rated),
+        'sxy': product(values, values),
+    }
+
+def condition_statistics(condition_rows, treatments):
+    return pair_statistics(*condition_matrices(condition_rows, treatments))
+
+def statistics_path(statsdir, condition):
+    return statsdir + '/' + model_name(condition) + ".npz"
+
+#only pairs with a co-rated user have statistics, so they are saved as coordinates
+def save_statistics(path, treatments, stats):
+    rows, columns = np.nonzero(stats['n'])
+    arrays = dict((key, stats[key][rows, columns]) for key in STATISTICS)
+    np.savez_compressed(path, treatments=np.array(treatments, dtype=str), rows=rows, columns=columns, **arrays)
+
+#the saved statistics laid out for treatments, which may list treatments the saved ones didn't have
+def load_statistics(path, treatments):
+    saved = np.load(path)
+    positions = pd.Index(treatments).get_indexer(list(saved['treatments']))
+    rows, columns = positions[saved['rows']], positions[saved['columns']]
+    known = (rows >= 0) & (columns >= 0)
+    stats = {}
+    for key in STATISTICS:
+        stats[key] = np.zeros((len(treatments), len(treatments)), dtype=saved[key].dtype)
+        stats[key][rows[known], columns[known]] = saved[key][known]
+    return stats
+
+#replace the contribution of some users: old_rows are everything they had before, new_rows everything they have now
+def update_statistics(stats, treatments, old_rows, new_rows):
+    old = condition_statistics(old_rows, treatments)
+    new = condition_statistics(new_rows, treatments)
+    updated = {}
+    for key in STATISTICS:
+        updated[key] = stats[key] - old[key] + new[key]
+        #sums that should cancel to exactly zero leave rounding noise behind, which would turn a 0/0 into a value
+        scale = np.abs(stats[key]) + np.abs(old[key]) + np.abs(new[key])
+        updated[key][np.abs(updated[key]) <= 1e-12 * scale] = 0
+    return updated
+
+#pairs that have a value: rated together by someone, no nan ratings, and not a treatment compared with itself
+def comparable(stats):
+    valid = (stats['n'] > 0) & (stats['nan'] == 0)
+    np.fill_diagonal(valid, False)
+    return valid
+
+def cosine_distances(stats):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        distances = 1.0 - stats['sxy'] / np.sqrt(stats['sxx'] * stats['sxx'].T)
+    distances[~comparable(stats)] = np.nan
+    return distances
+
+#pearson r and two tailed p value for every pair, computed the same way as scipy's pearsonr
+def pearson_correlations(stats):
+    n = stats['n'].astype(float)
+    sx, sy = stats['sx'], stats['sx'].T
+    with np.errstate(divide='ignore', invalid='ignore'):
+        covariance = stats['sxy'] - sx * sy / n
+        x_variance = stats['sxx'] - sx * sx / n
+        y_variance = stats['sxx'].T - sy * sy / n
+        #the single pass sums leave rounding noise where a treatment's values are constant, treat that as no variance
+        x_variance[x_variance <= 1e-12 * stats['sxx']] = 0.0
+        y_variance[y_variance <= 1e-12 * stats['sxx'].T] = 0.0
+        r = covariance / np.sqrt(x_variance * y_variance)
+        #a constant treatment has no correlation with anything, like scipy's pearsonr
+        r[x_variance * y_variance == 0] = np.nan
+        r = np.clip(r, -1.0, 1.0)
+
+        #two points always sit on a line
+        two_points = n == 2
+        r[two_points] = np.sign(r[two_points])
+
+        df = n - 2
+        t_squared = r * r * (df / ((1.0 - r) * (1.0 + r)))
+        p = special.betainc(0.5 * df, 0.5, df / (df + t_squared))
+        p[np.abs(r) == 1.0] = 0.0
+        #but with no degrees of freedom the line says nothing, like current scipy's pearsonr
+        p[two_points & ~np.isnan(r)] = 1.0
+
+    #can't compare scalars in pearson
+    invalid = ~comparable(stats) | (n < 2)
+    r[invalid] = np.nan
+    p[invalid] = np.nan
+    return r, p
+
+#values are rounded to 12 decimal places, so pairs that only differ by floating point noise (a distance of 0 against
+#-2.2e-16) tie exactly, and ties resolve by column order however the sums were accumulated
+def distance_matrix(stats, distance_metric, threshold):
+    if distance_metric == 'cosine':
+        return np.round(cosine_distances(stats), 12)
+    r, p = pearson_correlations(stats)
+    with np.errstate(invalid='ignore'):
+        r[~(p < threshold)] = np.nan
+    return np.round(r, 12)
+
+#the model table as recommender_predict.py reads it: one column per treatment plus a 'row' column naming each row
+def distance_table(distances, treatments):
+    table = pd.DataFrame(distances, columns=treatments)
+    table['row'] = treatments
+    return table
+
+def condition_table(condition_rows, distance_metric, threshold):
+    treatments = condition_treatments(condition_rows)
+    stats = condition_statistics(condition_rows, treatments)
+    return distance_table(distance_matrix(stats, distance_metric, threshold), treatments)
@@ -1,96 +1,81 @@
-### Usage: python recommender_predict.py datafile modeldir <pearson|cosine>
+### Usage: python recommender_predict.py datafile modeldir <pearson|cosine> [--top-k K]
 ### Example: python recommender_predict.py test_user_1.csv models
 ### Example: python recommender_predict.py test_user_1.csv models pearson
+### Example: python recommender_predict.py test_user_1.csv models cosine --top-k 5
 
 ### Takes in a single user's effectiveness measurements and determines what the most and least effect treatements for them will be
+### Models are read through model_store.open_models, which uses the <metric>.neighbours index when recommender_train.py
+### wrote one, then the <metric>.model file, then the per condition CSVs.  With the index the closest treatments to each
+### of the user's treatments are an O(k) read rather than a scan of the condition's table.
+### For every condition the closest treatments to the ones the user has used are ranked by closeness, then by the
+### magnitude of the effectiveness they are predicted from, and the first --top-k of them are the condition's best fits.
+### The best fits predicted to help are printed best first by predicted effectiveness, then the ones to stay away from,
+### up to --top-k of each.  --top-k 1 (the default) gives the single best and worst recommendation.
+### Condition names are replaced by their canonical names from the conditions list the models were trained with (see
+### condition_names.py) to find the model they were trained into
 
-import numpy as np
+import argparse
 import pandas as pd
-import sys
-import functools
-import warnings
-warnings.filterwarnings("ignore")
+import model_store
+import condition_names
+import recommender_engine
 
-if len(sys.argv) < 3:
-    print "Usage: python recommender_predict.py datafile modelfile distance_metric"
-    quit()
+parser = argparse.ArgumentParser(description='Recommend treatments for a single user')
+parser.add_argument('datafile')
+parser.add_argument('modeldir')
+parser.add_argument('distance_metric', nargs='?', default='cosine', choices=['cosine', 'pearson'])
+parser.add_argument('--top-k', default=1, type=int, help='how many treatments to recommend trying and avoiding')
+args = parser.parse_args()
+if args.top_k < 1:
+    parser.error("--top-k must be at least 1")
 
-file = sys.argv[1]
-modeldir = sys.argv[2]
+distance_metric = args.distance_metric
+k = args.top_k
 
-test_df = pd.read_csv(file)
+test_df = pd.read_csv(args.datafile)
+used = set(test_df['treatment'])
 
-distance_metric = 'cosine'
-if len(sys.argv) == 4:
-    if (sys.argv[3] == 'pearson') or (sys.argv[3] == 'cosine'):
-        distance_metric = sys.argv[3]
-    else:
-        print "distance metric must be pearson or cosine"
-        quit()
+models = model_store.open_models(args.modeldir, distance_metric)
+
+#the best fits of a single condition: the k closest treatments to the user's, closest first (lowest value for cosine,
+#highest for pearson), in the case of a tie the most relevant predicted effectiveness, then the user's row order
+def best_fits(condition_rows, condition_model):
+    fits = []
+    for order, (treatment, effectiveness) in enumerate(zip(condition_rows['treatment'], condition_rows['effectiveness'])):
+        for name, value in condition_model.neighbours(treatment, distance_metric, k):
+            closeness = value if distance_metric == 'cosine' else -value
+            fits.append(((closeness, -abs(effectiveness), order), name, effectiveness))
+    fits.sort(key=lambda fit: fit[0])
+    best = []
+    seen = set()
+    for key, name, effectiveness in fits:
+        if name not in seen:
+            seen.add(name)
+            best.append((name, effectiveness))
+    return best[:k]
 
 #get a list of all the conditions this user has
 #we will search each of them to see which one is most actionable
-#I'm just taking the highest and lowest predicted effectiveness for all conditions, could just as easily return a recommendation per condition
-conditions = list(set(test_df['condition']))
-
-highestPredictedValue = 0
-highestPredictedKey = ""
-highestPredictedCondition = ""
-lowestPredictedValue = 0
-lowestPredictedKey = ""
-lowestPredictedCondition = ""
-for condition in conditions:
-    condition_rows = test_df[test_df['condition'] == condition]
-    correlations = pd.read_csv(modeldir + '/' + condition.replace('/', '').replace("\n","").replace("\r","") + "_" + distance_metric + ".csv")
-
-    # some treatments won't have any associated distances, just skip over them
-    #correlations = correlations.dropna(how='all',axis=1)
-
-    #looking for the max values for pearson (from -1 to 1 with 1 being closest)
-    #but looking for min values for cosine (from 0-2 with 0 being closest)
-    best_fit_predicted_effectiveness = 0
-    best_fit_treatment_name = ""
-    if (distance_metric == 'pearson'):
-        condition_rows['closest_correlation_name'] = condition_rows['treatment'].apply(
-            lambda x: correlations[correlations['row'] == x].drop('row', axis=1).idxmax(axis=1).values[0])
-        condition_rows['closest_correlation_value'] = condition_rows['treatment'].apply(
-            lambda x: correlations[correlations['row'] == x].drop('row', axis=1).max(axis=1).values[0])
-        condition_rows = condition_rows[pd.notnull(condition_rows['closest_correlation_value'])]
-        if len(condition_rows) > 0:
-            tiedRows = condition_rows[
-                condition_rows['closest_correlation_value'] == condition_rows['closest_correlation_value'].max()]
-            best_fit_predicted_effectiveness = condition_rows.ix[tiedRows['effectiveness'].abs().idxmax()]['effectiveness']
-            best_fit_treatment_name = condition_rows.ix[tiedRows['effectiveness'].abs().idxmax()]['closest_correlation_name']
-    else:
-        condition_rows['closest_correlation_name'] = condition_rows['treatment'].apply(
-            lambda x: correlations[correlations['row'] == x].drop('row', axis=1).idxmin(axis=1).values[0])
-        condition_rows['closest_correlation_value'] = condition_rows['treatment'].apply(
-            lambda x: correlations[correlations['row'] == x].drop('row', axis=1).min(axis=1).values[0])
-        condition_rows = condition_rows[pd.notnull(condition_rows['closest_correlation_value'])]
-        if len(condition_rows) > 0:
-            tiedRows = condition_rows[condition_rows['closest_correlation_value'] == condition_rows['closest_correlation_value'].min()]
-            #in the case of a tie, go with the most relevant predicted effectiveness
-            best_fit_predicted_effectiveness = condition_rows.ix[tiedRows['effectiveness'].abs().idxmax()]['effectiveness']
-            best_fit_treatment_name = condition_rows.ix[tiedRows['effectiveness'].abs().idxmax()]['closest_correlation_name']
+recommendations = []
+#in the order the user's conditions first appear
+conditions = condition_names.models_index(args.modeldir).rows(test_df['condition'])
+for condition, rows in sorted(conditions.items(), key=lambda item: item[1][0]):
+    condition_rows = test_df.take(rows)
+    condition_model = models.condition(recommender_engine.model_name(condition))
+    if condition_model is None:
+        continue
+    for name, effectiveness in best_fits(condition_rows, condition_model):
+        #a check to make sure we don't recommend a treatment they already use
+        if name not in used and effectiveness != 0:
+            recommendations.append((condition, name, effectiveness))
 
-    #Now we know which treatment that the user has tried has another treatment which is most highly correlated to it, so predict that
-    #the new treatment will have an effectiveness similar to the original treatment
-    if best_fit_treatment_name not in test_df['treatment'].values: #a check to make sure we don't recommend a treatment they already use
-        if highestPredictedValue < best_fit_predicted_effectiveness:
-            highestPredictedValue = best_fit_predicted_effectiveness
-            highestPredictedName = best_fit_treatment_name
-            highestPredictedCondition = condition
-        if lowestPredictedValue > best_fit_predicted_effectiveness:
-            lowestPredictedValue = best_fit_predicted_effectiveness
-            lowestPredictedName = best_fit_treatment_name
-            lowestPredictedCondition = condition
+#predict that the new treatment will have an effectiveness similar to the user's treatment it is closest to
+try_treatments = sorted([fit for fit in recommendations if fit[2] > 0], key=lambda fit: -fit[2])[:k]
+avoid_treatments = sorted([fit for fit in recommendations if fit[2] < 0], key=lambda fit: fit[2])[:k]
 
-madeRec = False
-if highestPredictedValue > 0:
-    print "This user may have good results treating " + highestPredictedCondition + " with " + highestPredictedName
-    madeRec = True
-if lowestPredictedValue < 0:
-    madeRec = True
-    print "This user may have good results treating " + lowestPredictedCondition + " by staying away from " + lowestPredictedName
-if not madeRec:
-    print "We have no reliable recommendation to make for this user"
\ No newline at end of file
+for condition, name, effectiveness in try_treatments:
+    print "This user may have good results treating " + condition + " with " + name
+for condition, name, effectiveness in avoid_treatments:
+    print "This user may have good results treating " + condition + " by staying away from " + name
+if not try_treatments and not avoid_treatments:
+    print "We have no reliable recommendation to make for this user"
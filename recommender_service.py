@@ -0,0 +1,308 @@
+### Usage: python recommender_service.py [modeldir]
+### Example: python recommender_service.py models
+### Example: curl -X POST -H 'Content-Type: application/json' localhost:5000/recommend/cosine \
+###              -d '[{"condition": "Anxiety", "treatment": "Yoga", "effectiveness": 1.5}]'
+### Example: curl -X POST -H 'Content-Type: application/json' localhost:5000/diagnose \
+###              -d '{"symptoms": ["Fatigue", "Joint pain"], "k": 5}'
+
+### A resident version of recommender_predict.py, so a recommendation doesn't pay for starting Python, importing pandas
+### and parsing model CSVs.  POST a user's effectiveness rows (condition, treatment and effectiveness) to
+### /recommend/<pearson|cosine> and get back the best fit per condition, picked the same way as recommender_batch.py and
+### with the same fields, minus the user_id.  Conditions are looked up and returned under their canonical names from
+### the conditions list the models were trained with, see condition_names.py.
+
+### Condition models are kept in a least recently used cache bounded by an estimate of their size in bytes
+### (RECOMMENDER_CACHE_BYTES, default 256MB).  The model directory is checked for changes at most every few seconds,
+### and the cache is dropped when a model file has been rewritten.  /stats reports cache hits, misses and evictions
+### and the latency percentiles of recent requests.
+
+### POST a set of symptoms to /diagnose for the conditions diagnosis.py's model ranks best for them, with their
+### decisions and whether the model's thresholds predict them.  The model (modeldir/diagnosis.model) is opened on the
+### first request and dropped with the condition models when the directory changes.
+
+from flask import Flask, request
+from flask_restful import Api, Resource
+from flask_restful_swagger import swagger
+import collections
+import glob
+import os
+import sys
+import threading
+import time
+import numpy as np
+import condition_names
+import diagnosis
+import model_store
+import recommender_engine
+
+MODEL_DIR = os.environ.get('RECOMMENDER_MODELS', 'models')
+CACHE_BYTES = int(os.environ.get('RECOMMENDER_CACHE_BYTES', 256 * 1024 * 1024))
+RELOAD_CHECK_SECONDS = 5
+LATENCY_SAMPLES = 10000
+DISTANCE_METRICS = ['cosine', 'pearson']
+
+app = Flask(__name__)
+
+api = swagger.docs(Api(app), apiVersion='0.1',
+                   basePath='http://localhost:5000',
+                   resourcePath='/',
+                   produces=["application/json"],
+                   api_spec_url='/api/spec',
+                   description='Recommends treatments from a user\'s effectiveness measurements')
+
+#rough size of a loaded condition model, the treatment names and lookup dict plus any dense table it holds
+def model_size(condition_model):
+    size = 200 * len(condition_model.treatments)
+    if hasattr(condition_model, 'distances'):
+        size += condition_model.distances.nbytes
+    return size
+
+class ModelCache(object):
+    def __init__(self, modeldir, max_bytes):
+        self.modeldir = modeldir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.reloads = 0
+        self.clear()
+        self.signature = self.directory_signature()
+        self.checked = time.time()
+
+    def clear(self):
+        self.models = {}
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.diagnosis = None
+        self.conditions = None
+
+    #modification times of the directory and the files in it, any rewrite of a model changes this
+    def directory_signature(self):
+        paths = [self.modeldir] + [path for pattern in ['*.model', '*.neighbours', '*.csv']
+                                   for path in glob.glob(os.path.join(self.modeldir, pattern))]
+        return sorted((path, os.path.getmtime(path)) for path in paths if os.path.exists(path))
+
+    def check_for_changes(self):
+        if time.time() - self.checked < RELOAD_CHECK_SECONDS:
+            return
+        self.checked = time.time()
+        signature = self.directory_signature()
+        if signature != self.signature:
+            self.signature = signature
+            self.reloads += 1
+            self.clear()
+
+    def condition(self, distance_metric, name):
+        key = (distance_metric, name)
+        with self.lock:
+            self.check_for_changes()
+            if key in self.entries:
+                self.hits += 1
+                condition_model, size = self.entries.pop(key)
+                self.entries[key] = (condition_model, size)
+                return condition_model
+            self.misses += 1
+            if distance_metric not in self.models:
+                self.models[distance_metric] = model_store.open_models(self.modeldir, distance_metric)
+            #load rather than condition, so an evicted model isn't still held by the model store
+            condition_model = self.models[distance_metric].load(name)
+            size = model_size(condition_model) if condition_model is not None else 0
+            self.entries[key] = (condition_model, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes and len(self.entries) > 1:
+                evicted_key, (evicted, evicted_size) = self.entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+            return condition_model
+
+    #the index of the conditions list the directory's models were trained with
+    def conditions_index(self):
+        with self.lock:
+            self.check_for_changes()
+            if self.conditions is None:
+                self.conditions = condition_names.models_index(self.modeldir)
+            return self.conditions
+
+    #the diagnosis model of the directory, None if it has none
+    def diagnosis_model(self):
+        with self.lock:
+            self.check_for_changes()
+            if self.diagnosis is None and os.path.exists(diagnosis.model_path(self.modeldir)):
+                self.diagnosis = diagnosis.Diagnosis(diagnosis.model_path(self.modeldir))
+            return self.diagnosis
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'reloads': self.reloads,
+                'hit_rate': float(self.hits) / lookups if lookups else None,
+                'entries': len(self.entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+            }
+
+class LatencyRecorder(object):
+    def __init__(self, samples):
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=samples)
+        self.requests = 0
+
+    def record(self, seconds):
+        with self.lock:
+            self.latencies.append(seconds)
+            self.requests += 1
+
+    def stats(self):
+        with self.lock:
+            latencies = np.array(self.latencies)
+            requests = self.requests
+        stats = {'requests': requests, 'samples': len(latencies)}
+        for percentile in [50, 90, 95, 99]:
+            value = np.percentile(latencies, percentile) * 1000 if len(latencies) else None
+            stats['p%d_ms' % percentile] = value
+        return stats
+
+cache = ModelCache(MODEL_DIR, CACHE_BYTES)
+latencies = LatencyRecorder(LATENCY_SAMPLES)
+
+#the models hold utf-8 encoded names, JSON gives us unicode
+def encoded(name):
+    return name.encode('utf-8') if isinstance(name, unicode) else name
+
+#the best fit per condition for a single user, with the same rules as recommender_batch.score_condition
+#a request only has a handful of rows, so this stays in plain Python rather than paying for DataFrame operations
+def recommend(rows, distance_metric):
+    conditions_index = cache.conditions_index()
+    rows = [dict(row, condition=conditions_index.canonical_name(encoded(row['condition'])),
+                 treatment=encoded(row['treatment'])) for row in rows]
+    used = set(row['treatment'] for row in rows)
+    conditions = collections.OrderedDict()
+    for row in rows:
+        conditions.setdefault(row['condition'], []).append(row)
+
+    recommendations = []
+    for condition, condition_rows in conditions.items():
+        condition_model = cache.condition(distance_metric, recommender_engine.model_name(condition))
+        if condition_model is None:
+            continue
+        best = None
+        for row in condition_rows:
+            name, value = condition_model.closest(row['treatment'], distance_metric)
+            if value != value:
+                continue
+            closeness = value if distance_metric == 'cosine' else -value
+            key = (closeness, -abs(row['effectiveness']))
+            if best is None or key < best[0]:
+                best = (key, name, row['effectiveness'])
+        if best is None or best[1] in used or best[2] == 0:
+            continue
+        key, name, effectiveness = best
+        recommendations.append({
+            'condition': condition,
+            'recommended': name if effectiveness > 0 else None,
+            'avoid': name if effectiveness < 0 else None,
+            'score': float(effectiveness),
+        })
+    return recommendations
+
+class Recommend(Resource):
+  @swagger.operation(
+      notes='Recommend treatments for a single user.  The body is a JSON list of the user\'s effectiveness rows, each with a condition, treatment and effectiveness.  Returns the best fit recommendation for each condition that has one, with the treatment to try or to avoid and its predicted effectiveness.',
+      nickname='post',
+      parameters=[
+          {
+              "name": "distance_metric",
+              "description": "The distance metric of the models to use (cosine or pearson)",
+              "required": True,
+              "allowMultiple": False,
+              "dataType": 'string',
+              "paramType": "path"
+          },
+          {
+              "name": "body",
+              "description": "The user's effectiveness rows",
+              "required": True,
+              "allowMultiple": False,
+              "dataType": 'string',
+              "paramType": "body"
+          }
+      ])
+  def post(self, distance_metric):
+    started = time.time()
+    if distance_metric not in DISTANCE_METRICS:
+        return "distance metric must be pearson or cosine", 404
+    rows = request.get_json(force=True, silent=True)
+    if isinstance(rows, dict):
+        rows = rows.get('rows')
+    if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+        return "expected a list of effectiveness rows", 400
+    if any(column not in row for row in rows for column in ['condition', 'treatment', 'effectiveness']):
+        return "every row needs a condition, treatment and effectiveness", 400
+    if not all(isinstance(row['effectiveness'], (int, long, float)) for row in rows):
+        return "effectiveness must be a number", 400
+
+    recommendations = recommend(rows, distance_metric)
+    latencies.record(time.time() - started)
+    return {'recommendations': recommendations}, 200
+
+class Diagnose(Resource):
+  @swagger.operation(
+      notes='Rank the conditions that best explain a set of symptoms.  The body is a JSON object with a list of symptom names and optionally k, how many conditions to return (default 10).  Returns the conditions best first with their decision and whether the model predicts them, and any symptoms the model doesn\'t know.',
+      nickname='post',
+      parameters=[
+          {
+              "name": "body",
+              "description": "The symptoms, and optionally k",
+              "required": True,
+              "allowMultiple": False,
+              "dataType": 'string',
+              "paramType": "body"
+          }
+      ])
+  def post(self):
+    started = time.time()
+    body = request.get_json(force=True, silent=True)
+    if isinstance(body, list):
+        body = {'symptoms': body}
+    if not isinstance(body, dict) or not isinstance(body.get('symptoms'), list):
+        return "expected a list of symptoms", 400
+    if not all(isinstance(symptom, basestring) for symptom in body['symptoms']):
+        return "symptoms must be names", 400
+    k = body.get('k', diagnosis.K)
+    if not isinstance(k, (int, long)) or k < 1:
+        return "k must be a positive number", 400
+    model = cache.diagnosis_model()
+    if model is None:
+        return "no diagnosis model in " + cache.modeldir, 404
+
+    candidates, unknown = model.rank([encoded(symptom) for symptom in body['symptoms']], k)
+    latencies.record(time.time() - started)
+    return {'conditions': [{'condition': condition, 'decision': decision, 'predicted': predicted}
+                           for condition, decision, predicted in candidates],
+            'unknown_symptoms': unknown}, 200
+
+class Stats(Resource):
+  @swagger.operation(
+      notes='Model cache hits, misses and evictions, and latency percentiles in milliseconds over recent requests',
+      nickname='get'
+      )
+  def get(self):
+    return {'cache': cache.stats(), 'latency': latencies.stats()}, 200
+
+##
+## Actually setup the Api resource routing here
+##
+api.add_resource(Recommend, '/recommend/<string:distance_metric>')
+api.add_resource(Diagnose, '/diagnose')
+api.add_resource(Stats, '/stats')
+
+
+if __name__ == '__main__':
+  if len(sys.argv) > 1:
+    cache = ModelCache(sys.argv[1], CACHE_BYTES)
+  app.run(debug=True)
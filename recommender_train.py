@@ -1,10 +1,17 @@
-### Usage: python recommender_train.py datafile modeldir <pearson|cosine> threshold
+### Usage: python recommender_train.py datafile modeldir <pearson|cosine> threshold [--workers N] [--format csv|binary|both]
+###                                     [--top-k K] [--stats statsdir] [--delta deltafile [--write-merged outfile]]
+###                                     [--trace tracefile] [--profile profiledir] [--trace-memory]
+###                                     [--conditions-list conditions_list.csv]
 ### Example: python recommender_train.py effectiveness_083016.csv models
 ### Example: python recommender_train.py effectiveness_083016.csv models pearson 0.05
+### Example: python recommender_train.py effectiveness_083016.csv models cosine --workers 8
+### Example: python recommender_train.py effectiveness_083016.csv models cosine --format binary
+### Example: python recommender_train.py effectiveness_083016.csv models cosine --stats stats --delta new_checkins.csv
+### Example: python recommender_train.py effectiveness_083016.csv models cosine --trace train.jsonl --profile profiles
 
 ### This script takes in the pre-processed datafile from treatment_effectiveness.ipynb and measures the cosine distance
 ### between the effectiveness of all tags/treatments.  It then outputs a cosine distance table for each condition, which
-### can be used by recommender_predict.py
+### can be used by recommender_predict.py.  The pairwise computation itself lives in recommender_engine.py
 
 ### Before deciding on a distance metric, check out the accompanying notebook.  Long story short, you will find more
 ### non-na distances if you use cosine distance, but pearson is more discriminant.  If you set the
@@ -14,67 +21,197 @@
 ### Don't be surprised by the amount of NaN in the model.  Only treatments/tags that have been used by the same user
 ### for the same condition will have a value.  This means that most values will be NaN.
 
+### Every condition's table is independent, so --workers N trains N conditions at a time.  The effectiveness data is
+### loaded once before the pool is started and the workers inherit it, each task only sends a condition name.  The
+### largest conditions are scheduled first so the run doesn't end waiting on Anxiety or Depression.
+
+### --format binary writes every condition into a single memory mapped <metric>.model file instead of one CSV per
+### condition, see model_store.py.  recommender_predict.py uses that file when it finds it in the model directory.
+### Either way a <metric>.neighbours index of each treatment's --top-k closest treatments (default 10, 0 to skip it) is
+### written too, which turns finding the closest treatments at prediction time into an O(k) read.
+
+### --stats keeps each condition's pair statistics (co-rated counts, sums, sums of squares and dot products, see
+### recommender_engine.py) in statsdir.  A later run with --delta only retrains the conditions that a file of new or
+### changed effectiveness rows touches: the delta rows replace any row with the same user, condition and treatment,
+### and the changed users' old contribution to the saved statistics is swapped for their new one.  The tables come out
+### the same as a full retrain on the merged data, which --write-merged saves for the next full run.
+
+### --trace appends timing spans (load, and for each condition filter, pairs, distances and write) and counters (rows
+### scanned, pairs evaluated, nan pairs skipped) to tracefile as JSON lines, see instrumentation.py.  --profile keeps a
+### cProfile file per condition in profiledir and --trace-memory adds each condition's memory use to the trace.
+
+### Condition names are replaced by their canonical names from --conditions-list (the repository's conditions list by
+### default, see condition_names.py) as the data and any delta are read, so the rows of "GERD" and "Acid reflux" train
+### one model.  Names that aren't listed conditions are kept as they are.
+### The list is copied into modeldir as conditions_list.csv, which recommender_predict.py, recommender_batch.py and
+### recommender_service.py canonicalize with.  A --delta run has to use the list the models were trained with, and
+### models trained before the list was kept with them have to be retrained in full.
+
+import argparse
+import multiprocessing
+import os
 import numpy as np
 import pandas as pd
-import sys
-from scipy.spatial import distance
-from scipy.stats.stats import pearsonr
-
-if len(sys.argv) < 3:
-    print "Usage: python recommender_train.py datafile modelfile"
-    quit()
-
-file = sys.argv[1]
-modeldir = sys.argv[2]
-
-distance_metric = 'cosine'
-if len(sys.argv) >= 4:
-    if (sys.argv[3] == 'pearson') or (sys.argv[3] == 'cosine'):
-        distance_metric = sys.argv[3]
-    else:
-        print "distance metric must be pearson or cosine"
-        quit()
-threshold = 0.05
-if len(sys.argv) == 5:
-    threshold = sys.argv[4]
-
-df = pd.read_csv(file)
-
-def find_distances(condition_rows, treatment, other_treatments, condition):
-    treatment_correlations = {}
-    treatment_correlations['row'] = treatment
-    for treatment2 in other_treatments:
-        users_with_treatment2 = list(set(condition_rows[condition_rows['treatment'] == treatment2]['user_id']))
-        treatment1_values = condition_rows[(condition_rows['user_id'].isin(users_with_treatment2)) & (condition_rows['treatment'] == treatment)]['effectiveness']
-        treatment2_values = condition_rows[(condition_rows['user_id'].isin(users_with_treatment2)) & (condition_rows['treatment'] == treatment2)]['effectiveness']
-        if (not np.isnan(treatment1_values).any()) and (not np.isnan(treatment2_values).any()):
-            if distance_metric == 'cosine':
-                cos_distance = distance.cosine(treatment1_values, treatment2_values)
-                treatment_correlations[treatment2] = cos_distance
-            else: #pearson
-                if len(treatment1_values) > 1 : #can't compare scalars in pearson
-                    pearson_result = pearsonr(treatment1_values, treatment2_values)
-                    correlation = pearson_result[0]
-                    if pearson_result[1] < threshold:
-                        treatment_correlations[treatment2] = correlation
-    return treatment_correlations
-
-conditions = list(set(df['condition']))
-for condition in conditions:
+import time
+import instrumentation
+import model_store
+import condition_names
+import recommender_engine
+
+parser = argparse.ArgumentParser(description='Build the treatment distance table for each condition')
+parser.add_argument('datafile')
+parser.add_argument('modeldir')
+parser.add_argument('distance_metric', nargs='?', default='cosine', choices=['cosine', 'pearson'])
+parser.add_argument('threshold', nargs='?', default=0.05, type=float)
+parser.add_argument('--workers', default=1, type=int, help='number of conditions to train at the same time')
+parser.add_argument('--format', default='csv', choices=['csv', 'binary', 'both'],
+                    help='write a CSV per condition, a single binary model file, or both')
+parser.add_argument('--top-k', default=10, type=int, help='closest treatments to keep per treatment in the neighbour index')
+parser.add_argument('--stats', help='directory to keep each condition\'s pair statistics in, needed for --delta')
+parser.add_argument('--delta', help='file of new or changed effectiveness rows, only the conditions it touches are retrained')
+parser.add_argument('--write-merged', help='with --delta, where to write the effectiveness data with the delta applied')
+parser.add_argument('--trace', help='append timing spans and counters to this file as JSON lines')
+parser.add_argument('--profile', help='directory to keep a cProfile file per condition in')
+parser.add_argument('--trace-memory', action='store_true', help='record the memory each condition takes')
+parser.add_argument('--conditions-list', default=condition_names.CONDITIONS_LIST,
+                    help='conditions list to canonicalize condition names with')
+args = parser.parse_args()
+if args.delta and not args.stats:
+    parser.error("--delta needs the --stats directory of an earlier run")
+if args.stats and not os.path.isdir(args.stats):
+    os.makedirs(args.stats)
+if args.trace or args.profile or args.trace_memory:
+    instrumentation.configure(args.trace, args.profile, args.trace_memory)
+
+KEY = ['user_id', 'condition', 'treatment']
+
+file = args.datafile
+modeldir = args.modeldir
+distance_metric = args.distance_metric
+threshold = args.threshold
+
+def train_condition(condition):
     print "finding table for " + condition
-    #get a list of all treatments/tags that have been reported at the same time as this condition
-    treatments = list(set(df[df['condition'] == condition]['treatment']))
+    started = time.time()
+    with instrumentation.span('condition', condition=condition), instrumentation.profile('condition', condition):
+        result = train_tables(condition)
+    return (condition, time.time() - started) + result
+
+def train_tables(condition):
+    #every treatment/tag that has been reported at the same time as this condition, compared pairwise in one pass
+    with instrumentation.span('filter'):
+        rows = df.take(condition_rows[condition])
+        treatments = recommender_engine.condition_treatments(rows)
+        instrumentation.count('rows scanned', len(rows))
+    with instrumentation.span('pairs'):
+        stats_path = recommender_engine.statistics_path(args.stats, condition) if args.stats else None
+        if condition in changed_users and os.path.exists(stats_path):
+            users = changed_users[condition]
+            old_rows = base.take(base_condition_rows.get(condition, []))
+            old_rows = old_rows[old_rows['user_id'].isin(users)]
+            new_rows = rows[rows['user_id'].isin(users)]
+            saved = recommender_engine.load_statistics(stats_path, treatments)
+            stats = recommender_engine.update_statistics(saved, treatments, old_rows, new_rows)
+        else:
+            stats = recommender_engine.condition_statistics(rows, treatments)
+        if stats_path:
+            recommender_engine.save_statistics(stats_path, treatments, stats)
+    with instrumentation.span('distances'):
+        distances = recommender_engine.distance_matrix(stats, distance_metric, threshold)
+        if instrumentation.enabled():
+            pairs = len(treatments) * (len(treatments) - 1) // 2
+            instrumentation.count('pairs evaluated', pairs)
+            instrumentation.count('nan pairs skipped', int(np.isnan(distances[np.triu_indices(len(treatments), 1)]).sum()))
+    with instrumentation.span('write'):
+        if args.format != 'binary':
+            result = recommender_engine.distance_table(distances, treatments)
+            result.to_csv(recommender_engine.model_path(modeldir, condition, distance_metric), index=False)
+        name = recommender_engine.model_name(condition)
+        model = None
+        if args.format != 'csv':
+            model = (name, treatments, model_store.table_rows(distances))
+        neighbours = None
+        if args.top_k > 0:
+            neighbours = (name, treatments, model_store.top_neighbours(distances, distance_metric, args.top_k))
+    return model, neighbours
+
+def format_seconds(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "%d:%02d:%02d" % (hours, minutes, seconds)
+
+conditions_index = condition_names.index(args.conditions_list)
+with instrumentation.span('load', file=file):
+    df = condition_names.canonicalized(pd.read_csv(file), conditions_index)
+    instrumentation.count('rows loaded', len(df))
+
+#the users whose rows changed in each condition the delta touches
+changed_users = {}
+if args.delta:
+    if args.top_k > 0 and os.path.exists(model_store.neighbours_path(modeldir, distance_metric)):
+        k = model_store.open_neighbours(model_store.neighbours_path(modeldir, distance_metric)).header['k']
+        if k != args.top_k:
+            print "the neighbour index was built with --top-k %d, use the same value or retrain everything" % k
+            quit()
+    if not condition_names.same_list(condition_names.models_list(modeldir), args.conditions_list):
+        print "the models were trained with a different conditions list, use the same one or retrain everything"
+        quit()
+    delta = condition_names.canonicalized(pd.read_csv(args.delta), conditions_index).drop_duplicates(KEY, keep='last')
+    base = df
+    base_condition_rows = conditions_index.rows(base['condition'])
+    replaced = pd.MultiIndex.from_arrays([base[column] for column in KEY]).isin(
+        pd.MultiIndex.from_arrays([delta[column] for column in KEY]))
+    df = pd.concat([base[~replaced], delta[base.columns]], ignore_index=True)
+    changed_users = dict((condition, set(delta['user_id'].values[rows]))
+                         for condition, rows in conditions_index.rows(delta['condition']).items())
+    if args.write_merged:
+        df.to_csv(args.write_merged, index=False)
+
+#row positions of each condition, the workers slice the shared DataFrame with these
+condition_rows = conditions_index.rows(df['condition'])
+conditions = sorted(condition_rows, key=lambda condition: len(condition_rows[condition]), reverse=True)
+if args.delta:
+    conditions = [condition for condition in conditions if condition in changed_users]
 
-    #empty dataframe with each treatment/tag as a column, will fill with each treatment/tag as a row to make square matrix
-    result = pd.DataFrame(columns=treatments)
+#rows are a rough measure of how long a condition takes, use them to estimate the time remaining
+total_rows = float(sum(len(condition_rows[condition]) for condition in conditions))
+finished_rows = 0
+models = []
+neighbours = []
+started = time.time()
 
-    for treatment in treatments:
-        #the list of all users that have reported both the condition and target treatment
-        affected_users = list(set(df[(df['treatment'] == treatment) & (df['condition'] == condition)]['user_id']))
-        affected_rows = df[(df['user_id'].isin(affected_users)) & (df['condition'] == condition)]
+if args.workers > 1:
+    pool = multiprocessing.Pool(args.workers)
+    results = pool.imap_unordered(train_condition, conditions)
+else:
+    results = (train_condition(condition) for condition in conditions)
 
-        other_treatments = affected_rows[affected_rows['treatment'] != treatment]['treatment']
-        distances = find_distances(affected_rows, treatment, other_treatments, condition)
-        result = result.append(distances, ignore_index=True)
+for finished, (condition, seconds, model, condition_neighbours) in enumerate(results, 1):
+    finished_rows += len(condition_rows[condition])
+    if model is not None:
+        models.append(model)
+    if condition_neighbours is not None:
+        neighbours.append(condition_neighbours)
+    elapsed = time.time() - started
+    eta = elapsed / finished_rows * (total_rows - finished_rows)
+    print "finished %s in %.2fs (%d/%d conditions, eta %s)" % (condition, seconds, finished, len(conditions), format_seconds(eta))
 
-    result.to_csv(modeldir + '/' + condition.replace('/', '').replace("\n","").replace("\r","") + "_" + distance_metric + ".csv", index=False)
\ No newline at end of file
+if args.workers > 1:
+    pool.close()
+    pool.join()
+#with --delta only the retrained conditions are replaced in the existing files
+with instrumentation.span('write models'):
+    if args.format != 'csv':
+        path = model_store.store_path(modeldir, distance_metric)
+        existing = []
+        if args.delta and os.path.exists(path):
+            existing = model_store.store_conditions(model_store.open_store(path))
+        model_store.write_store(path, distance_metric, model_store.replace_conditions(existing, models))
+    if args.top_k > 0:
+        path = model_store.neighbours_path(modeldir, distance_metric)
+        existing = []
+        if args.delta and os.path.exists(path):
+            existing = model_store.neighbour_conditions(model_store.open_neighbours(path))
+        model_store.write_neighbours(path, distance_metric, args.top_k, model_store.replace_conditions(existing, neighbours))
+    condition_names.record_list(modeldir, args.conditions_list)
+print "trained %d conditions in %s" % (len(conditions), format_seconds(time.time() - started))
@@ -0,0 +1,223 @@
+### Usage: python synthetic_data.py outfile [--rows 100000] [--seed 0] [--effectiveness effectiveness.csv]
+###                                         [--conditions-list conditions_list.csv]
+### Example: python synthetic_data.py synthetic_trackables.csv --rows 1000000 --effectiveness synthetic_effectiveness.csv
+
+### Writes a made up trackable export in the layout of the real one (user_id, age, sex, country, checkin_date,
+### trackable_id, trackable_type, trackable_name, trackable_value), for benchmarking and trying the scripts without the
+### real data, which can't be shared.  Any number of rows from ten thousand to tens of millions, written a few
+### thousand users at a time so memory doesn't grow with the size.
+
+### The distributions have the real export's long tails: which conditions, symptoms, treatments and tags a user reports
+### are drawn from Zipf distributions over their vocabularies, so a few are reported by most users and most by very
+### few, and how many days users check in for is geometric, most give up after a few days and some log for a year.
+### The conditions are the names in app-engine-service/conditions_list.csv, most reported first, so find_stats.py's
+### synonym matching has something to match.  Conditions and symptoms are logged with a 0-4 severity, which the
+### treatments a user takes that day move up or down by an effect of their own, so treatment_effectiveness.py has
+### something to find.  Treatments are logged with a dose now and then, tags without a value.
+
+### --effectiveness also writes the effectiveness.csv layout recommender_train.py reads, for the same users: for each
+### condition or symptom and treatment a user logged, the mean severity on the days without the treatment and on the
+### days with it, with a t-test of the two.  That's a plain before/after rather than treatment_effectiveness.py's
+### windows, enough to train and benchmark the recommender on without running the effectiveness step first.
+
+import argparse
+import os
+import numpy as np
+import pandas as pd
+import treatment_effectiveness
+
+COLUMNS = ['user_id', 'age', 'sex', 'country', 'checkin_date', 'trackable_id', 'trackable_type', 'trackable_name',
+           'trackable_value']
+CONDITIONS_LIST = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app-engine-service', 'conditions_list.csv')
+
+SYMPTOMS = ['Fatigue', 'Headache', 'Anxiety', 'Depression', 'Nausea', 'Brain fog', 'Joint pain', 'Insomnia',
+            'Abdominal pain', 'Back pain', 'Dizziness', 'Bloating', 'Muscle pain', 'Diarrhea', 'Constipation',
+            'Stiffness', 'Irritability', 'Migraine', 'Neck pain', 'Numbness']
+TREATMENTS = ['Ibuprofen', 'Prednisone', 'Gabapentin', 'Vitamin D', 'Fish oil', 'Magnesium', 'Yoga', 'Meditation',
+              'Tramadol', 'Cymbalta', 'Lyrica', 'Omeprazole', 'Melatonin', 'Probiotic', 'Acupuncture',
+              'Physical therapy', 'Zofran', 'Armodafinil', 'Humira', 'Acetaminophen']
+TAGS = ['tired', 'stressed', 'alcohol', 'Coffee', 'exercise', 'good sleep', 'bad sleep', 'period', 'travel',
+        'gluten', 'dairy', 'sugar', 'rain', 'walk', 'work', 'hot weather']
+#how many names each type has beyond the ones above
+TAIL_SIZES = {'Symptom': 1000, 'Treatment': 3000, 'Tag': 2000}
+#how many of each type a user reports, at least one and on average about this many more
+PER_USER = {'Condition': 1, 'Symptom': 3, 'Treatment': 2, 'Tag': 2}
+#chance that a trackable a user reports is logged on any one of their check-in days
+LOGGED = {'Condition': 0.8, 'Symptom': 0.8, 'Treatment': 0.5, 'Tag': 0.3}
+ZIPF_EXPONENT = 1.1
+MEAN_DAYS = 30
+MAX_DAYS = 730
+SEXES = ['female', 'male', 'other', 'doesnt_say']
+SEX_WEIGHTS = [0.8, 0.15, 0.02, 0.03]
+COUNTRIES = ['US', 'GB', 'CA', 'AU', 'DE', 'NL', 'SE', 'IE', 'NZ', 'FR']
+USERS_PER_CHUNK = 2000
+FIRST_DATE = np.datetime64('2015-01-01')
+DATE_RANGE = 600
+
+def zipf_weights(count):
+    weights = 1.0 / np.arange(1, count + 1) ** ZIPF_EXPONENT
+    return weights / weights.sum()
+
+#the names of every trackable type with their trackable_id and how likely a user is to report each, most likely first
+def vocabularies(conditions_list=CONDITIONS_LIST):
+    vocabularies = {}
+    if os.path.exists(conditions_list):
+        conditions = pd.read_csv(conditions_list).dropna(subset=['Condition']).drop_duplicates('Condition')
+        conditions = conditions.sort_values('Count', ascending=False)
+        vocabularies['Condition'] = (list(conditions['Condition']), list(conditions['trackable_id'].astype(int)))
+    else:
+        vocabularies['Condition'] = (['Condition %d' % i for i in range(500)], list(range(1, 501)))
+    next_id = max(vocabularies['Condition'][1]) + 1
+    for trackable_type, head in [('Symptom', SYMPTOMS), ('Treatment', TREATMENTS), ('Tag', TAGS)]:
+        names = head + ['%s %d' % (trackable_type.lower(), i) for i in range(TAIL_SIZES[trackable_type])]
+        vocabularies[trackable_type] = (names, list(range(next_id, next_id + len(names))))
+        next_id += len(names)
+    return dict((trackable_type, (names, ids, zipf_weights(len(names))))
+                for trackable_type, (names, ids) in vocabularies.items())
+
+class Generator(object):
+    def __init__(self, seed=0, conditions_list=CONDITIONS_LIST):
+        self.rng = np.random.RandomState(seed)
+        self.vocabularies = vocabularies(conditions_list)
+        #how much each treatment and tag moves severity when it's logged, most do little
+        self.effects = dict((trackable_type, self.rng.normal(0, 0.4, len(self.vocabularies[trackable_type][0])))
+                            for trackable_type in ['Treatment', 'Tag'])
+        self.next_user = 1
+
+    #the trackables one user reports, as (type, index into the type's vocabulary)
+    def user_trackables(self):
+        rng = self.rng
+        trackables = []
+        for trackable_type, mean in sorted(PER_USER.items()):
+            names, ids, weights = self.vocabularies[trackable_type]
+            count = min(1 + rng.poisson(mean), len(names))
+            for index in np.unique(rng.choice(len(names), count, p=weights)):
+                trackables.append((trackable_type, index))
+        return trackables
+
+    #one user's columns, and for --effectiveness their severities and treatments day by day
+    def user(self):
+        rng = self.rng
+        user_id = self.next_user
+        self.next_user += 1
+        days = int(min(rng.geometric(1.0 / MEAN_DAYS), MAX_DAYS))
+        span = days + rng.randint(0, days * 2 + 1)
+        day_numbers = np.sort(rng.choice(span, days, replace=False))
+        dates = FIRST_DATE + rng.randint(0, DATE_RANGE) + day_numbers
+
+        trackables = self.user_trackables()
+        types = np.array([trackable_type for trackable_type, _ in trackables])
+        logged = rng.rand(days, len(trackables)) < np.array([LOGGED[t] for t in types])
+        logged[:, types == 'Condition'] |= ~logged.any(axis=1)[:, None] #every check-in logs something
+
+        #severity is a base level for each condition and symptom, moved by that day's treatments and tags
+        rated = np.isin(types, ['Condition', 'Symptom'])
+        effects = np.array([self.effects[t][i] if t in self.effects else 0.0 for t, i in trackables])
+        day_effect = (logged * effects).sum(axis=1)
+        severity = rng.uniform(0.5, 3.5, len(trackables)) + day_effect[:, None] + rng.normal(0, 0.7, logged.shape)
+        severity = np.clip(np.round(severity), 0, 4)
+
+        day_index, trackable_index = np.nonzero(logged)
+        values = np.full(len(day_index), np.nan)
+        rated_rows = rated[trackable_index]
+        values[rated_rows] = severity[day_index[rated_rows], trackable_index[rated_rows]]
+        doses = (types[trackable_index] == 'Treatment') & (rng.rand(len(day_index)) < 0.2)
+        values[doses] = rng.choice([1, 2, 5, 10, 20, 50], doses.sum())
+
+        rows = len(day_index)
+        user = {
+            'user_id': user_id,
+            'age': rng.randint(15, 75) if rng.rand() < 0.9 else np.nan,
+            'sex': rng.choice(SEXES, p=SEX_WEIGHTS),
+            'country': COUNTRIES[min(rng.zipf(2.0) - 1, len(COUNTRIES) - 1)],
+        }
+        names = np.array([self.vocabularies[t][0][i] for t, i in trackables], dtype=object)
+        ids = np.array([self.vocabularies[t][1][i] for t, i in trackables])
+        columns = dict((column, np.repeat(value, rows)) for column, value in user.items())
+        columns.update({
+            'checkin_date': dates[day_index],
+            'trackable_id': ids[trackable_index],
+            'trackable_type': types[trackable_index],
+            'trackable_name': names[trackable_index],
+            'trackable_value': values,
+        })
+        return columns, user, names, types, logged, np.where(logged & rated, severity, np.nan)
+
+    #before/after means and t-tests of every (condition or symptom, treatment or tag) pair of one user
+    def user_effectiveness(self, user, names, types, logged, severity):
+        rated = np.isin(types, ['Condition', 'Symptom'])
+        #a name reported as both a condition and a symptom counts once, as the condition
+        rated &= ~pd.Series(names).where(rated).duplicated().values
+        rated, treated = np.nonzero(rated)[0], np.nonzero(~np.isin(types, ['Condition', 'Symptom']))[0]
+        if not len(rated) or not len(treated):
+            return None
+        values = severity[:, rated]
+        present = ~np.isnan(values)
+        values = np.where(present, values, 0)
+        on = logged[:, treated].astype(float)
+        off = 1 - on
+        #rated x treated sums over the days with and without each treatment
+        n_on, n_off = present.T.dot(on), present.T.dot(off)
+        sx_on, sx_off = values.T.dot(on), values.T.dot(off)
+        sxx_on, sxx_off = (values ** 2).T.dot(on), (values ** 2).T.dot(off)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            before, after = sx_off / n_off, sx_on / n_on
+        pvalue = treatment_effectiveness.ttestFromSums(n_on.ravel(), sx_on.ravel(), sxx_on.ravel(),
+                                                       n_off.ravel(), sx_off.ravel(), sxx_off.ravel())
+        pairs = len(rated) * len(treated)
+        columns = dict((column, np.repeat(value, pairs)) for column, value in user.items())
+        columns.update({
+            'condition': np.repeat(names[rated], len(treated)),
+            'treatment': np.tile(names[treated], len(rated)),
+            'before_value': before.ravel(), 'after_value': after.ravel(),
+            'effectiveness': (before - after).ravel(), 'pvalue': pvalue,
+        })
+        found = ~np.isnan(columns['effectiveness'])
+        return dict((column, value[found]) for column, value in columns.items())
+
+    #chunks of rows adding up to about rows (they end with a whole user), with the effectiveness of their users
+    def chunks(self, rows, effectiveness=False):
+        written = 0
+        while written < rows:
+            chunk, chunk_effectiveness = [], []
+            for _ in range(USERS_PER_CHUNK):
+                columns, user, names, types, logged, severity = self.user()
+                chunk.append(columns)
+                if effectiveness:
+                    chunk_effectiveness.append(self.user_effectiveness(user, names, types, logged, severity))
+                written += len(columns['user_id'])
+                if written >= rows:
+                    break
+            yield (concatenate(chunk, COLUMNS),
+                   concatenate(chunk_effectiveness, treatment_effectiveness.OUTPUT_COLUMNS) if effectiveness else None)
+
+#one DataFrame of dicts of column arrays
+def concatenate(parts, columns):
+    parts = [part for part in parts if part is not None]
+    return pd.DataFrame(dict((column, np.concatenate([part[column] for part in parts])) for column in columns),
+                        columns=columns)
+
+def write(outfile, rows, seed=0, effectiveness_file=None, conditions_list=CONDITIONS_LIST):
+    generator = Generator(seed, conditions_list)
+    written = effectiveness_written = 0
+    for i, (chunk, effectiveness) in enumerate(generator.chunks(rows, effectiveness_file is not None)):
+        chunk.to_csv(outfile, index=False, header=i == 0, mode='w' if i == 0 else 'a', float_format='%g')
+        written += len(chunk)
+        if effectiveness is not None:
+            effectiveness.to_csv(effectiveness_file, index=False, header=i == 0, mode='w' if i == 0 else 'a')
+            effectiveness_written += len(effectiveness)
+    return written, generator.next_user - 1, effectiveness_written
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic trackable export')
+    parser.add_argument('outfile')
+    parser.add_argument('--rows', default=100000, type=int, help='about how many rows to write')
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--effectiveness', help='also write an effectiveness file for the same users here')
+    parser.add_argument('--conditions-list', default=CONDITIONS_LIST, help='the condition names, conditions_list.csv')
+    args = parser.parse_args()
+
+    rows, users, effectiveness_rows = write(args.outfile, args.rows, args.seed, args.effectiveness, args.conditions_list)
+    print "wrote %d rows for %d users to %s" % (rows, users, args.outfile)
+    if args.effectiveness:
+        print "wrote %d effectiveness rows to %s" % (effectiveness_rows, args.effectiveness)
@@ -0,0 +1,124 @@
+### Usage: python tag_relevance.py update datafile [relevancefile]
+###        python tag_relevance.py compare datafile [relevancefile]
+### Example: python tag_relevance.py update flaredown_trackable_data_080316.csv tag_relevance.csv
+
+### The hand labelled tag_relevance.csv (columns tag, actionable) read once into a dict, for the two things done with it:
+### keeping only the tags labelled actionable, and adding the export's new tags to the file to be labelled.  A tag is
+### actionable if any of its rows has actionable "1".  New tags are appended as not actionable (0) until somebody
+### turns them on, and tags with a comma are left out since the file isn't quoted.
+
+### The actionable filter looks each distinct name up once, per category when the names are categorical, instead of
+### scanning the file for every row.  update streams the tag names out of the export chunk by chunk, adding each chunk's
+### new tags as it goes, so the export is never loaded in full.
+
+### compare times the notebook's per-row scan against the index on a sample of the export's tag rows.
+
+import argparse
+import os
+import time
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_categorical_dtype
+import trackable_loader
+
+RELEVANCE_FILE = 'tag_relevance.csv'
+
+class TagRelevance(object):
+    def __init__(self, path=RELEVANCE_FILE):
+        self.path = path
+        self.labels = {}
+        if os.path.exists(path):
+            relevance = pd.read_csv(path, dtype=str, keep_default_na=False)
+            for tag, actionable in zip(relevance['tag'], relevance['actionable']):
+                self.labels[tag] = self.labels.get(tag, False) or actionable.strip() == '1'
+        self.actionable = set(tag for tag, actionable in self.labels.items() if actionable)
+
+    def __contains__(self, tag):
+        return tag in self.labels
+
+    def __len__(self):
+        return len(self.labels)
+
+    #whether each of names is labelled actionable, as a bool array
+    def is_actionable(self, names):
+        if is_categorical_dtype(names):
+            categories = pd.Series(names.cat.categories.astype(object)).isin(self.actionable).values
+            codes = names.cat.codes.values
+            return np.where(codes >= 0, categories[codes], False)
+        return pd.Series(names).astype(object).isin(self.actionable).values
+
+    #the rows to keep: everything but the tags that aren't labelled actionable
+    def actionable_rows(self, df):
+        return (df['trackable_type'] != 'Tag').values | self.is_actionable(df['trackable_name'])
+
+    #tags that aren't in the file yet, once each in the order given
+    def unlabelled(self, tags):
+        found = []
+        seen = set()
+        for tag in tags:
+            tag = str(tag)
+            if tag not in self.labels and tag not in seen and ',' not in tag:
+                found.append(tag)
+                seen.add(tag)
+        return found
+
+    #adds the unlabelled tags to the file as not actionable, returns the ones added
+    def append(self, tags):
+        tags = self.unlabelled(tags)
+        if not tags:
+            return tags
+        new_file = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        with open(self.path, 'ab+') as outfile:
+            if new_file:
+                outfile.write("tag,actionable\n")
+            else:
+                outfile.seek(-1, os.SEEK_END)
+                if outfile.read(1) != "\n":
+                    outfile.write("\n")
+            for tag in tags:
+                outfile.write(tag + ",0\n")
+                self.labels[tag] = False
+        return tags
+
+    #adds the tags of the export that aren't in the file, streaming two of its columns
+    def update(self, datafile, chunksize=trackable_loader.CHUNKSIZE):
+        added = []
+        for chunk in trackable_loader.iter_chunks(datafile, chunksize, columns=['trackable_type', 'trackable_name']):
+            tags = chunk[chunk['trackable_type'] == 'Tag']['trackable_name'].dropna()
+            added.extend(self.append(tags.astype(object).unique()))
+        return added
+
+#the notebook's filter, scanning the labels for every row
+def scan_actionable(tags, relevance_df):
+    return tags['trackable_name'].apply(lambda x: "1" in relevance_df[relevance_df['tag'] == x]['actionable'].values)
+
+def compare(datafile, path, rows=20000):
+    tags = trackable_loader.select(datafile, lambda chunk: chunk['trackable_type'] == 'Tag',
+                                   columns=['trackable_type', 'trackable_name'])
+    tags = tags.iloc[::max(len(tags) // rows, 1)][:rows]
+
+    started = time.time()
+    relevance = TagRelevance(path)
+    indexed = relevance.is_actionable(tags['trackable_name'])
+    index_seconds = time.time() - started
+
+    started = time.time()
+    scanned = scan_actionable(tags, pd.read_csv(path, dtype=str, keep_default_na=False)).values
+    scan_seconds = time.time() - started
+    print "%d tag rows, %d labelled tags: per-row scan %.2fs, index %.4fs, %.0fx faster, %d rows differ" % (
+        len(tags), len(relevance), scan_seconds, index_seconds, scan_seconds / max(index_seconds, 1e-9),
+        (indexed != scanned).sum())
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Add new tags to the tag relevance file, or time the actionable filter')
+    parser.add_argument('command', choices=['update', 'compare'])
+    parser.add_argument('datafile')
+    parser.add_argument('relevancefile', nargs='?', default=RELEVANCE_FILE)
+    args = parser.parse_args()
+
+    if args.command == 'update':
+        relevance = TagRelevance(args.relevancefile)
+        added = relevance.update(args.datafile)
+        print "added %d new tags to %s, %d tags in all" % (len(added), args.relevancefile, len(relevance))
+    else:
+        compare(args.datafile, args.relevancefile)
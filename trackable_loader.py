@@ -0,0 +1,238 @@
+### Usage: python trackable_loader.py compare datafile
+###        python trackable_loader.py cache datafile [parquet|feather]
+### Example: python trackable_loader.py compare flaredown_trackable_data_083016.csv
+### Example: TRACKABLE_CACHE=parquet python treatment_effectiveness.py flaredown_trackable_data_083016.csv
+
+### One place that reads the raw trackable export, so the scripts stop loading it as object strings and parsing
+### checkin_date and trackable_value again each.  Columns are read with explicit dtypes: the repetitive text columns
+### (trackable_type, trackable_name, trackable_value, sex, country, trackable_id) as categoricals and age as float32.
+### checkin_date is parsed once, and value holds trackable_value as a float32 number (nan where it isn't one).
+### condition_code is the position of the canonical condition each row's trackable_name is a synonym of, -1 where it
+### isn't one, see condition_names.py; load_effectiveness adds the same for the condition column.  They are worked out
+### once per distinct name, and from the conditions list given as conditions or the repository's one.
+
+### load reads the whole export, iter_chunks streams it in typed chunks, and select keeps only the rows a filter
+### accepts while streaming, for scripts that need a single user or trackable type.
+
+### With cache='parquet' or 'feather' (or TRACKABLE_CACHE set to one of them) load keeps a columnar copy next to the
+### export, <datafile>.<format>, and reads that instead when the export hasn't changed.  The export's size and mtime
+### are kept in <datafile>.<format>.json with a sha1 of its contents: a changed size or hash rebuilds the copy, a changed
+### mtime alone only costs hashing the file.  The columnar formats need pyarrow (or fastparquet for parquet), without
+### them load reads the CSV and says so.
+
+### Categorical columns group by every category unless told otherwise, so group them with observed=True.
+
+### compare prints the load time and peak memory of reading the export as the scripts used to against the typed,
+### chunked and cached ways, each measured in a fresh process.
+
+import hashlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_categorical_dtype, union_categoricals
+import condition_names
+
+CATEGORICAL_COLUMNS = ['trackable_id', 'trackable_type', 'trackable_name', 'trackable_value', 'sex', 'country']
+DTYPES = dict([(column, 'category') for column in CATEGORICAL_COLUMNS] + [('age', np.float32)])
+EFFECTIVENESS_DTYPES = {'age': np.float32, 'sex': 'category', 'country': 'category', 'condition': 'category',
+                        'treatment': 'category'}
+CHUNKSIZE = 1000000
+CACHE_FORMATS = ['parquet', 'feather']
+CACHE = os.environ.get('TRACKABLE_CACHE') or None
+
+#trackable_value as numbers, the categories are parsed once rather than every row
+def numeric(values):
+    if not is_categorical_dtype(values):
+        return pd.to_numeric(values, errors='coerce').values.astype(np.float32)
+    parsed = pd.to_numeric(pd.Series(values.cat.categories.astype(object)), errors='coerce').values.astype(np.float32)
+    codes = values.cat.codes.values
+    return np.where(codes >= 0, parsed[codes], np.float32(np.nan))
+
+#the numeric trackable values of a loaded frame, or of one read some other way
+def numeric_values(df):
+    if 'value' in df.columns:
+        return df['value'].values
+    return numeric(df['trackable_value'])
+
+#the condition codes of the names in column, with conditions or the repository's conditions list
+def canonicalize(df, column='trackable_name', conditions=None):
+    if column in df.columns:
+        df['condition_code'] = (conditions or condition_names.index()).codes(df[column])
+    return df
+
+def parse(df, conditions=None):
+    if 'checkin_date' in df.columns:
+        df['checkin_date'] = pd.to_datetime(df['checkin_date'], cache=True)
+    if 'trackable_value' in df.columns:
+        df['value'] = numeric(df['trackable_value'])
+    return canonicalize(df, conditions=conditions)
+
+#the columns of the file to read for columns, value is parsed from trackable_value and condition_code comes from the
+#names in source
+def file_columns(columns, source='trackable_name'):
+    derived = {'value': 'trackable_value', 'condition_code': source}
+    found = [column for column in columns if column not in derived]
+    found.extend(derived[column] for column in columns if column in derived and derived[column] not in found)
+    return found
+
+def read_options(columns, dtypes, source='trackable_name'):
+    if columns is None:
+        return {'dtype': dtypes}
+    usecols = file_columns(columns, source)
+    return {'usecols': usecols, 'dtype': dict((c, t) for c, t in dtypes.items() if c in usecols)}
+
+def iter_chunks(path, chunksize=CHUNKSIZE, columns=None, conditions=None):
+    for chunk in pd.read_csv(path, chunksize=chunksize, **read_options(columns, DTYPES)):
+        yield parse(chunk, conditions)
+
+#chunks read separately have their own categories, give them all the same ones so they concatenate as categoricals
+def concat_chunks(chunks):
+    chunks = [chunk for chunk in chunks]
+    if not chunks:
+        return None
+    for column in chunks[0].columns:
+        if is_categorical_dtype(chunks[0][column]):
+            categories = union_categoricals([chunk[column] for chunk in chunks]).categories
+            for chunk in chunks:
+                chunk[column] = chunk[column].cat.set_categories(categories)
+    return pd.concat(chunks, ignore_index=True)
+
+#the rows keep(chunk) accepts, without holding the whole export in memory
+def select(path, keep, columns=None, chunksize=CHUNKSIZE, conditions=None):
+    return concat_chunks(chunk[keep(chunk)] for chunk in iter_chunks(path, chunksize, columns, conditions))
+
+def load(path, columns=None, cache=CACHE, conditions=None):
+    if cache:
+        df = read_cache(path, cache, columns)
+        if df is not None:
+            return canonicalize(df, conditions=conditions)
+        df = parse(pd.read_csv(path, **read_options(None, DTYPES)), conditions)
+        write_cache(df, path, cache)
+        return df if columns is None else df[columns]
+    return parse(pd.read_csv(path, **read_options(columns, DTYPES)), conditions)
+
+#an effectiveness file as treatment_effectiveness.py writes it
+def load_effectiveness(path, columns=None, conditions=None):
+    df = pd.read_csv(path, **read_options(columns, EFFECTIVENESS_DTYPES, 'condition'))
+    return canonicalize(df, 'condition', conditions)
+
+def cache_path(path, cache):
+    if cache not in CACHE_FORMATS:
+        raise ValueError("cache must be one of " + ', '.join(CACHE_FORMATS))
+    return path + '.' + cache
+
+def file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as infile:
+        for block in iter(lambda: infile.read(1 << 20), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+#whether the copy at cached was made from the export as it is now
+def cache_valid(path, cached):
+    if not os.path.exists(cached) or not os.path.exists(cached + '.json'):
+        return False
+    with open(cached + '.json') as infile:
+        source = json.load(infile)
+    stat = os.stat(path)
+    if source['size'] != stat.st_size:
+        return False
+    if source['mtime'] == stat.st_mtime:
+        return True
+    #touched, but maybe not changed
+    if source['sha1'] != file_hash(path):
+        return False
+    write_source(cached, path, source['sha1'])
+    return True
+
+def write_source(cached, path, sha1):
+    stat = os.stat(path)
+    with open(cached + '.json', 'w') as outfile:
+        json.dump({'size': stat.st_size, 'mtime': stat.st_mtime, 'sha1': sha1}, outfile)
+
+def read_cache(path, cache, columns=None):
+    cached = cache_path(path, cache)
+    if not cache_valid(path, cached):
+        return None
+    #the codes aren't cached, they depend on the conditions list as it is now
+    columns = file_columns(columns) if columns is not None else None
+    if cache == 'parquet':
+        df = pd.read_parquet(cached, columns=columns)
+    else:
+        df = pd.read_feather(cached, columns=columns)
+    #restore categoricals a format or engine doesn't keep
+    for column in CATEGORICAL_COLUMNS:
+        if column in df.columns and not is_categorical_dtype(df[column]):
+            df[column] = df[column].astype('category')
+    return df
+
+def write_cache(df, path, cache):
+    cached = cache_path(path, cache)
+    temporary = cached + '.tmp'
+    df = df.drop(['condition_code'], axis=1, errors='ignore')
+    try:
+        if cache == 'parquet':
+            df.to_parquet(temporary, index=False)
+        else:
+            df.reset_index(drop=True).to_feather(temporary)
+    except ImportError as error:
+        print "not caching %s: %s" % (path, error)
+        return
+    os.rename(temporary, cached)
+    write_source(cached, path, file_hash(path))
+
+#the ways compare measures, each returns the number of rows it read
+def load_objects(path):
+    df = pd.read_csv(path)
+    df['checkin_date'] = pd.to_datetime(df['checkin_date'])
+    df['trackable_value'] = pd.to_numeric(df['trackable_value'], errors='coerce')
+    return len(df)
+
+def load_typed(path):
+    return len(load(path, cache=None))
+
+def load_chunks(path):
+    return sum(len(chunk) for chunk in iter_chunks(path))
+
+def load_cached(cache):
+    return lambda path: len(load(path, cache=cache))
+
+METHODS = [('object columns', load_objects), ('typed', load_typed), ('chunked', load_chunks),
+           ('parquet cache', load_cached('parquet')), ('feather cache', load_cached('feather'))]
+
+def measure(method, path):
+    started = time.time()
+    rows = dict(METHODS)[method](path)
+    seconds = time.time() - started
+    print json.dumps({'rows': rows, 'seconds': seconds, 'peak_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0})
+
+def compare(path):
+    for cache in CACHE_FORMATS:
+        if not cache_valid(path, cache_path(path, cache)):
+            load(path, cache=cache)
+    baseline = subprocess.check_output([sys.executable, __file__, 'measure', 'typed', path, '--empty'])
+    print "%-16s %8s %10s %10s" % ('method', 'seconds', 'peak MB', 'rows')
+    print "%-16s %8s %10.1f %10s" % ('(interpreter)', '', json.loads(baseline)['peak_mb'], '')
+    for method, function in METHODS:
+        if method.endswith('cache') and not os.path.exists(cache_path(path, method.split()[0])):
+            continue
+        result = json.loads(subprocess.check_output([sys.executable, __file__, 'measure', method, path]))
+        print "%-16s %8.2f %10.1f %10d" % (method, result['seconds'], result['peak_mb'], result['rows'])
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 3 and sys.argv[1] == 'measure':
+        if '--empty' in sys.argv:
+            print json.dumps({'peak_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0})
+        else:
+            measure(sys.argv[2], sys.argv[3])
+    elif len(sys.argv) == 3 and sys.argv[1] == 'compare':
+        compare(sys.argv[2])
+    elif len(sys.argv) in (3, 4) and sys.argv[1] == 'cache':
+        load(sys.argv[2], cache=sys.argv[3] if len(sys.argv) == 4 else 'parquet')
+    else:
+        print "Usage: python trackable_loader.py <compare|cache> datafile [parquet|feather]"
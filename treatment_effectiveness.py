@@ -1,12 +1,46 @@
+### Usage: python treatment_effectiveness.py [datafile] [--output effectiveness.csv] [--welch] [--actionable-tags [tag_relevance.csv]]
+###                                          [--trace tracefile] [--profile profiledir] [--trace-memory]
+### Example: python treatment_effectiveness.py flaredown_trackable_data_083016.csv
+### Example: python treatment_effectiveness.py flaredown_trackable_data_083016.csv --output effectiveness.csv
+
+### Without --output this prints the effectiveness of a few treatments for a single user, read from the per-user day
+### arrays of day_store.py.  With --output it scores every
+### (user, treatment, symptom) combination in the trackable export at once and writes them in the effectiveness.csv
+### layout that recommender_train.py reads, with the t-test p value as an extra column.
+
+### The bulk mode gives the same answer getEffectiveness would give for each combination, without filtering the user's
+### rows per call.  Every user's check-in dates are ranked, each (user, symptom) is sorted by date once with running
+### sums of its values, and a treatment window is then two binary searches into those sums.  The sporadic case joins
+### the shifted treatment dates onto per-day symptom sums.  The t-tests are computed for all combinations at once from
+### the counts, sums and sums of squares.
+
+### With --actionable-tags only the tags labelled actionable in tag_relevance.csv are scored as treatments, as the
+### notebook does before the recommender (see tag_relevance.py).  The other tags still count as check-ins.
+
+### --trace appends a timing span for loading, each stage of the bulk scoring and writing, and counters of the rows
+### scanned, combinations scored and combinations skipped (left out for having nothing to compare), to tracefile as JSON
+### lines (see instrumentation.py).  The combination counters have their own names so that summing them with
+### recommender_train.py's treatment pair counters doesn't mix the two up.  --profile keeps a cProfile file of the
+### scoring and --trace-memory records its memory use.
+
+import argparse
+import time
 import pandas as pd
 import numpy as np
 from scipy.stats.stats import pearsonr
-from scipy.stats import ttest_ind
+from scipy.stats import ttest_ind, t as t_distribution
 import math
 import datetime
+import day_store
+import instrumentation
+import tag_relevance
+import trackable_loader
 
 PERIODICITY_THRESHOLD = 0.75 #how periodic a treatment seems to be before its considered recurring
 TIMEFRAMES = [0, 1, 2, 7] #all of the timeframes (in days) over which we compare symptom severity for sporatic tags
+TREATMENT_TYPES = ['Treatment', 'Tag'] #trackable types that are scored as treatments
+SYMPTOM_TYPES = ['Condition', 'Symptom'] #trackable types whose severity the treatments are scored against
+OUTPUT_COLUMNS = ['user_id', 'age', 'sex', 'country', 'condition', 'treatment', 'before_value', 'after_value', 'effectiveness', 'pvalue']
 
 #Attempts to determine if a treatment is periodic
 #We want to know this as there are two different ways that a treatment could be considered effective
@@ -15,80 +49,242 @@ TIMEFRAMES = [0, 1, 2, 7] #all of the timeframes (in days) over which we compare
 #There are a lot of ways to measure periodicity.  Most standard takes the Fourier transform.
 #At least for now, going with the more simple and interpretable method of taking the percentage of days that the user logged the trackable, as this takes into account
 #the fact that most users log sporatically
-def isTreatmentPeriodic(user_df, treatment_name):
-    treatment_df = user_df[(user_df['trackable_name'] == treatment_name)]
-    treatment_start_date = treatment_df['checkin_date'].min()
-    treatment_end_date = treatment_df['checkin_date'].max()
-    treatment_range = user_df[(user_df['checkin_date'] > treatment_start_date) & (user_df['checkin_date'] < treatment_end_date)]
-    percent_logged = float(len(set(treatment_range['checkin_date']))) / float(len(set(user_df['checkin_date'])))
+def isTreatmentPeriodic(user_days, treatment_name):
+    treatment_days = np.flatnonzero(user_days.logged(treatment_name))
+    percent_logged = 0.0
+    if len(treatment_days) > 0:
+        treatment_start_day, treatment_end_day = treatment_days[0], treatment_days[-1]
+        percent_logged = float(user_days.checked_in[treatment_start_day + 1:treatment_end_day].sum()) / float(user_days.checked_in.sum())
     print treatment_name + " " + str(percent_logged)
     return percent_logged > PERIODICITY_THRESHOLD
 
 #Determines if a treatment affects a symptom over a significant period of time, this method only works for treatments that are used regularily
 #Turns the duration of treatment into a window, and measures the severity of symptoms inside and outside of that window
 #See notebook for more details of how this method was arrived at
-def effectivenessInWindow(user_df, treatment_name, symptom_name):
-    treatment_df = user_df[(user_df['trackable_name'] == treatment_name)]
-    treatment_start_date = treatment_df['checkin_date'].min()
-    treatment_end_date = treatment_df['checkin_date'].max()
-    treatment_range = user_df[(user_df['checkin_date'] >= treatment_start_date) & (user_df['checkin_date'] <= treatment_end_date)]
-    no_treatment_range = user_df[(user_df['checkin_date'] < treatment_start_date) | (user_df['checkin_date'] > treatment_end_date)]
-
-    #create lists of trackable_values inside the treatment dates, outside treatment dates, and for all dates
-    treatment_values = pd.to_numeric(treatment_range[treatment_range['trackable_name'] == symptom_name]['trackable_value']).values
-    no_treatment_values = pd.to_numeric(no_treatment_range[no_treatment_range['trackable_name'] == symptom_name]['trackable_value']).values
-    population_values = pd.to_numeric(user_df[user_df['trackable_name'] == symptom_name]['trackable_value']).values
-
-    #remove nans
-    treatment_values = [x for x in treatment_values if (math.isnan(x) == False)]
-    no_treatment_values = [x for x in no_treatment_values if (math.isnan(x) == False)]
-    population_values = [x for x in population_values if (math.isnan(x) == False)]
-
-    effectiveness = np.mean(no_treatment_values) - np.mean(treatment_values)
-    tstat, pvalue = ttest_ind(treatment_values, population_values)  #best method I could think of to determine the significance of the difference of means
-    return effectiveness, pvalue
+def effectivenessInWindow(user_days, treatment_name, symptom_name):
+    treatment_days = np.flatnonzero(user_days.logged(treatment_name))
+    population_sums = user_days.trackable_sums(symptom_name)
+    population = [sums.sum() for sums in population_sums]
+
+    #split the symptom's days into the treatment window and the days outside of it
+    if len(treatment_days) > 0:
+        treatment_start_day, treatment_end_day = treatment_days[0], treatment_days[-1] + 1
+        treatment = [sums[treatment_start_day:treatment_end_day].sum() for sums in population_sums]
+    else:
+        treatment = [np.float64(0)] * 3
+    no_treatment = [total - part for total, part in zip(population, treatment)]
+
+    #the t-test is the best method I could think of to determine the significance of the difference of means
+    return meansEffectiveness(no_treatment, treatment, treatment, population)
 
 #Get a measure of the correlation between days with a treatment versus not, with a specified timedelta
-def effectivenessAtTime(user_df, treatment_name, symptom_name, timeframe):
-    treatment_df = user_df[(user_df['trackable_name'] == treatment_name)]
-    treatment_dates = treatment_df['checkin_date'].apply(lambda x: x + datetime.timedelta(days=timeframe))
-    treatment_range = user_df[(user_df['checkin_date'].isin(treatment_dates)) & (user_df['trackable_name'] == symptom_name)]
+def effectivenessAtTime(user_days, treatment_name, symptom_name, timeframe):
+    #the treatment's days moved forward by the timeframe, days past the user's last check-in fall off the end
+    treatment_days = user_days.logged(treatment_name)
+    shifted_days = np.zeros(user_days.days(), dtype=bool)
+    shifted_days[timeframe:] = treatment_days[:max(user_days.days() - timeframe, 0)]
+    treatment_range = shifted_days & user_days.logged(symptom_name)
 
     #if there aren't any days that the symptom is logged, return 0 with 0 certainty
-    if len(treatment_range) == 0:
+    if not treatment_range.any():
         return 0,0
 
-    treatment_values = pd.to_numeric(treatment_range['trackable_value']).values
-    population_values = pd.to_numeric(user_df[user_df['trackable_name'] == symptom_name]['trackable_value']).values
+    population_sums = user_days.trackable_sums(symptom_name)
+    population = [sums.sum() for sums in population_sums]
+    treatment = [sums[treatment_range].sum() for sums in population_sums]
+    return meansEffectiveness(population, treatment, treatment, population)
 
-    # remove nans
-    treatment_values = [x for x in treatment_values if (math.isnan(x) == False)]
-    population_values = [x for x in population_values if (math.isnan(x) == False)]
-
-    effectiveness = np.mean(population_values) - np.mean(treatment_values)
-    tstat, pvalue = ttest_ind(treatment_values, population_values)
-    return effectiveness, pvalue
-
-def getEffectiveness(user_df,treatment_name,symptom_name):
-    isPeriodic = isTreatmentPeriodic(user_df, treatment_name)
+#user_days is a user's days from the day store (day_store.DayStore.user)
+def getEffectiveness(user_days,treatment_name,symptom_name):
+    isPeriodic = isTreatmentPeriodic(user_days, treatment_name)
     if isPeriodic:
-        return effectivenessInWindow(user_df,treatment_name,symptom_name)
+        return effectivenessInWindow(user_days,treatment_name,symptom_name)
     else:
         for timeframe in TIMEFRAMES:
-            effectiveness, certainty = effectivenessAtTime(user_df, treatment_name, symptom_name, timeframe)
+            effectiveness, certainty = effectivenessAtTime(user_days, treatment_name, symptom_name, timeframe)
             print str(effectiveness) + " with certainty " + str(certainty) + " at time " + str(timeframe)
         return effectiveness, certainty
 
-df = pd.read_csv("flaredown_trackable_data_083016.csv")
-df['checkin_date'] = pd.to_datetime(df['checkin_date'])
+#the (user_id, trackable_name) pairs logged with any of the given types
+def userTrackables(df, types):
+    trackables = df[df['trackable_type'].isin(types)][['user_id', 'trackable_name']].drop_duplicates()
+    return trackables.astype({'trackable_name': object})
+
+#sum of squared deviations from count, sum and sum of squares, with the rounding noise of constant values taken out
+def squaredDeviations(n, sx, sxx):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ss = sxx - sx * sx / n
+        ss[ss <= 1e-12 * sxx] = 0.0
+    return ss
+
+#ttest_ind for many pairs of samples at once, each sample given by its count, sum and sum of squares
+def ttestFromSums(n1, sx1, sxx1, n2, sx2, sxx2, equal_var=True):
+    n1, n2 = n1.astype(float), n2.astype(float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        #sample variances, nan for a single value like np.var(ddof=1)
+        v1 = squaredDeviations(n1, sx1, sxx1) / (n1 - 1)
+        v2 = squaredDeviations(n2, sx2, sxx2) / (n2 - 1)
+        difference = sx1 / n1 - sx2 / n2
+        if equal_var:
+            df = n1 + n2 - 2.0
+            denominator = np.sqrt(((n1 - 1) * v1 + (n2 - 1) * v2) / df * (1.0 / n1 + 1.0 / n2))
+        else:
+            vn1, vn2 = v1 / n1, v2 / n2
+            df = (vn1 + vn2) ** 2 / (vn1 ** 2 / (n1 - 1) + vn2 ** 2 / (n2 - 1))
+            df[np.isnan(df)] = 1
+            denominator = np.sqrt(vn1 + vn2)
+        tstat = difference / denominator
+        return t_distribution.sf(np.abs(tstat), df) * 2
+
+#compareMeans for a single combination: the difference of the before and after means and the p value of ttest_ind
+#between tested and population, each sample given by its count, sum and sum of squares
+def meansEffectiveness(before, after, tested, population):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        effectiveness = before[1] / before[0] - after[1] / after[0]
+    pvalue = ttestFromSums(*[np.array([value], dtype=float) for value in tested + population])[0]
+    return effectiveness, pvalue
+
+#the mean values the effectiveness compares, effectiveness itself and the p value of the t-test
+def compareMeans(combinations, before, after, tested, population, equal_var):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        combinations['before_value'] = before[1] / before[0]
+        combinations['after_value'] = after[1] / after[0]
+    combinations['effectiveness'] = combinations['before_value'] - combinations['after_value']
+    combinations['pvalue'] = ttestFromSums(*(tested + population), equal_var=equal_var)
+    return combinations
 
-#user_df = df[df['user_id'] == '2561']
-user_df = df[df['user_id'] == 932]
-effectiveness, certainty = getEffectiveness(user_df, "alcohol", "Headache")
+#effectivenessInWindow for every periodic combination
+#sums are running sums over every (user, symptom)'s non nan values, sorted by symptom (segment) and then by day
+def windowEffectiveness(combinations, sums, totals, equal_var):
+    #the running sums are searched by (segment, day) packed into a single sorted key
+    keys = sums['segment'] * sums['days'] + sums['day']
+    segments = combinations['segment'].values
+    first = np.searchsorted(keys, segments * sums['days'] + combinations['start_day'].values, 'left')
+    last = np.searchsorted(keys, segments * sums['days'] + combinations['end_day'].values, 'right')
+
+    inside = [sums[key][last] - sums[key][first] for key in ['n', 'sx', 'sxx']]
+    population = [totals[key][segments] for key in ['n', 'sx', 'sxx']]
+    outside = [total - part for total, part in zip(population, inside)]
+    return compareMeans(combinations, outside, inside, inside, population, equal_var)
+
+#effectivenessAtTime for every sporadic combination
+def timeframeEffectiveness(combinations, treatment_rows, symptom_rows, totals, timeframe, equal_var):
+    treatment_dates = treatment_rows[['user_id', 'trackable_name', 'checkin_date']].drop_duplicates()
+    treatment_dates['checkin_date'] = treatment_dates['checkin_date'] + datetime.timedelta(days=timeframe)
+    treatment_dates.columns = ['user_id', 'treatment', 'checkin_date']
+
+    #counts and sums of each symptom per day, joined onto the shifted treatment days
+    symptom_days = symptom_rows.assign(sxx=symptom_rows['value'] ** 2).groupby(['user_id', 'trackable_name', 'checkin_date'])
+    symptom_days = pd.DataFrame({'rows': symptom_days.size(), 'n': symptom_days['value'].count(),
+                                 'sx': symptom_days['value'].sum(), 'sxx': symptom_days['sxx'].sum()}).reset_index()
+    symptom_days = symptom_days.rename(columns={'trackable_name': 'condition'})
+    shifted = treatment_dates.merge(symptom_days, on=['user_id', 'checkin_date'])
+    shifted = shifted.groupby(['user_id', 'treatment', 'condition'])[['rows', 'n', 'sx', 'sxx']].sum().reset_index()
+    combinations = combinations.merge(shifted, on=['user_id', 'treatment', 'condition'], how='left')
+    combinations[['rows', 'n', 'sx', 'sxx']] = combinations[['rows', 'n', 'sx', 'sxx']].fillna(0)
+
+    treated = [combinations[key].values for key in ['n', 'sx', 'sxx']]
+    population = [totals[key][combinations['segment'].values] for key in ['n', 'sx', 'sxx']]
+    combinations = compareMeans(combinations, population, treated, treated, population, equal_var)
+
+    #if there aren't any days that the symptom is logged, return 0 with 0 certainty
+    combinations.loc[combinations['rows'] == 0, ['effectiveness', 'pvalue']] = 0.0
+    return combinations.drop(['rows', 'n', 'sx', 'sxx'], axis=1)
+
+#getEffectiveness for every (user, treatment, symptom) in df, one row per combination
+#before_value and after_value are the two means that effectiveness is the difference of, after_value is nan where the
+#symptom has no values on the treatment's days
+#with relevance, a tag_relevance.TagRelevance, tags that aren't labelled actionable aren't scored
+def bulkEffectiveness(df, equal_var=True, relevance=None):
+    instrumentation.count('rows scanned', len(df))
+    with instrumentation.span('trackables'):
+        treatments = userTrackables(df if relevance is None else df[relevance.actionable_rows(df)], TREATMENT_TYPES)
+        symptoms = userTrackables(df, SYMPTOM_TYPES)
+        users = df.drop_duplicates('user_id')[['user_id', 'age', 'sex', 'country']]
+
+    with instrumentation.span('days'):
+        #the names are compared and grouped across frames, which categoricals with different categories can't do
+        values = trackable_loader.numeric_values(df).astype(float)
+        df = df[['user_id', 'checkin_date', 'trackable_name']].copy()
+        df['trackable_name'] = df['trackable_name'].astype(object)
+        df['value'] = values
+        df['day'] = df.groupby('user_id')['checkin_date'].rank(method='dense').astype(np.int64) - 1
+        user_days = df.groupby('user_id')['day'].max() + 1
+
+    with instrumentation.span('periodicity'):
+        #a treatment is periodic when the user logged anything on most of the days strictly between its first and last day
+        treatment_rows = df.merge(treatments, on=['user_id', 'trackable_name'])
+        spans = treatment_rows.groupby(['user_id', 'trackable_name'])['day'].agg(['min', 'max']).reset_index()
+        spans.columns = ['user_id', 'treatment', 'start_day', 'end_day']
+        between = np.maximum(spans['end_day'] - spans['start_day'] - 1, 0)
+        spans['periodic'] = between.values.astype(float) / user_days.reindex(spans['user_id']).values > PERIODICITY_THRESHOLD
+
+    with instrumentation.span('segments'):
+        #each (user, symptom) is a segment of the rows sorted by user, symptom and day
+        symptom_rows = df.merge(symptoms, on=['user_id', 'trackable_name']).sort_values(['user_id', 'trackable_name', 'day'])
+        symptom_rows['segment'] = symptom_rows.groupby(['user_id', 'trackable_name']).ngroup().values
+        segments = symptom_rows.drop_duplicates('segment')[['user_id', 'trackable_name', 'segment']]
+        segments.columns = ['user_id', 'condition', 'segment']
+
+        logged = symptom_rows[pd.notnull(symptom_rows['value'])]
+        values = logged['value'].values
+        sums = {'segment': logged['segment'].values, 'day': logged['day'].values, 'days': df['day'].max() + 1}
+        for key, column in [('n', np.ones(len(values))), ('sx', values), ('sxx', values * values)]:
+            sums[key] = np.concatenate([[0.0], np.cumsum(column)])
+        starts = np.searchsorted(sums['segment'], np.arange(len(segments) + 1))
+        totals = dict((key, sums[key][starts[1:]] - sums[key][starts[:-1]]) for key in ['n', 'sx', 'sxx'])
+
+    combinations = spans.merge(segments, on='user_id')
+    combinations = combinations[combinations['treatment'] != combinations['condition']]
+    instrumentation.count('combinations scored', len(combinations))
+    with instrumentation.span('periodic windows'):
+        periodic = windowEffectiveness(combinations[combinations['periodic']].copy(), sums, totals, equal_var)
+    with instrumentation.span('sporadic timeframes'):
+        sporadic = timeframeEffectiveness(combinations[~combinations['periodic']].copy(), treatment_rows, symptom_rows,
+                                          totals, TIMEFRAMES[-1], equal_var)
+
+    with instrumentation.span('join'):
+        effectiveness = pd.concat([periodic, sporadic], ignore_index=True).merge(users, on='user_id')
+        effectiveness = effectiveness.sort_values(['user_id', 'condition', 'treatment']).reset_index(drop=True)
+    return effectiveness[OUTPUT_COLUMNS + ['periodic']]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure how treatments affect the symptoms users log with them')
+    parser.add_argument('datafile', nargs='?', default='flaredown_trackable_data_083016.csv')
+    parser.add_argument('--output', help='score every user, treatment and symptom and write them to this csv file')
+    parser.add_argument('--welch', action='store_true', help='use Welch\'s t-test rather than Student\'s')
+    parser.add_argument('--actionable-tags', nargs='?', const=tag_relevance.RELEVANCE_FILE, metavar='RELEVANCEFILE',
+                        help='only score the tags labelled actionable in this file as treatments')
+    parser.add_argument('--trace', help='append timing spans and counters to this file as JSON lines')
+    parser.add_argument('--profile', help='directory to keep a cProfile file of the scoring in')
+    parser.add_argument('--trace-memory', action='store_true', help='record the memory the scoring takes')
+    args = parser.parse_args()
+    if args.trace or args.profile or args.trace_memory:
+        instrumentation.configure(args.trace, args.profile, args.trace_memory)
+
+    with instrumentation.span('load', file=args.datafile):
+        df = trackable_loader.load(args.datafile)
+
+    if args.output:
+        started = time.time()
+        relevance = tag_relevance.TagRelevance(args.actionable_tags) if args.actionable_tags else None
+        with instrumentation.span('effectiveness'), instrumentation.profile('effectiveness'):
+            effectiveness = bulkEffectiveness(df, equal_var=not args.welch, relevance=relevance)
+        with instrumentation.span('write output', file=args.output):
+            #leave out combinations with nothing to compare
+            compared = pd.notnull(effectiveness['effectiveness']) & pd.notnull(effectiveness['after_value'])
+            instrumentation.count('combinations skipped', int((~compared).sum()))
+            effectiveness = effectiveness[compared]
+            effectiveness[OUTPUT_COLUMNS].to_csv(args.output, index=False)
+        print "wrote %d rows for %d users in %.2fs" % (len(effectiveness), effectiveness['user_id'].nunique(), time.time() - started)
+    else:
+        #user_days = store.user('2561')
+        user_days = day_store.from_frame(df[df['user_id'] == 932]).user(932)
+        effectiveness, certainty = getEffectiveness(user_days, "alcohol", "Headache")
 
 
-effectiveness, certainty = getEffectiveness(user_df, "Armodafinil", "Headache")
-print str(effectiveness) + " with certainty " + str(certainty)
+        effectiveness, certainty = getEffectiveness(user_days, "Armodafinil", "Headache")
+        print str(effectiveness) + " with certainty " + str(certainty)
 
-effectiveness, certainty = getEffectiveness(user_df, "Armodafinil", "Fatigue")
-print str(effectiveness) + " with certainty " + str(certainty)
\ No newline at end of file
+        effectiveness, certainty = getEffectiveness(user_days, "Armodafinil", "Fatigue")
+        print str(effectiveness) + " with certainty " + str(certainty)
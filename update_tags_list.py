@@ -5,15 +5,9 @@
 ## Running this file will add any new tags to the file, which will then need to be hand labelled.
 ## Since most tags are not actionable, I'm defaulting them to off(0) until somebody comes and turns them on
 
-import pandas as pd
+import tag_relevance
 
-df = pd.read_csv("flaredown_trackable_data_080316.csv")
-
-tags = list(set(df[df['trackable_type'] == 'Tag']['trackable_name']))
-relevance = pd.read_csv("tag_relevance.csv")
-existing_tags = list(set(relevance['tag']))
-outfile = open('tag_relevance.csv', 'a')
-print existing_tags
-for tag in tags:
-    if (tag not in existing_tags) and (not ',' in str(tag)):
-        outfile.write(str(tag) + ",0\n")
\ No newline at end of file
+#streams the tag names out of the export, see tag_relevance.py
+relevance = tag_relevance.TagRelevance("tag_relevance.csv")
+added = relevance.update("flaredown_trackable_data_080316.csv")
+print "added %d new tags to label: %s" % (len(added), ', '.join(added))
@@ -0,0 +1,416 @@
+### Usage: python user_recommender.py build datafile modeldir [--components 32] [--exact-limit 50000]
+###                                          [--conditions-list conditions_list.csv]
+###        python user_recommender.py predict testfile modeldir [--k 10] [--clusters clusters/clusters.model]
+###        python user_recommender.py benchmark datafile [--scale 10] [--queries 500] [--k 10] [--exact-limit 50000]
+### Example: python user_recommender.py build effectiveness_083016.csv models
+### Example: python user_recommender.py predict test_user_1.csv models
+### Example: python user_recommender.py benchmark effectiveness_083016.csv --scale 10 --exact-limit 2000
+
+### User based recommendations: the users most like this one with the same condition, and the effectiveness they found
+### in the treatments this user hasn't tried.  The recommender_system notebook found this (KNeighborsRegressor over a
+### user x treatment pivot of effectiveness plus one-hot sex and country) does better than the treatment to treatment
+### distances of recommender_predict.py, but refit it with a grid search for the single treatment "good sleep".
+
+### build makes every condition's user vectors once and keeps them in modeldir/users.model, in model_store.py's memory
+### mapped container: for each user of the condition a sparse row of their effectiveness per treatment (the mean when a
+### treatment was scored more than once, untried treatments are zero as in the notebook's fillna(0)) followed by
+### their one-hot sex and country.  Users are compared by cosine similarity of those rows.
+### Conditions with up to --exact-limit users are searched exactly, one sparse product against every user.  Bigger
+### conditions also keep each user's vector reduced to --components dimensions (truncated SVD) and normalised, where
+### euclidean distance orders neighbours like cosine, and a KD-tree over them, built when the condition is first
+### queried, gives CANDIDATES times k candidates that are then ranked by their exact similarity.  A condition with
+### too few treatment and profile columns for --components keeps one less dimension than it has columns.  The exact
+### search is a single sparse matrix-vector product and stays around a millisecond at ten times today's users (25
+### thousand users of one condition), faster than the tree and without its missed neighbours, so the default limit
+### leaves the tree for conditions far bigger than any there are now.
+
+### predict takes a single user's effectiveness rows like recommender_predict.py.  For each of their conditions the k
+### most similar users are found and every treatment is predicted at once as the similarity weighted mean of the
+### neighbours that tried it, and the untried treatment predicted to help most and the one predicted to hurt most are
+### printed.  Treatments fewer than MIN_NEIGHBOURS of the neighbours tried aren't predicted.  With --clusters (written by
+### cluster_patients.py from the same effectiveness file) only the users in the clusters nearest the user are
+### compared, a cheap pre-filter for the biggest conditions.
+
+### benchmark grows an effectiveness file to --scale times its users, copies of the users with their scores jittered,
+### then times build and the latency of --queries queries for users of the biggest conditions, exactly and through
+### the tree for the conditions over --exact-limit, with how many of the exact neighbours the tree found.  The index
+### is built in a temporary directory.
+
+### Condition names are replaced by their canonical names from --conditions-list (see condition_names.py) as the data
+### is read, the way recommender_train.py trains its models, and build keeps the list in modeldir.  predict
+### canonicalizes the user's rows with the list modeldir was built with.
+
+import argparse
+import shutil
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.sparse.linalg import svds
+from scipy.spatial import cKDTree
+import condition_names
+import model_store
+import recommender_engine
+
+PROFILE_COLUMNS = ['sex', 'country']
+COMPONENTS = 32
+EXACT_LIMIT = 50000
+CANDIDATES = 8 #tree candidates per neighbour wanted, re-ranked exactly
+K = 10
+MIN_NEIGHBOURS = 2 #a treatment only one similar user tried is left unpredicted
+
+def index_path(modeldir):
+    return modeldir + '/users.model'
+
+#the one-hot profile columns, 'sex=female', 'country=US'...
+def profile_vocabulary(df):
+    users = df.drop_duplicates('user_id')
+    return ['%s=%s' % (column, value) for column in PROFILE_COLUMNS
+            for value in sorted(users[column].dropna().astype(str).unique())]
+
+#each user's profile columns as positions in vocabulary, -1 where unknown
+def profile_codes(users, vocabulary):
+    positions = pd.Index(vocabulary)
+    return np.column_stack([positions.get_indexer(column + '=' + users[column].astype(str)) for column in PROFILE_COLUMNS]
+                           ).astype(np.int32)
+
+#users, treatments and the users x treatments effectiveness of one condition's mean scores
+def condition_ratings(means):
+    user_index, users = pd.factorize(means['user_id'], sort=True)
+    treatment_index, treatments = pd.factorize(means['treatment'], sort=True)
+    ratings = sparse.csr_matrix((means['effectiveness'].values, (user_index, treatment_index)),
+                                shape=(len(users), len(treatments)))
+    ratings.sort_indices()
+    return np.asarray(users), list(treatments), ratings
+
+#rows of effectiveness then one-hot profile, each scaled to unit length
+def user_vectors(ratings, codes, profile_size):
+    rows = np.repeat(np.arange(len(codes)), codes.shape[1])
+    known = codes.ravel() >= 0
+    profile = sparse.csr_matrix((np.ones(known.sum()), (rows[known], codes.ravel()[known])),
+                                shape=(len(codes), profile_size))
+    vectors = sparse.hstack([ratings, profile], format='csr')
+    norms = np.sqrt(np.asarray(vectors.multiply(vectors).sum(axis=1)).ravel())
+    norms[norms == 0] = 1.0
+    return sparse.diags(1.0 / norms).dot(vectors).tocsr()
+
+#coordinates of the vectors in their first components singular directions, and the projection that gives them
+def reduce(vectors, components):
+    components = min(components, min(vectors.shape) - 1)
+    if components < 1:
+        #too small to reduce, it is searched exactly
+        return np.zeros((0, 0), dtype=np.float32), np.zeros((0, vectors.shape[1]), dtype=np.float32)
+    _, _, projection = svds(vectors, k=components)
+    coordinates = vectors.dot(projection.T)
+    return normalize(coordinates).astype(np.float32), projection.astype(np.float32)
+
+def normalize(coordinates):
+    norms = np.sqrt((coordinates * coordinates).sum(axis=-1, keepdims=True))
+    return coordinates / np.where(norms == 0, 1.0, norms)
+
+def build(df, path, components=COMPONENTS, exact_limit=EXACT_LIMIT):
+    vocabulary = profile_vocabulary(df)
+    profiles = df.drop_duplicates('user_id').sort_values('user_id')
+    all_codes = profile_codes(profiles, vocabulary)
+    scored = df[pd.notnull(df['effectiveness'])]
+    means = scored.groupby(['condition', 'user_id', 'treatment'])['effectiveness'].mean().reset_index()
+    names, condition_treatments = [], []
+    user_ids, codes, indptr, indices, values = [], [], [], [], []
+    user_offsets, coordinates, coordinate_offsets, projections, projection_offsets = [0], [], [0], [], [0]
+    condition_components = []
+    entries = 0
+    for condition, positions in sorted(means.groupby('condition').indices.items()):
+        users, treatments, ratings = condition_ratings(means.take(positions))
+        user_codes = all_codes[np.searchsorted(profiles['user_id'].values, users)]
+        names.append(recommender_engine.model_name(condition))
+        condition_treatments.append(treatments)
+        user_ids.append(users)
+        codes.append(user_codes)
+        indptr.append(ratings.indptr[:-1] + entries)
+        indices.append(ratings.indices)
+        values.append(ratings.data)
+        entries += ratings.nnz
+        user_offsets.append(user_offsets[-1] + len(users))
+        #small conditions are searched exactly and keep no coordinates
+        if len(users) > exact_limit:
+            condition_coordinates, projection = reduce(user_vectors(ratings, user_codes, len(vocabulary)), components)
+        else:
+            condition_coordinates, projection = np.zeros((0, 0), dtype=np.float32), np.zeros((0, 0), dtype=np.float32)
+        condition_components.append(len(projection))
+        coordinates.append(np.pad(condition_coordinates, ((0, 0), (0, components - len(projection))), 'constant'))
+        projections.append(projection.ravel())
+        coordinate_offsets.append(coordinate_offsets[-1] + len(coordinates[-1]))
+        projection_offsets.append(projection_offsets[-1] + len(projections[-1]))
+
+    arrays = model_store.condition_arrays(names, condition_treatments)
+    arrays['profile_names_blob'], arrays['profile_names_offsets'] = model_store.pack_names(vocabulary)
+    arrays['user_offsets'] = np.asarray(user_offsets, dtype=np.int64)
+    arrays['user_ids'] = np.concatenate(user_ids).astype(np.int64)
+    arrays['profile_codes'] = np.concatenate(codes)
+    arrays['indptr'] = np.concatenate(indptr + [[entries]]).astype(np.int64)
+    arrays['indices'] = np.concatenate(indices).astype(np.int32)
+    arrays['values'] = np.concatenate(values).astype(np.float32)
+    #coordinates have a row per user of the conditions with a tree, padded to --components for the conditions that
+    #keep fewer, projections are each condition's flattened components x (treatments + profile) matrix
+    arrays['components'] = np.asarray(condition_components, dtype=np.int32)
+    arrays['coordinate_offsets'] = np.asarray(coordinate_offsets, dtype=np.int64)
+    arrays['coordinates'] = np.concatenate(coordinates)
+    arrays['projection_offsets'] = np.asarray(projection_offsets, dtype=np.int64)
+    arrays['projections'] = np.concatenate(projections)
+    model_store.write_arrays(path, {'kind': 'users', 'components': components}, arrays)
+    return len(names), len(arrays['user_ids'])
+
+class UserIndex(model_store.ModelStore):
+    def __init__(self, path):
+        header, self.arrays = model_store.read_arrays(path)
+        self.path = path
+        self.header = header
+        self.treatment_names = model_store.unpack_names(self.arrays['treatment_names_blob'],
+                                                        self.arrays['treatment_names_offsets'])
+        self.profile_names = model_store.unpack_names(self.arrays['profile_names_blob'],
+                                                      self.arrays['profile_names_offsets'])
+        self.condition_index = dict((name, i) for i, name in enumerate(
+            model_store.unpack_names(self.arrays['condition_names_blob'], self.arrays['condition_names_offsets'])))
+        self.models = {}
+
+    def condition_model(self, i):
+        return ConditionUsers(self, i)
+
+    #a user's profile as positions in the profile columns, like profile_codes
+    def profile(self, user):
+        return profile_codes(pd.DataFrame([user]), self.profile_names)[0]
+
+#the entries of a few rows of a csr matrix as (which of positions, column, value), without scipy's row indexing,
+#which builds a selection matrix and multiplies by it
+def row_entries(matrix, positions):
+    starts, ends = matrix.indptr[positions], matrix.indptr[np.asarray(positions) + 1]
+    lengths = ends - starts
+    entries = np.repeat(starts - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths) + np.arange(lengths.sum())
+    return np.repeat(np.arange(len(positions)), lengths), matrix.indices[entries], matrix.data[entries]
+
+class ConditionUsers(object):
+    def __init__(self, index, i):
+        arrays = index.arrays
+        self.treatments, _ = index.condition_treatments(i)
+        self.treatment_index = dict((treatment, t) for t, treatment in enumerate(self.treatments))
+        self.profile_size = len(index.profile_names)
+        start, end = arrays['user_offsets'][i], arrays['user_offsets'][i + 1]
+        self.user_ids = arrays['user_ids'][start:end]
+        self.codes = arrays['profile_codes'][start:end]
+        indptr = arrays['indptr'][start:end + 1]
+        self.ratings = sparse.csr_matrix((arrays['values'][indptr[0]:indptr[-1]], arrays['indices'][indptr[0]:indptr[-1]],
+                                          indptr - indptr[0]), shape=(len(self.user_ids), len(self.treatments)))
+        self.vectors = user_vectors(self.ratings, self.codes, self.profile_size)
+
+        components = arrays['components'][i]
+        start, end = arrays['coordinate_offsets'][i], arrays['coordinate_offsets'][i + 1]
+        self.coordinates = arrays['coordinates'][start:end, :components]
+        start, end = arrays['projection_offsets'][i], arrays['projection_offsets'][i + 1]
+        self.projection = arrays['projections'][start:end].reshape(components, self.vectors.shape[1])
+        self.tree = None
+        self.partitioned = None
+
+    #the unit length vector of a user with these treatment: effectiveness scores and profile codes
+    def query_vector(self, scores, codes):
+        columns = [self.treatment_index[treatment] for treatment in scores if treatment in self.treatment_index]
+        data = [scores[self.treatments[column]] for column in columns]
+        known = [len(self.treatments) + code for code in codes if code >= 0]
+        vector = np.zeros(self.vectors.shape[1])
+        vector[columns] = data
+        vector[known] = 1.0
+        norm = np.sqrt(vector.dot(vector))
+        return vector / norm if norm else vector
+
+    def approximate(self):
+        return len(self.coordinates) > 0
+
+    #positions and similarities of the k most similar users, most similar first, leaving out the user exclude
+    #with clusters, a cluster_patients.ConditionClusters and the numbers of some of its clusters, only the users in
+    #those clusters are compared
+    def neighbours(self, vector, k=K, exclude=None, exact=False, clusters=None):
+        if clusters is not None:
+            members, vectors = self.partition(clusters[0])
+            candidates = np.concatenate([members[c] for c in clusters[1]])
+            similarities = np.concatenate([vectors[c].dot(vector) for c in clusters[1]])
+        elif exact or not self.approximate():
+            candidates = np.arange(len(self.user_ids))
+            similarities = self.vectors.dot(vector)
+        else:
+            if self.tree is None:
+                self.tree = cKDTree(self.coordinates)
+            point = normalize(self.projection.dot(vector))
+            count = min(k * CANDIDATES + 1, len(self.user_ids))
+            _, candidates = self.tree.query(point, k=count)
+            candidates = np.atleast_1d(candidates)
+            rows, columns, values = row_entries(self.vectors, candidates)
+            similarities = np.bincount(rows, weights=values * vector[columns], minlength=len(candidates))
+        if exclude is not None:
+            similarities[self.user_ids[candidates] == exclude] = -np.inf
+        found = min(k, int(np.isfinite(similarities).sum()))
+        if not found:
+            return candidates[:0], similarities[:0]
+        best = np.argpartition(-similarities, found - 1)[:found]
+        best = best[np.argsort(-similarities[best], kind='mergesort')]
+        return candidates[best], similarities[best]
+
+    #the positions and vectors of the users of each cluster, made the first time the clusters are used
+    def partition(self, condition_clusters):
+        if self.partitioned is None or self.partitioned[0] is not condition_clusters:
+            labels = np.full(len(self.user_ids), -1)
+            positions = np.minimum(np.searchsorted(self.user_ids, condition_clusters.user_ids), len(self.user_ids) - 1)
+            found = self.user_ids[positions] == condition_clusters.user_ids
+            labels[positions[found]] = condition_clusters.labels[found]
+            order = np.argsort(labels, kind='mergesort')
+            bounds = np.searchsorted(labels[order], np.arange(len(condition_clusters.centers) + 1))
+            vectors = self.vectors[order]
+            self.partitioned = (condition_clusters, (
+                [order[bounds[c]:bounds[c + 1]] for c in range(len(bounds) - 1)],
+                [vectors[bounds[c]:bounds[c + 1]] for c in range(len(bounds) - 1)]))
+        return self.partitioned[1]
+
+    #every treatment's predicted effectiveness as the similarity weighted mean of the neighbours that tried it, and
+    #how many did, nan where none did
+    def predict(self, positions, similarities):
+        weights = np.maximum(similarities, 0)
+        if not weights.any():
+            weights = np.ones(len(positions))
+        rows, columns, values = row_entries(self.ratings, positions)
+        size = len(self.treatments)
+        totals = np.bincount(columns, weights=weights[rows] * values, minlength=size)
+        rated = np.bincount(columns, weights=weights[rows], minlength=size)
+        counts = np.bincount(columns, minlength=size)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(rated > 0, totals / rated, np.nan), counts
+
+#one user's predictions for the untried treatments of each of their conditions in the index, only comparing the users
+#of their nearest clusters when given the cluster_patients.Clusters of the same data
+def recommend(index, user_rows, k=K, exclude_self=True, min_neighbours=MIN_NEIGHBOURS, clusters=None):
+    user = user_rows.iloc[0]
+    codes = index.profile(user)
+    results = []
+    for condition, rows in user_rows.groupby('condition'):
+        model = index.condition(recommender_engine.model_name(condition))
+        if model is None:
+            continue
+        rows = rows[pd.notnull(rows['effectiveness'])]
+        scores = rows.groupby('treatment')['effectiveness'].mean().to_dict()
+        nearest = None
+        condition_clusters = clusters.condition(recommender_engine.model_name(condition)) if clusters else None
+        if condition_clusters is not None:
+            nearest = (condition_clusters, condition_clusters.nearest(scores))
+        positions, similarities = model.neighbours(model.query_vector(scores, codes), k,
+                                                   exclude=user['user_id'] if exclude_self else None,
+                                                   clusters=nearest)
+        predicted, counts = model.predict(positions, similarities)
+        untried = np.array([treatment not in scores for treatment in model.treatments]) & (counts >= min_neighbours)
+        for t in np.nonzero(untried)[0]:
+            results.append((condition, model.treatments[t], predicted[t], counts[t]))
+    return pd.DataFrame(results, columns=['condition', 'treatment', 'predicted', 'neighbours'])
+
+#an effectiveness file with scale times the users: copies with new ids and each score moved by up to jitter
+def scaled(df, scale, jitter=0.5, seed=0):
+    rng = np.random.RandomState(seed)
+    step = df['user_id'].max() + 1
+    copies = [df]
+    for copy in range(1, scale):
+        rows = df.copy()
+        rows['user_id'] = rows['user_id'] + step * copy
+        rows['effectiveness'] = rows['effectiveness'] + rng.uniform(-jitter, jitter, len(rows))
+        copies.append(rows)
+    return pd.concat(copies, ignore_index=True)
+
+def benchmark(datafile, scale, queries, k, components=COMPONENTS, exact_limit=EXACT_LIMIT, conditions=None):
+    df = scaled(condition_names.canonicalized(pd.read_csv(datafile), conditions or condition_names.index()), scale)
+    print "%d rows, %d users, %d conditions" % (len(df), df['user_id'].nunique(), df['condition'].nunique())
+    modeldir = tempfile.mkdtemp()
+    try:
+        time_index(df, index_path(modeldir), queries, k, components, exact_limit)
+    finally:
+        shutil.rmtree(modeldir)
+
+def time_index(df, path, queries, k, components, exact_limit):
+    started = time.time()
+    conditions, users = build(df, path, components, exact_limit)
+    print "built %d conditions (%d condition users) in %.2fs" % (conditions, users, time.time() - started)
+
+    started = time.time()
+    index = UserIndex(path)
+    #the biggest conditions, where the search costs most
+    sizes = df.groupby('condition')['user_id'].nunique().sort_values(ascending=False)
+    for condition in sizes.index[:3]:
+        index.condition(recommender_engine.model_name(condition))
+    print "opened the index in %.2fs" % (time.time() - started)
+
+    rng = np.random.RandomState(1)
+    for condition in sizes.index[:3]:
+        model = index.condition(recommender_engine.model_name(condition))
+        sample = rng.choice(len(model.user_ids), min(queries, len(model.user_ids)), replace=False)
+        vectors = [model.vectors[position].toarray().ravel() for position in sample]
+        timings = {'exact': [], 'tree': []}
+        found = {}
+        for method in ['exact', 'tree'] if model.approximate() else ['exact']:
+            model.neighbours(vectors[0], k, exact=method == 'exact') #the tree is built on the first query
+            for position, vector in zip(sample, vectors):
+                started = time.time()
+                neighbours, similarities = model.neighbours(vector, k, exclude=model.user_ids[position],
+                                                            exact=method == 'exact')
+                model.predict(neighbours, similarities)
+                timings[method].append(time.time() - started)
+                found.setdefault(method, []).append(set(neighbours))
+        for method, seconds in sorted(timings.items()):
+            if not seconds:
+                continue
+            seconds = np.array(seconds) * 1000
+            recall = ''
+            if method == 'tree':
+                recall = ", found %.1f%% of the exact neighbours" % (100.0 * np.mean(
+                    [len(tree & exact) / float(max(len(exact), 1)) for tree, exact in zip(found['tree'], found['exact'])]))
+            print "%s (%d users, %d treatments) %s: p50 %.2fms p90 %.2fms p99 %.2fms%s" % (
+                condition, len(model.user_ids), len(model.treatments), method, np.percentile(seconds, 50),
+                np.percentile(seconds, 90), np.percentile(seconds, 99), recall)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Recommend treatments from the most similar users')
+    parser.add_argument('command', choices=['build', 'predict', 'benchmark'])
+    parser.add_argument('datafile', help='effectiveness file, or a single user\'s rows for predict')
+    parser.add_argument('modeldir', nargs='?', default='models')
+    parser.add_argument('--k', default=K, type=int, help='similar users to predict from')
+    parser.add_argument('--components', default=COMPONENTS, type=int, help='dimensions of the reduced vectors')
+    parser.add_argument('--exact-limit', default=EXACT_LIMIT, type=int,
+                        help='conditions with up to this many users are searched exactly, without a tree')
+    parser.add_argument('--scale', default=10, type=int, help='benchmark with this many times the users')
+    parser.add_argument('--queries', default=500, type=int)
+    parser.add_argument('--clusters', help='clusters.model of cluster_patients.py, to compare only the nearest clusters\' users')
+    parser.add_argument('--conditions-list', default=condition_names.CONDITIONS_LIST,
+                        help='conditions list to canonicalize condition names with')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        started = time.time()
+        df = condition_names.canonicalized(pd.read_csv(args.datafile), condition_names.index(args.conditions_list))
+        conditions, users = build(df, index_path(args.modeldir), args.components, args.exact_limit)
+        condition_names.record_list(args.modeldir, args.conditions_list)
+        print "indexed %d conditions (%d condition users) in %.2fs" % (conditions, users, time.time() - started)
+    elif args.command == 'predict':
+        clusters = None
+        if args.clusters:
+            import cluster_patients
+            clusters = cluster_patients.Clusters(args.clusters)
+        user_rows = condition_names.canonicalized(pd.read_csv(args.datafile),
+                                                  condition_names.models_index(args.modeldir))
+        predictions = recommend(UserIndex(index_path(args.modeldir)), user_rows, args.k, clusters=clusters)
+        if not len(predictions):
+            print "no similar users found for this user's conditions"
+        else:
+            best = predictions.loc[predictions['predicted'].idxmax()]
+            worst = predictions.loc[predictions['predicted'].idxmin()]
+            if best['predicted'] > 0:
+                print "This user may have good results treating %s with %s (predicted %.2f from %d similar users)" % (
+                    best['condition'], best['treatment'], best['predicted'], best['neighbours'])
+            if worst['predicted'] < 0:
+                print "This user may have good results treating %s by staying away from %s (predicted %.2f from %d similar users)" % (
+                    worst['condition'], worst['treatment'], worst['predicted'], worst['neighbours'])
+    else:
+        benchmark(args.datafile, args.scale, args.queries, args.k, args.components, args.exact_limit,
+                  condition_names.index(args.conditions_list))
@@ -0,0 +1,206 @@
+### Usage: python word_clouds.py datafile [--output word_cloud_images] [--processes N] [--force]
+### Example: python word_clouds.py flaredown_trackable_data_080316.csv --processes 4
+
+### Builds the assets of word_clouds.ipynb in word_cloud_images/:
+###   <condition>.svg       - the symptoms of the users that reported each of the 15 most common conditions
+###   <condition>_tags.svg  - their symptoms (red) and tags (blue), for the 20 most common conditions
+###   <condition>.txt       - the same words as plain text for other word cloud apps, spaces replaced with ~
+###   all.txt               - the symptoms and tags of every user
+### Each user counts once per trackable.  The clouds leave out Fatigue, tired and Headache, which dominate every
+### condition, and the text files keep only a share of the users reporting the most common symptoms instead, as in
+### the notebook.
+
+### Rather than filtering the users of each condition out of the whole export, every condition's frequency table comes
+### from one product of sparse user x trackable matrices.  The clouds are rendered in a process pool.  The hash of each
+### asset's frequency table and settings is kept in manifest.json in the output directory, and an asset whose hash
+### hasn't changed since the last build isn't made again (--force makes everything).
+
+### Rendering needs wordcloud (pip install wordcloud) and matplotlib, without them only the text files are written.
+
+import argparse
+import colorsys
+import hashlib
+import json
+import os
+import random
+import time
+from multiprocessing import Pool
+import numpy as np
+import pandas as pd
+from scipy import sparse
+import trackable_loader
+
+CLOUD_EXCLUDED = ['Fatigue', 'tired', 'Headache']
+#(trackable, n): the text files keep the trackable only for users whose id is a multiple of n
+TEXT_SAMPLED = [('Fatigue', 3), ('tired', 3), ('stressed', 3), ('Anxiety', 3), ('Headache', 2), ('Depression', 2)]
+SYMPTOM_CONDITIONS = 15
+TAG_CONDITIONS = 20
+SYMPTOM_WORDS = 20
+TAG_WORDS = 15
+SYMPTOM_COLORS = ['#00b4d2']
+TAG_COLORS = ['#FF0000', '#00b4d2'] #symptoms, tags
+MANIFEST = 'manifest.json'
+
+#each user once per trackable
+def distinct_trackables(df):
+    df = df.drop_duplicates(['user_id', 'trackable_name'])
+    return df[df['trackable_name'].notnull()]
+
+def top_conditions(df, count):
+    return list(df[df['trackable_type'] == 'Condition']['trackable_name'].astype(object).value_counts().index[0:count])
+
+#for each condition, how many of the users that reported it reported each trackable of types, in one pass
+#df has each user once per trackable, and the conditions are trackables in it
+def condition_frequencies(df, conditions, types):
+    user_index, users = pd.factorize(df['user_id'])
+    name_index, names = pd.factorize(df['trackable_name'].astype(object))
+    shape = (len(users), len(names))
+    reported = sparse.csr_matrix((np.ones(len(df)), (user_index, name_index)), shape=shape)
+    typed = df['trackable_type'].isin(types).values
+    typed_reported = sparse.csr_matrix((np.ones(typed.sum()), (user_index[typed], name_index[typed])), shape=shape)
+
+    condition_users = reported[:, pd.Index(names).get_indexer(conditions)]
+    counts = (condition_users.T * typed_reported).tocsr()
+    frequencies = {}
+    for i, condition in enumerate(conditions):
+        row = counts[i]
+        frequencies[condition] = dict((names[j], int(count)) for j, count in zip(row.indices, row.data))
+    return frequencies
+
+def sampled_for_text(df):
+    for name, every in TEXT_SAMPLED:
+        df = df[(df['trackable_name'] != name) | (df['user_id'] % every == 0)]
+    return df
+
+#slashes would make a directory of the file name
+def file_name(condition, suffix):
+    return condition.replace('/', '-') + suffix
+
+#everything the notebook made, as (file name, frequencies, render settings)
+def assets(df):
+    df = distinct_trackables(df)
+    cloud_df = df[~df['trackable_name'].isin(CLOUD_EXCLUDED)]
+    text_df = sampled_for_text(df)
+    symptom_names = set(cloud_df[cloud_df['trackable_type'] == 'Symptom']['trackable_name'].astype(object))
+
+    found = []
+    conditions = top_conditions(cloud_df, SYMPTOM_CONDITIONS)
+    for condition, frequencies in condition_frequencies(cloud_df, conditions, ['Symptom']).items():
+        found.append((file_name(condition, '.svg'), frequencies,
+                      {'title': condition, 'max_words': SYMPTOM_WORDS, 'colors': SYMPTOM_COLORS}))
+    conditions = top_conditions(cloud_df, TAG_CONDITIONS)
+    for condition, frequencies in condition_frequencies(cloud_df, conditions, ['Symptom', 'Tag']).items():
+        symptoms = sorted(name for name in frequencies if name in symptom_names)
+        found.append((file_name(condition, '_tags.svg'), frequencies,
+                      {'title': condition, 'max_words': TAG_WORDS, 'colors': TAG_COLORS,
+                       'first_color_words': symptoms}))
+    conditions = top_conditions(text_df, TAG_CONDITIONS)
+    for condition, frequencies in condition_frequencies(text_df, conditions, ['Symptom', 'Tag']).items():
+        found.append((file_name(condition, '.txt'), frequencies, {}))
+    words = text_df[text_df['trackable_type'].isin(['Symptom', 'Tag'])]['trackable_name'].astype(object)
+    found.append(('all.txt', dict((name, int(count)) for name, count in words.value_counts().iteritems()), {}))
+    return found
+
+def asset_hash(frequencies, settings):
+    return hashlib.sha1(json.dumps([sorted(frequencies.items()), settings], sort_keys=True)).hexdigest()
+
+#every word once per user that reported it, most reported first
+def write_text(path, frequencies):
+    words = sorted(frequencies.items(), key=lambda item: (-item[1], item[0]))
+    with open(path, 'w') as outfile:
+        outfile.write(' '.join(' '.join([str(name).replace(' ', '~')] * count) for name, count in words))
+
+def color_func(colors, first_color_words):
+    from PIL import ImageColor
+    hsv = [colorsys.rgb_to_hsv(*[channel / 255. for channel in ImageColor.getrgb(color)]) for color in colors]
+    first_color_words = set(first_color_words)
+
+    #the word's color at a random brightness, the first color for first_color_words and the last for the rest
+    def word_color(word=None, font_size=None, position=None, orientation=None, font_path=None, random_state=None):
+        if random_state is None:
+            random_state = random.Random()
+        h, s, v = hsv[0] if word in first_color_words else hsv[-1]
+        r, g, b = colorsys.hsv_to_rgb(h, s, random_state.uniform(0.2, 1))
+        return 'rgb({:.0f}, {:.0f}, {:.0f})'.format(r * 255, g * 255, b * 255)
+    return word_color
+
+def render(job):
+    path, frequencies, settings = job
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from wordcloud import WordCloud
+    wc = WordCloud(max_words=settings['max_words'], margin=10, random_state=1)
+    wc.generate_from_frequencies(frequencies)
+    plt.figure(figsize=(12, 8))
+    plt.title(settings['title'])
+    plt.axis("off")
+    plt.imshow(wc.recolor(color_func=color_func(settings['colors'], settings.get('first_color_words', [])),
+                          random_state=3))
+    plt.savefig(path, format="svg")
+    plt.close()
+    return path
+
+def read_manifest(output):
+    path = os.path.join(output, MANIFEST)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as infile:
+        return json.load(infile)
+
+def write_manifest(output, manifest):
+    with open(os.path.join(output, MANIFEST), 'w') as outfile:
+        json.dump(manifest, outfile, indent=1, sort_keys=True)
+
+def build(datafile, output, processes=None, force=False):
+    started = time.time()
+    df = trackable_loader.load(datafile, columns=['user_id', 'trackable_type', 'trackable_name'])
+    found = assets(df)
+    print "%d frequency tables in %.1fs" % (len(found), time.time() - started)
+
+    if not os.path.exists(output):
+        os.makedirs(output)
+    manifest = read_manifest(output)
+    changed = []
+    for name, frequencies, settings in found:
+        digest = asset_hash(frequencies, settings)
+        if force or manifest.get(name) != digest or not os.path.exists(os.path.join(output, name)):
+            changed.append((name, frequencies, settings, digest))
+    print "%d of %d assets changed" % (len(changed), len(found))
+
+    for name, frequencies, settings, digest in changed:
+        if name.endswith('.txt'):
+            write_text(os.path.join(output, name), frequencies)
+            manifest[name] = digest
+    clouds = [(os.path.join(output, name), frequencies, settings) for name, frequencies, settings, _ in changed
+              if name.endswith('.svg')]
+    digests = dict((os.path.join(output, name), digest) for name, _, _, digest in changed)
+    if clouds:
+        try:
+            import wordcloud
+        except ImportError as error:
+            print "not rendering %d clouds: %s" % (len(clouds), error)
+            clouds = []
+    try:
+        if clouds:
+            pool = Pool(processes)
+            try:
+                for path in pool.imap_unordered(render, clouds):
+                    manifest[os.path.basename(path)] = digests[path]
+                    print path
+            finally:
+                pool.close()
+                pool.join()
+    finally:
+        #keep what was made even if a render fails
+        write_manifest(output, manifest)
+    print "done in %.1fs" % (time.time() - started)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Make the word cloud images and text files of the most common conditions')
+    parser.add_argument('datafile')
+    parser.add_argument('--output', default='word_cloud_images')
+    parser.add_argument('--processes', type=int, default=None, help='render processes, one per cpu by default')
+    parser.add_argument('--force', action='store_true', help='make every asset, changed or not')
+    args = parser.parse_args()
+    build(args.datafile, args.output, args.processes, args.force)